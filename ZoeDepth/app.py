@@ -4,8 +4,15 @@ from PIL import Image
 import torch
 from zoedepth.models.builder import build_model
 from zoedepth.utils.config import get_config
-from zoedepth.utils.misc import pil_to_batched_tensor, colorize, save_raw_16bit
-from flask import Flask, request, jsonify, render_template
+from zoedepth.utils.misc import pil_to_batched_tensor, save_raw_16bit
+from zoedepth.models.bucketing import BucketedDepthModel, parse_buckets
+from zoedepth.serving.batching import InferenceBatcher
+from zoedepth.serving.replicas import ReplicaExecutor
+from zoedepth.serving.cache import DepthCache, CachedInference, inference_settings
+from zoedepth.serving.render import DepthRenderer
+from zoedepth.serving import formats
+from zoedepth.serving.prefork import memory_usage
+from flask import Flask, Response, request, jsonify, render_template, send_file
 from flask_cors import CORS
 import io
 import base64
@@ -22,15 +29,89 @@ CORS(app)
 logging.basicConfig(level=logging.DEBUG)
 
 # Load the ZoeD_N model
-conf = get_config("zoedepth", "infer")
+overwrite = {"pretrained_resource": os.environ["ZOE_PRETRAINED_RESOURCE"]} if "ZOE_PRETRAINED_RESOURCE" in os.environ else {}
+# ZOE_WEIGHTS_DTYPE=bfloat16 (or float16) keeps the layer weights in half precision, see DepthModel.set_weights_dtype
+if os.environ.get("ZOE_WEIGHTS_DTYPE"):
+    overwrite["weights_dtype"] = os.environ["ZOE_WEIGHTS_DTYPE"]
+conf = get_config("zoedepth", "infer", **overwrite)
 model_zoe_n = build_model(conf)
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 zoe = model_zoe_n.to(DEVICE)
 
+# ZOE_PRECISION=bf16 runs inference under bfloat16 autocast, fp16-weights halves the weight memory (see DepthModel.set_precision)
+zoe.set_precision(os.environ.get("ZOE_PRECISION", "fp32"))
+
+# With ZOE_BUCKETS ("default" or e.g. "384x512,672x512"), inputs are padded to one of a few network resolutions and the model is compiled
+# once per resolution at startup, ZOE_COMPILE_CACHE keeps the compiled graphs across restarts (see zoedepth.models.bucketing)
+if os.environ.get("ZOE_BUCKETS"):
+    zoe = BucketedDepthModel(zoe, buckets=parse_buckets(os.environ["ZOE_BUCKETS"]), cache_dir=os.environ.get("ZOE_COMPILE_CACHE"))
+    zoe.warmup(batch_sizes=[int(b) for b in os.environ.get("ZOE_WARMUP_BATCH_SIZES", "2").split(",")])
+
+# Concurrent requests are batched together before going through the model, or with ZOE_REPLICAS set, spread over that many CPU
+# replicas of the model pinned to their own cores (see sweep_replicas.py)
+replicas = int(os.environ.get("ZOE_REPLICAS", 0))
+if replicas and DEVICE != "cpu":
+    logging.warning("ZOE_REPLICAS is ignored, replicas only run on CPU")
+    replicas = 0
+if replicas:
+    batcher = ReplicaExecutor(zoe, replicas=replicas,
+                              threads_per_replica=int(os.environ.get("ZOE_THREADS_PER_REPLICA", 0)) or None,
+                              policy=os.environ.get("ZOE_REPLICA_POLICY", "least_load"))
+else:
+    batcher = InferenceBatcher(zoe, max_batch_size=int(os.environ.get("ZOE_MAX_BATCH_SIZE", 4)),
+                               max_wait_ms=float(os.environ.get("ZOE_MAX_WAIT_MS", 10)))
+
+# ZOE_RESIZE_FIRST=1 resizes uploads to the network resolution before the padding and flip augmentations instead of augmenting the full
+# resolution image (see DepthModel.infer_with_tta)
+infer_kwargs = dict(resize_first=True) if os.environ.get("ZOE_RESIZE_FIRST") == "1" else {}
+
+# Repeated uploads of the same image are served from the cache
+cache = DepthCache(max_bytes=int(os.environ.get("ZOE_CACHE_MB", 256)) * 2**20, cache_dir=os.environ.get("ZOE_CACHE_DIR"))
+depth_model = CachedInference(batcher, cache, model_id=f"{conf.model}_{conf.version_name}", checkpoint=conf.pretrained_resource,
+                              settings=inference_settings(zoe, conf))
+
+# Colorized depth maps are inlined in the /upload JSON and served from /depth/<key>.png, at full resolution unless ZOE_RENDER_MAX_SIDE
+# (e.g. 1024) caps their longer side
+renderer = DepthRenderer(cmap='inferno', max_side=int(os.environ["ZOE_RENDER_MAX_SIDE"]) if os.environ.get("ZOE_RENDER_MAX_SIDE") else None)
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/stats')
+def stats():
+    return jsonify(batcher=batcher.stats(), cache=cache.stats(), worker=dict(pid=os.getpid(), **memory_usage()))
+
+def colorized_png(depth_numpy):
+    depth_numpy = renderer.downscale(depth_numpy)
+    # Same normalization as zoedepth.utils.misc.colorize
+    colored = renderer.colorize(depth_numpy, vmin=np.percentile(depth_numpy, 2), vmax=np.percentile(depth_numpy, 85))
+    buf = io.BytesIO()
+    Image.fromarray(colored).save(buf, format="PNG", compress_level=renderer.compress_level)
+    return buf.getvalue()
+
+@app.route('/depth/<key>.png')
+def depth_png(key):
+    depth_numpy = depth_model.lookup(key)
+    if depth_numpy is None:
+        return jsonify({'error': 'Unknown or expired depth key, upload the image again'}), 404
+    return send_file(io.BytesIO(colorized_png(depth_numpy)), mimetype='image/png')
+
+@app.route('/depth/<key>')
+def depth_raw(key):
+    # Raw relative depth (before the wall height scale factor) in one of the binary formats, see zoedepth.serving.formats
+    depth_numpy = depth_model.lookup(key)
+    if depth_numpy is None:
+        return jsonify({'error': 'Unknown or expired depth key, upload the image again'}), 404
+    try:
+        fmt = formats.negotiate(request.accept_mimetypes, request.args.get('format'), default=formats.FORMATS['f16z'][0])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if fmt not in formats.FORMATS:
+        fmt = 'f16z'
+    body, mimetype = formats.encode(depth_numpy, fmt, units="m")
+    return Response(body, mimetype=mimetype, headers={'X-Depth-Key': key})
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     logging.debug("Upload endpoint called")
@@ -47,7 +128,14 @@ def upload_file():
     height = 10  # Known height of the wall in feet
 
     try:
-        image = Image.open(file).convert("RGB")  # Convert image to RGB
+        # JSON with the colorized depth map inlined unless the client asks for one of the binary depth formats
+        fmt = formats.negotiate(request.accept_mimetypes, request.args.get('format'), default='application/json')
+    except ValueError as e:
+        return jsonify({'width': width_feet or random.uniform(8, 10), 'height': height, 'error': str(e)}), 400
+
+    try:
+        image_data = file.read()
+        image = Image.open(io.BytesIO(image_data)).convert("RGB")  # Convert image to RGB
         logging.debug(f"Image opened successfully: {image}")
     except Exception as e:
         logging.error(f"Error opening image: {e}")
@@ -78,7 +166,8 @@ def upload_file():
         logging.debug(f"Integer reference points: {ref_points}")
 
         # Predict depth using ZoeDepth model
-        depth_numpy = zoe.infer_pil(image)  # Get depth as numpy array
+        key = depth_model.key(image, image_bytes=image_data, **infer_kwargs)
+        depth_numpy = depth_model.infer_pil(image, key=key, **infer_kwargs)  # Get depth as numpy array
 
         # Convert feet to meters
         known_height_meters = height * 0.3048  
@@ -136,18 +225,27 @@ def upload_file():
         fpath = "output.png"  # Update with your desired output path
         save_raw_16bit(depth_metric, fpath)
 
-        # Colorize and save the depth output
-        colored = colorize(depth_metric, cmap='inferno')
-        fpath_colored = "output_colored.png"  # Update with your desired output path
-        colored_image = Image.fromarray(colored)
-        buffered = io.BytesIO()
-        colored_image.save(buffered, format="PNG")
-        depth_image_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        if fmt in formats.FORMATS:
+            # The metric depth map as the body, the measurements as headers
+            body, mimetype = formats.encode(depth_metric, fmt, units="m")
+            return Response(body, mimetype=mimetype, headers={'X-Depth-Key': key, 'X-Width-Feet': str(width_feet),
+                                                              'X-Height-Feet': str(height), 'X-Scale-Factor': str(scale_factor)})
+
+        if request.args.get('depth') == 'url':
+            # The depth map is not inlined, the client fetches the colorized or the raw depth by key
+            return jsonify({
+                'width': width_feet,
+                'height': height,
+                'depth_key': key,
+                'depth_url': f'/depth/{key}.png',
+                'depth_raw_url': f'/depth/{key}?format=f16z',
+                'scale_factor': scale_factor
+            })
 
         return jsonify({
             'width': width_feet,
             'height': height,
-            'depth_image': depth_image_str
+            'depth_image': base64.b64encode(colorized_png(depth_metric)).decode("utf-8")
         })
     except Exception as e:
         logging.error(f"Error processing image: {e}")
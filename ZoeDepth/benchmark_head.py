@@ -0,0 +1,136 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Measures the effect of the head_resolution option of ZoeDepth models on latency, peak memory and (optionally) accuracy.
+
+Latency and memory are measured in a fresh python process per head_resolution; memory is the peak increase over the resident size of
+the loaded model (or the peak allocated CUDA memory):
+
+    python benchmark_head.py --head_resolution 1 0.5 0.25
+    python benchmark_head.py --head_resolution 1 0.5 -d nyu   # also evaluate on an eval split, see evaluate.py
+
+A head_resolution of 1 is the default behaviour.
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+def overwrite_kwargs(args, head_resolution):
+    overwrite = dict(head_resolution=head_resolution if head_resolution < 1 else None)
+    if args.pretrained_resource is not None:
+        overwrite['pretrained_resource'] = args.pretrained_resource or None
+    return overwrite
+
+
+def child(args):
+    import torch
+    from zoedepth.models.builder import build_model
+    from zoedepth.utils.config import get_config
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = build_model(get_config(args.model, "infer", **overwrite_kwargs(args, args.head_resolution[0]))).to(device).eval()
+    h, w = args.size
+    x = torch.rand(args.batch_size, 3, h, w, device=device)
+
+    with torch.no_grad():
+        model.infer(x, with_flip_aug=not args.no_flip_aug)  # warm up
+        base = rss_mb()
+        if device == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated() / 2**20
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            model.infer(x, with_flip_aug=not args.no_flip_aug)
+        if device == "cuda":
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated() / 2**20
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    latency = (time.perf_counter() - start) / args.repeats
+    print(json.dumps(dict(latency_ms=latency * 1000, peak_mb=peak - base)))
+
+
+def evaluate_accuracy(args, head_resolution):
+    from evaluate import DEVICE, evaluate
+    from zoedepth.data.data_mono import DepthDataLoader
+    from zoedepth.models.builder import build_model
+    from zoedepth.utils.config import get_config
+
+    config = get_config(args.model, "eval", args.dataset, **overwrite_kwargs(args, head_resolution))
+    model = build_model(config).to(DEVICE)
+    return evaluate(model, DepthDataLoader(config, 'online_eval').data, config)
+
+
+def main(args):
+    results = {}
+    for r in args.head_resolution:
+        cmd = [sys.executable, __file__, "--child", "-m", args.model, "--head_resolution", str(r), "-n", str(args.repeats),
+               "-b", str(args.batch_size), "--size", *map(str, args.size)]
+        if args.pretrained_resource is not None:
+            cmd += ["-p", args.pretrained_resource]
+        if args.no_flip_aug:
+            cmd.append("--no_flip_aug")
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results[r] = json.loads(out.strip().splitlines()[-1])
+
+    ref = results[args.head_resolution[0]]
+    print(f"{'head_resolution':<16}{'latency':>12}{'peak memory':>14}")
+    for r, res in results.items():
+        print(f"{r:<16}{res['latency_ms']:>10.0f}ms{res['peak_mb']:>12.0f}MB"
+              f"  ({res['latency_ms'] / ref['latency_ms']:.2f}x time, {res['peak_mb'] / max(ref['peak_mb'], 1):.2f}x memory)")
+
+    if args.dataset:
+        metrics = {r: evaluate_accuracy(args, r) for r in args.head_resolution}
+        ref = metrics[args.head_resolution[0]]
+        print(f"Accuracy on {args.dataset}, delta to head_resolution={args.head_resolution[0]}:")
+        for r, m in metrics.items():
+            print(r, {k: f"{v} ({v - ref[k]:+.4f})" for k, v in m.items()})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="zoedepth", help="Name of the model to benchmark")
+    parser.add_argument("-p", "--pretrained_resource", type=str, default=None,
+                        help="Pretrained resource to load. Defaults to the resource of the model config, an empty string uses random weights")
+    parser.add_argument("--head_resolution", type=float, nargs="+", default=[1, 0.5], help="head resolutions to compare, the first is the reference")
+    parser.add_argument("-n", "--repeats", type=int, default=3, help="Number of timed inferences")
+    parser.add_argument("-b", "--batch_size", type=int, default=1)
+    parser.add_argument("--size", type=int, nargs=2, default=[480, 640], metavar=("H", "W"), help="Input image size")
+    parser.add_argument("--no_flip_aug", action="store_true", help="Disable flip augmentation")
+    parser.add_argument("-d", "--dataset", type=str, default=None, help="Eval dataset to measure the accuracy delta on")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+    else:
+        main(args)
@@ -0,0 +1,92 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Measures the cold start time of a ZoeDepth model: imports, model construction, weight loading and the first forward pass.
+
+Every run happens in a fresh python process so that module and torch hub caches of earlier runs don't count. Compare the vendored MiDaS
+code with the torch hub fallback (the old behaviour) with
+
+    python benchmark_startup.py --midas_source local hub
+
+Pass -p "" to skip loading the ZoeDepth checkpoint and time model construction only.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+
+def child(args):
+    t0 = time.perf_counter()
+    import torch
+    from zoedepth.models.builder import build_model
+    from zoedepth.utils.config import get_config
+    t1 = time.perf_counter()
+
+    overwrite = dict(midas_source=args.midas_source)
+    if args.pretrained_resource is not None:
+        overwrite['pretrained_resource'] = args.pretrained_resource or None
+    conf = get_config(args.model, "infer", **overwrite)
+    model = build_model(conf).eval()
+    t2 = time.perf_counter()
+
+    with torch.no_grad():
+        model(torch.rand(1, 3, 384, 512))
+    t3 = time.perf_counter()
+    print(json.dumps(dict(imports=t1 - t0, build=t2 - t1, first_forward=t3 - t2, total=t3 - t0)))
+
+
+def main(args):
+    runs = {}
+    for source in args.midas_source:
+        cmd = [sys.executable, __file__, "--child", "-m", args.model, "--midas_source", source]
+        if args.pretrained_resource is not None:
+            cmd += ["-p", args.pretrained_resource]
+        runs[source] = []
+        for _ in range(args.repeats):
+            out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            runs[source].append(json.loads(out.strip().splitlines()[-1]))
+
+    print(f"{'midas_source':<14}" + "".join(f"{k:>15}" for k in ("imports", "build", "first_forward", "total")))
+    for source, results in runs.items():
+        # best of the repeats, the slower runs mostly measure disk cache misses
+        best = {k: min(r[k] for r in results) for k in results[0]}
+        print(f"{source:<14}" + "".join(f"{best[k]:>14.2f}s" for k in ("imports", "build", "first_forward", "total")))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="zoedepth", help="Name of the model to benchmark")
+    parser.add_argument("-p", "--pretrained_resource", type=str, default=None,
+                        help="Pretrained resource to load. Defaults to the resource of the model config, an empty string skips loading weights")
+    parser.add_argument("--midas_source", type=str, nargs="+", default=["local"], choices=["local", "hub"],
+                        help="Where the MiDaS code comes from, more than one value compares them")
+    parser.add_argument("-n", "--repeats", type=int, default=3, help="Number of cold starts per midas_source")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        args.midas_source = args.midas_source[0]
+        child(args)
+    else:
+        main(args)
@@ -0,0 +1,132 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Compares flip augmentation on every input with adaptive flip augmentation (see DepthModel.infer_with_adaptive_flip_aug) on latency,
+the fraction of inputs that got the flipped pass, and accuracy:
+
+    python compare_adaptive_tta.py -m zoedepth --images /path/to/images --thresholds 0.05 0.1 0.2
+    python compare_adaptive_tta.py -m zoedepth -d nyu   # also evaluate on an eval split, see evaluate.py
+
+Accuracy is reported as the mean relative difference of the predicted depth to flip augmentation on every input and, with -d, as the
+eval metrics. The uncertainty of every input is printed as well, its quantiles are a starting point for the thresholds.
+"""
+
+import argparse
+import time
+
+import torch
+
+from compare_precision import load_inputs
+from zoedepth.models.builder import build_model
+from zoedepth.utils.config import get_config
+
+
+class Inference(object):
+    def __init__(self, flip_threshold=None, with_flip_aug=True, pad_input=True):
+        """model.infer with the given flip augmentation, counting the inputs that got the flipped pass"""
+        self.kwargs = dict(with_flip_aug=with_flip_aug, pad_input=pad_input)
+        self.flip_threshold = flip_threshold
+        self.count = self.flipped = 0
+        self.uncertainties = []
+
+    def __call__(self, model, images, **kwargs):
+        self.count += images.shape[0]
+        if not self.kwargs['with_flip_aug']:
+            return model.infer(images, **self.kwargs)
+        if self.flip_threshold is None:
+            self.flipped += images.shape[0]
+            return model.infer(images, **self.kwargs)
+        pred, uncertainty = model.infer(images, flip_threshold=self.flip_threshold, return_uncertainty=True, **self.kwargs)
+        self.flipped += int((uncertainty > self.flip_threshold).sum())
+        self.uncertainties.append(uncertainty.cpu())
+        return pred
+
+    @property
+    def flip_rate(self):
+        return self.flipped / max(self.count, 1)
+
+
+@torch.no_grad()
+def run(model, inputs, inference):
+    inference(model, inputs[0].to(model.device))  # warm up
+    inference.count = inference.flipped = 0
+    inference.uncertainties = []
+    start = time.perf_counter()
+    outputs = [inference(model, x.to(model.device)).cpu() for x in inputs]
+    return outputs, (time.perf_counter() - start) / len(inputs) * 1000
+
+
+def main(args):
+    overwrite = {} if args.pretrained_resource is None else dict(pretrained_resource=args.pretrained_resource or None)
+    config = get_config(args.model, "eval", args.dataset, **overwrite) if args.dataset else get_config(args.model, "infer", **overwrite)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = build_model(config).to(device).eval()
+    inputs = load_inputs(args)
+
+    # infinite threshold: first pass only, to get the uncertainties
+    probe = Inference(flip_threshold=float("inf"), pad_input=not args.no_pad_input)
+    run(model, inputs, probe)
+    quantiles = torch.quantile(torch.cat(probe.uncertainties), torch.tensor([.1, .25, .5, .75, .9])).tolist()
+    print("uncertainty quantiles (10, 25, 50, 75, 90%):", [round(q, 4) for q in quantiles])
+
+    modes = {"flip": dict(), "no flip": dict(with_flip_aug=False)}
+    modes.update({f"adaptive {t}": dict(flip_threshold=t) for t in args.thresholds})
+    results, reference = {}, None
+    for mode, kwargs in modes.items():
+        inference = Inference(pad_input=not args.no_pad_input, **kwargs)
+        outputs, latency = run(model, inputs, inference)
+        reference = reference or outputs
+        rel = torch.stack([((o - r).abs() / r.abs().clamp(min=1e-6)).mean() for o, r in zip(outputs, reference)]).mean().item()
+        results[mode] = dict(latency_ms=latency, flip_rate=inference.flip_rate, rel_diff=rel)
+        if args.dataset:
+            from evaluate import evaluate
+            from zoedepth.data.data_mono import DepthDataLoader
+
+            # the eval split is run without padding augmentation, as in evaluate.py
+            inference = Inference(pad_input=False, **kwargs)
+            results[mode]['metrics'] = evaluate(model, DepthDataLoader(config, 'online_eval').data, config, infer_fn=inference)
+            results[mode]['eval_flip_rate'] = inference.flip_rate
+
+    ref = results["flip"]
+    print(f"{'mode':<18}{'latency':>12}{'flipped':>10}{'rel diff':>12}")
+    for mode, res in results.items():
+        print(f"{mode:<18}{res['latency_ms']:>10.0f}ms{res['flip_rate']:>10.0%}{res['rel_diff']:>12.2e}"
+              f"  ({res['latency_ms'] / ref['latency_ms']:.2f}x time)")
+    if args.dataset:
+        print(f"Accuracy on {args.dataset}, delta to flip:")
+        for mode, res in results.items():
+            print(mode, f"flipped {res['eval_flip_rate']:.0%}", {k: f"{v} ({v - ref['metrics'][k]:+.4f})" for k, v in res['metrics'].items()})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="zoedepth", help="Name of the model to compare")
+    parser.add_argument("-p", "--pretrained_resource", type=str, default=None,
+                        help="Pretrained resource to load. Defaults to the resource of the model config, an empty string uses random weights")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.05, 0.1, 0.2],
+                        help="flip thresholds to compare, on the mean relative standard deviation of the predicted depth")
+    parser.add_argument("--images", type=str, default=None, help="Folder of images to compare the outputs on. Defaults to a random input")
+    parser.add_argument("--num_images", type=int, default=8)
+    parser.add_argument("--size", type=int, nargs=2, default=[480, 640], metavar=("H", "W"), help="Size of the random input")
+    parser.add_argument("--no_pad_input", action="store_true", help="Disable padding augmentation")
+    parser.add_argument("-d", "--dataset", type=str, default=None, help="Eval dataset to measure the accuracy delta on")
+    main(parser.parse_args())
@@ -0,0 +1,113 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Compares the inference precisions of ZoeDepth models (see DepthModel.set_precision) on latency, weight memory and accuracy:
+
+    python compare_precision.py -m zoedepth --images /path/to/images
+    python compare_precision.py -m zoedepth -d nyu   # also evaluate on an eval split, see evaluate.py
+
+Accuracy is reported as the mean relative difference of the predicted depth to fp32 and, with -d, as the eval metrics. Precisions run in
+the given order on the same model; fp16-weights rounds the weights, so it should come last.
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from zoedepth.models.builder import build_model
+from zoedepth.utils.config import get_config
+
+
+def load_inputs(args):
+    if not args.images:
+        return [torch.rand(1, 3, *args.size)]
+    paths = sorted(glob.glob(os.path.join(args.images, "*")))[:args.num_images]
+    return [transforms.ToTensor()(Image.open(p).convert("RGB")).unsqueeze(0) for p in paths]
+
+
+def weight_mb(model):
+    return sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
+
+
+@torch.no_grad()
+def run(model, inputs, args):
+    model.infer(inputs[0].to(model.device), with_flip_aug=not args.no_flip_aug)  # warm up
+    start = time.perf_counter()
+    outputs = [model.infer(x.to(model.device), with_flip_aug=not args.no_flip_aug).cpu() for x in inputs]
+    return outputs, (time.perf_counter() - start) / len(inputs) * 1000
+
+
+def evaluate_accuracy(model, config, precision):
+    from evaluate import DEVICE, evaluate
+    from zoedepth.data.data_mono import DepthDataLoader
+
+    # evaluate calls the model directly, not through infer, so the autocast of bf16 is applied here
+    with torch.autocast(torch.device(DEVICE).type, dtype=torch.bfloat16, enabled=precision == "bf16"):
+        return evaluate(model, DepthDataLoader(config, 'online_eval').data, config)
+
+
+def main(args):
+    overwrite = {} if args.pretrained_resource is None else dict(pretrained_resource=args.pretrained_resource or None)
+    config = get_config(args.model, "eval", args.dataset, **overwrite) if args.dataset else get_config(args.model, "infer", **overwrite)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = build_model(config).to(device).eval()
+    inputs = load_inputs(args)
+
+    results, reference = {}, None
+    for precision in args.precision:
+        model.set_precision(precision)
+        outputs, latency = run(model, inputs, args)
+        reference = reference or outputs
+        rel = torch.stack([((o - r).abs() / r.abs().clamp(min=1e-6)).mean() for o, r in zip(outputs, reference)]).mean().item()
+        results[precision] = dict(latency_ms=latency, weight_mb=weight_mb(model), rel_diff=rel)
+        if args.dataset:
+            results[precision]['metrics'] = evaluate_accuracy(model, config, precision)
+
+    ref = results[args.precision[0]]
+    print(f"{'precision':<14}{'latency':>12}{'weights':>12}{'rel diff':>12}")
+    for precision, res in results.items():
+        print(f"{precision:<14}{res['latency_ms']:>10.0f}ms{res['weight_mb']:>10.0f}MB{res['rel_diff']:>12.2e}"
+              f"  ({res['latency_ms'] / ref['latency_ms']:.2f}x time)")
+    if args.dataset:
+        print(f"Accuracy on {args.dataset}, delta to {args.precision[0]}:")
+        for precision, res in results.items():
+            print(precision, {k: f"{v} ({v - ref['metrics'][k]:+.4f})" for k, v in res['metrics'].items()})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="zoedepth", help="Name of the model to compare")
+    parser.add_argument("-p", "--pretrained_resource", type=str, default=None,
+                        help="Pretrained resource to load. Defaults to the resource of the model config, an empty string uses random weights")
+    parser.add_argument("--precision", type=str, nargs="+", default=["fp32", "bf16", "fp16-weights"],
+                        help="precisions to compare, the first is the reference")
+    parser.add_argument("--images", type=str, default=None, help="Folder of images to compare the outputs on. Defaults to a random input")
+    parser.add_argument("--num_images", type=int, default=8)
+    parser.add_argument("--size", type=int, nargs=2, default=[480, 640], metavar=("H", "W"), help="Size of the random input")
+    parser.add_argument("--no_flip_aug", action="store_true", help="Disable flip augmentation")
+    parser.add_argument("-d", "--dataset", type=str, default=None, help="Eval dataset to measure the accuracy delta on")
+    main(parser.parse_args())
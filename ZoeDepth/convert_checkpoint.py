@@ -0,0 +1,78 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Converts a ZoeDepth checkpoint to the flat memory-mapped format of zoedepth.models.model_io.save_mmap_checkpoint.
+
+    python convert_checkpoint.py url::https://github.com/isl-org/ZoeDepth/releases/download/v1.0/ZoeD_M12_N.pt ZoeD_M12_N.safetensors
+
+The result is loaded with the pretrained resource mmap::/path/to/ZoeD_M12_N.safetensors, e.g.
+
+    python evaluate.py -m zoedepth -p mmap::ZoeD_M12_N.safetensors
+
+With --weights_dtype bfloat16 (or float16), the layer weights are written in half precision. A model built with the same weights_dtype
+maps them without a copy, so processes serving the same file share half the memory:
+
+    python convert_checkpoint.py url::https://github.com/isl-org/ZoeDepth/releases/download/v1.0/ZoeD_M12_N.pt ZoeD_M12_N_bf16.safetensors --weights_dtype bfloat16
+    python evaluate.py -m zoedepth -p mmap::ZoeD_M12_N_bf16.safetensors --weights_dtype bfloat16
+"""
+
+import argparse
+import os
+
+import torch
+
+from zoedepth.models.model_io import load_mmap_checkpoint, save_mmap_checkpoint
+from zoedepth.models.precision import WEIGHT_DTYPES
+
+
+def load_checkpoint(resource):
+    if resource.startswith("url::"):
+        return torch.hub.load_state_dict_from_url(resource.split("url::")[1], map_location="cpu", progress=True)
+    return torch.load(resource.split("local::")[-1], map_location="cpu")
+
+
+def main(args):
+    ckpt = load_checkpoint(args.checkpoint)
+    state_dict = ckpt.get("model", ckpt)
+    # same prefix handling as model_io.load_state_dict, so the converted file loads into plain (non DataParallel) models
+    state_dict = {(k[7:] if k.startswith("module.") else k): v for k, v in state_dict.items() if isinstance(v, torch.Tensor)}
+    if args.weights_dtype:
+        # the weights of linear and conv layers, the ones DepthModel.set_weights_dtype stores in half precision. Other tensors converted
+        # here are upcast again when loaded.
+        state_dict = {k: v.to(WEIGHT_DTYPES[args.weights_dtype]) if k.endswith(".weight") and v.dim() > 1 and v.is_floating_point() else v
+                      for k, v in state_dict.items()}
+
+    save_mmap_checkpoint(state_dict, args.output, metadata={"source": args.checkpoint})
+
+    converted = load_mmap_checkpoint(args.output)
+    assert converted.keys() == state_dict.keys()
+    assert all(torch.equal(converted[k], v) for k, v in state_dict.items())
+    print(f"Wrote {len(converted)} tensors ({os.path.getsize(args.output) / 2**20:.1f} MB) to {args.output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint", type=str, help="Checkpoint to convert, a path or a url:: / local:: resource")
+    parser.add_argument("output", type=str, help="Output file, conventionally *.safetensors")
+    parser.add_argument("--weights_dtype", type=str, default=None, choices=list(WEIGHT_DTYPES),
+                        help="Store the layer weights in half precision, for models built with the same weights_dtype")
+    main(parser.parse_args())
@@ -36,6 +36,8 @@ from zoedepth.utils.config import change_dataset, get_config, ALL_EVAL_DATASETS,
 from zoedepth.utils.misc import (RunningAverageDict, colors, compute_metrics,
                         count_parameters)
 
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
 
 @torch.no_grad()
 def infer(model, images, **kwargs):
@@ -52,12 +54,13 @@ def infer(model, images, **kwargs):
             raise NotImplementedError(f"Unknown output type {type(pred)}")
         return pred
 
-    pred1 = model(images, **kwargs)
-    pred1 = get_depth_from_prediction(pred1)
+    # run both views as a single batch
+    n = images.shape[0]
+    pred = model(torch.cat([images, torch.flip(images, [3])], dim=0), **kwargs)
+    pred = get_depth_from_prediction(pred)
 
-    pred2 = model(torch.flip(images, [3]), **kwargs)
-    pred2 = get_depth_from_prediction(pred2)
-    pred2 = torch.flip(pred2, [3])
+    pred1 = pred[:n]
+    pred2 = torch.flip(pred[n:], [3])
 
     mean_pred = 0.5 * (pred1 + pred2)
 
@@ -65,7 +68,8 @@ def infer(model, images, **kwargs):
 
 
 @torch.no_grad()
-def evaluate(model, test_loader, config, round_vals=True, round_precision=3):
+def evaluate(model, test_loader, config, round_vals=True, round_precision=3, infer_fn=infer):
+    """Evaluates model on test_loader. infer_fn(model, images, **kwargs) returns the predicted depth, defaults to infer (flip augmentation)"""
     model.eval()
     metrics = RunningAverageDict()
     for i, sample in tqdm(enumerate(test_loader), total=len(test_loader)):
@@ -73,11 +77,11 @@ def evaluate(model, test_loader, config, round_vals=True, round_precision=3):
             if not sample['has_valid_depth']:
                 continue
         image, depth = sample['image'], sample['depth']
-        image, depth = image.cuda(), depth.cuda()
+        image, depth = image.to(DEVICE), depth.to(DEVICE)
         depth = depth.squeeze().unsqueeze(0).unsqueeze(0)
         focal = sample.get('focal', torch.Tensor(
-            [715.0873]).cuda())  # This magic number (focal) is only used for evaluating BTS model
-        pred = infer(model, image, dataset=sample['dataset'][0], focal=focal)
+            [715.0873]).to(DEVICE))  # This magic number (focal) is only used for evaluating BTS model
+        pred = infer_fn(model, image, dataset=sample['dataset'][0], focal=focal)
 
         # Save image, depth, pred for visualization
         if "save_images" in config and config.save_images:
@@ -108,19 +112,31 @@ def evaluate(model, test_loader, config, round_vals=True, round_precision=3):
     metrics = {k: r(v) for k, v in metrics.get_value().items()}
     return metrics
 
-def main(config):
+def main(config, compare_weights=False):
+    weights_dtype = config.get("weights_dtype")
+    if compare_weights and weights_dtype:
+        # the same checkpoint is evaluated with float32 weights first, then with the weights stored in weights_dtype
+        config.weights_dtype = None
     model = build_model(config)
     test_loader = DepthDataLoader(config, 'online_eval').data
-    model = model.cuda()
+    model = model.to(DEVICE)
+    if compare_weights and weights_dtype:
+        reference = evaluate(model, test_loader, config)
+        model.set_weights_dtype(weights_dtype)
+        config.weights_dtype = weights_dtype
     metrics = evaluate(model, test_loader, config)
     print(f"{colors.fg.green}")
     print(metrics)
     print(f"{colors.reset}")
+    if compare_weights and weights_dtype:
+        print(f"Delta of {weights_dtype} weights to float32 weights:")
+        print({k: round(v - reference[k], 4) for k, v in metrics.items()})
     metrics['#params'] = f"{round(count_parameters(model, include_all=True)/1e6, 2)}M"
+    metrics['weights'] = f"{round(sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20)}MB"
     return metrics
 
 
-def eval_model(model_name, pretrained_resource, dataset='nyu', **kwargs):
+def eval_model(model_name, pretrained_resource, dataset='nyu', compare_weights=False, **kwargs):
 
     # Load default pretrained resource defined in config if not set
     overwrite = {**kwargs, "pretrained_resource": pretrained_resource} if pretrained_resource else kwargs
@@ -128,7 +144,7 @@ def eval_model(model_name, pretrained_resource, dataset='nyu', **kwargs):
     # config = change_dataset(config, dataset)  # change the dataset
     pprint(config)
     print(f"Evaluating {model_name} on {dataset}...")
-    metrics = main(config)
+    metrics = main(config, compare_weights=compare_weights)
     return metrics
 
 
@@ -140,6 +156,8 @@ if __name__ == '__main__':
                         required=False, default=None, help="Pretrained resource to use for fetching weights. If not set, default resource from model config is used,  Refer models.model_io.load_state_from_resource for more details.")
     parser.add_argument("-d", "--dataset", type=str, required=False,
                         default='nyu', help="Dataset to evaluate on")
+    parser.add_argument("--compare_weights", action="store_true",
+                        help="With --weights_dtype float16|bfloat16, also evaluate the float32 weights and print the accuracy delta")
 
     args, unknown_args = parser.parse_known_args()
     overwrite_kwargs = parse_unknown(unknown_args)
@@ -157,4 +175,4 @@ if __name__ == '__main__':
     
     for dataset in datasets:
         eval_model(args.model, pretrained_resource=args.pretrained_resource,
-                    dataset=dataset, **overwrite_kwargs)
+                    dataset=dataset, compare_weights=args.compare_weights, **overwrite_kwargs)
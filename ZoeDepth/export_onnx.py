@@ -0,0 +1,108 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Exports a ZoeDepth model to ONNX (see zoedepth.models.onnx_export), validates the ONNX Runtime outputs against the PyTorch model and
+compares their CPU latency:
+
+    python export_onnx.py -m zoedepth -o ZoeD_N.onnx
+    python export_onnx.py -m zoedepth_nk -o ZoeD_NK.onnx --size 384 512 --image /path/to/image.jpg
+
+Validation runs on images of the size given by --input_size (random, or --image resized to it), which PyTorch resizes to --size when
+their aspect ratio matches. Portrait (--input_size transposed) and wide (twice as wide) images are letterboxed to --size by
+OnnxDepthModel, they are checked against PyTorch on the same letterboxed input.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from zoedepth.models.bucketing import pad_to_bucket
+from zoedepth.models.builder import build_model
+from zoedepth.models.onnx_export import OnnxDepthModel, export_onnx
+from zoedepth.utils.config import get_config
+
+
+@torch.no_grad()
+def latency_ms(model, x, repeats):
+    model.infer(x, with_flip_aug=False)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.infer(x, with_flip_aug=False)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def load_input(args, h, w):
+    if args.image:
+        x = transforms.ToTensor()(Image.open(args.image).convert("RGB").resize((w, h))).unsqueeze(0)
+    else:
+        x = torch.rand(1, 3, h, w)
+    return x.repeat(args.batch_size, 1, 1, 1)
+
+
+def check(actual, expected, tolerance, name):
+    diff = (actual - expected).abs()
+    rel = diff / expected.abs().clamp(min=1e-6)
+    print(f"{name}: max abs diff {diff.max().item():.2e}, mean rel diff {rel.mean().item():.2e}")
+    if rel.mean().item() > tolerance:
+        raise SystemExit(f"ONNX Runtime outputs differ from PyTorch by more than {tolerance} ({name})")
+
+
+def main(args):
+    overwrite = {} if args.pretrained_resource is None else dict(pretrained_resource=args.pretrained_resource or None)
+    model = build_model(get_config(args.model, "infer", **overwrite)).eval()
+    export_onnx(model, args.output, size=args.size, opset_version=args.opset)
+    print(f"Exported {args.model} to {args.output}")
+    onnx_model = OnnxDepthModel(args.output)
+
+    h, w = args.input_size
+    x = load_input(args, h, w)
+    with torch.no_grad():
+        check(onnx_model.infer(x), model.infer(x), args.tolerance, f"{h}x{w}")
+
+        for name, (ih, iw) in (("portrait", (w, h)), ("wide", (h, 2 * w))):
+            xi = load_input(args, ih, iw)
+            xp, crop = pad_to_bucket(xi, onnx_model.network_size(ih, iw), args.size)
+            check(onnx_model(xi)['metric_depth'], crop(model(xp)['metric_depth']), args.tolerance, f"{name} {ih}x{iw}, letterboxed")
+
+    x = x[:1]
+    torch_ms, onnx_ms = latency_ms(model, x, args.repeats), latency_ms(onnx_model, x, args.repeats)
+    print(f"CPU latency at {h}x{w}: PyTorch {torch_ms:.0f}ms, ONNX Runtime {onnx_ms:.0f}ms ({onnx_ms / torch_ms:.2f}x)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="zoedepth", help="Name of the model to export")
+    parser.add_argument("-p", "--pretrained_resource", type=str, default=None,
+                        help="Pretrained resource to load. Defaults to the resource of the model config, an empty string uses random weights")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Path of the exported model")
+    parser.add_argument("--size", type=int, nargs=2, default=[384, 512], metavar=("H", "W"), help="Network resolution of the exported model")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--input_size", type=int, nargs=2, default=[480, 640], metavar=("H", "W"), help="Size of the validation images")
+    parser.add_argument("--image", type=str, default=None, help="Validation image. Defaults to random noise")
+    parser.add_argument("-b", "--batch_size", type=int, default=2, help="Validation batch size, checks the dynamic batch dimension")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Maximum mean relative difference to the PyTorch outputs")
+    parser.add_argument("-n", "--repeats", type=int, default=3, help="Number of timed inferences")
+    main(parser.parse_args())
@@ -22,7 +22,7 @@
 
 # File author: Shariq Farooq Bhat
 
-dependencies=['torch']
+dependencies=['torch', 'timm']
 from zoedepth.utils.config import get_config
 from zoedepth.models.builder import build_model
 import numpy as np
@@ -56,6 +56,7 @@ def ZoeD_N(pretrained=False, midas_model_type="DPT_BEiT_L_384", config_mode="inf
             min_temp (int): Lower bound for temperature of output probability distribution. Defaults to 0.0212.
             max_temp (int): Upper bound for temperature of output probability distribution. Defaults to 50.
             force_keep_ar (bool): If True, the model will keep the aspect ratio of the input image. Defaults to True.
+            weights_dtype (str): "float16" or "bfloat16" to store the weights of the linear and conv layers in half precision, halving the weight memory. They are upcast per layer when used. Defaults to None (float32).
     """
     if pretrained and midas_model_type != "DPT_BEiT_L_384":
         raise ValueError(f"Only DPT_BEiT_L_384 MiDaS model is supported for pretrained Zoe_N model, got: {midas_model_type}")
@@ -96,6 +97,7 @@ def ZoeD_K(pretrained=False, midas_model_type="DPT_BEiT_L_384", config_mode="inf
             min_temp (int): Lower bound for temperature of output probability distribution. Defaults to 0.0212.
             max_temp (int): Upper bound for temperature of output probability distribution. Defaults to 50.
             force_keep_ar (bool): If True, the model will keep the aspect ratio of the input image. Defaults to True.
+            weights_dtype (str): "float16" or "bfloat16" to store the weights of the linear and conv layers in half precision, halving the weight memory. They are upcast per layer when used. Defaults to None (float32).
 
     """
     if pretrained and midas_model_type != "DPT_BEiT_L_384":
@@ -139,6 +141,7 @@ def ZoeD_NK(pretrained=False, midas_model_type="DPT_BEiT_L_384", config_mode="in
             max_temp (int): Upper bound for temperature of output probability distribution. Defaults to 50.
             
             memory_efficient (bool): Whether to use memory efficient version of attractor layers. Memory efficient version is slower but is recommended incase of multiple metric heads in order save GPU memory. Defaults to True.
+            weights_dtype (str): "float16" or "bfloat16" to store the weights of the linear and conv layers in half precision, halving the weight memory. They are upcast per layer when used. Defaults to None (float32).
 
     """
     if pretrained and midas_model_type != "DPT_BEiT_L_384":
@@ -151,4 +154,33 @@ def ZoeD_NK(pretrained=False, midas_model_type="DPT_BEiT_L_384", config_mode="in
 
     config = get_config("zoedepth_nk", config_mode, pretrained_resource=pretrained_resource, **kwargs)
     model = build_model(config)
-    return model
\ No newline at end of file
+    return model
+
+
+# Zoe_N and Zoe_K heads on one core
+def ZoeD_N_K(pretrained=False, midas_model_type="DPT_BEiT_L_384", config_mode="infer", core_head="nyu", **kwargs):
+    """The metric heads of Zoe_M12_N ("nyu") and Zoe_M12_K ("kitti") on one shared MiDaS core, taken from the checkpoint of core_head. The core
+    runs once and both heads run on its features, infer returns the depth of both as the channels of one tensor (see ZoeDepthMultiHead).
+    Only the head weights of the other checkpoint are loaded. Its head was trained with its own core, compare the accuracy with ZoeD_N and
+    ZoeD_K before relying on it.
+    Args:
+        pretrained (bool): If True, returns a model with the pre-trained heads of Zoe_M12_N and Zoe_M12_K
+        midas_model_type (str): Midas model type. Should be one of the models as listed in torch.hub.list("intel-isl/MiDaS"). Default: DPT_BEiT_L_384
+        config_mode (str): Config mode. Should be one of "infer", "train" or "eval". Default: "infer"
+        core_head (str): "nyu" or "kitti", the checkpoint the core is loaded from. Default: "nyu"
+
+    Keyword Args:
+        **kwargs: Additional arguments passed to the configs of both heads, see ZoeD_N
+    """
+    if pretrained and midas_model_type != "DPT_BEiT_L_384":
+        raise ValueError(f"Only DPT_BEiT_L_384 MiDaS model is supported for pretrained Zoe_N_K model, got: {midas_model_type}")
+
+    from zoedepth.models.zoedepth import ZoeDepthMultiHead
+
+    resources = dict(nyu="url::https://github.com/isl-org/ZoeDepth/releases/download/v1.0/ZoeD_M12_N.pt",
+                     kitti="url::https://github.com/isl-org/ZoeDepth/releases/download/v1.0/ZoeD_M12_K.pt")
+    weights_dtype = kwargs.pop("weights_dtype", None)
+    configs = {name: get_config("zoedepth", config_mode, pretrained_resource=resources[name] if pretrained else None,
+                                config_version=config_version, **kwargs)
+               for name, config_version in [("nyu", None), ("kitti", "kitti")]}
+    return ZoeDepthMultiHead.build(configs, core_head=core_head, weights_dtype=weights_dtype)
@@ -0,0 +1,129 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Quantizes a ZoeDepth model to int8 for CPU inference (see zoedepth.models.quantization) and reports its latency, size and accuracy
+against the fp32 model.
+
+Calibration runs on a folder of images (through infer_pil) or on samples of a dataset (through DepthDataLoader):
+
+    python quantize.py -m zoedepth --calib_dir /path/to/images -o ZoeD_N_int8.pt
+    python quantize.py -m zoedepth --calib_dataset nyu --calib_samples 64 -d nyu -o ZoeD_N_int8.pt   # also evaluate on an eval split
+
+The saved artifact is loaded with zoedepth.models.quantization.load_quantized.
+"""
+
+import argparse
+import glob
+import io
+import itertools
+import os
+import time
+
+import torch
+from PIL import Image
+
+from zoedepth.models.builder import build_model
+from zoedepth.models.quantization import quantize_model, save_quantized
+from zoedepth.utils.config import get_config
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def calibration_images(args):
+    if args.calib_dir:
+        paths = sorted(p for p in glob.glob(os.path.join(args.calib_dir, "*")) if p.lower().endswith(IMAGE_EXTENSIONS))
+        if not paths:
+            raise ValueError(f"No images found in {args.calib_dir}")
+        for path in paths[:args.calib_samples]:
+            yield Image.open(path).convert("RGB")
+    else:
+        from zoedepth.data.data_mono import DepthDataLoader
+        config = get_config(args.model, "eval", args.calib_dataset)
+        samples = DepthDataLoader(config, 'online_eval').data
+        for sample in itertools.islice(samples, args.calib_samples):
+            yield sample['image']
+
+
+def model_size_mb(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 2**20
+
+
+@torch.no_grad()
+def latency_ms(model, args):
+    x = torch.rand(1, 3, *args.size)
+    model.infer(x)  # warm up
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        model.infer(x)
+    return (time.perf_counter() - start) / args.repeats * 1000
+
+
+def report(model, config, args):
+    res = dict(latency_ms=latency_ms(model, args), size_mb=model_size_mb(model))
+    if args.dataset:
+        import evaluate as evaluate_module
+        from zoedepth.data.data_mono import DepthDataLoader
+        # quantized kernels only run on the CPU
+        evaluate_module.DEVICE = "cpu"
+        res['metrics'] = evaluate_module.evaluate(model, DepthDataLoader(config, 'online_eval').data, config)
+    return res
+
+
+def main(args):
+    overwrite = {} if args.pretrained_resource is None else dict(pretrained_resource=args.pretrained_resource or None)
+    config = get_config(args.model, "eval", args.dataset, **overwrite) if args.dataset else get_config(args.model, "infer", **overwrite)
+    model = build_model(config).eval()
+
+    fp32 = report(model, config, args)
+    quantize_model(model, calibration_images(args), backend=args.backend)
+    int8 = report(model, config, args)
+    if args.output:
+        save_quantized(model, args.output, config)
+        print(f"Saved quantized model to {args.output}")
+
+    print(f"{'':<6}{'latency':>12}{'size':>12}")
+    for name, res in (("fp32", fp32), ("int8", int8)):
+        print(f"{name:<6}{res['latency_ms']:>10.0f}ms{res['size_mb']:>10.0f}MB")
+    print(f"int8: {int8['latency_ms'] / fp32['latency_ms']:.2f}x time, {int8['size_mb'] / fp32['size_mb']:.2f}x size")
+    if args.dataset:
+        print(f"Accuracy on {args.dataset}, int8 (delta to fp32):")
+        print({k: f"{v} ({v - fp32['metrics'][k]:+.4f})" for k, v in int8['metrics'].items()})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="zoedepth", help="Name of the model to quantize")
+    parser.add_argument("-p", "--pretrained_resource", type=str, default=None,
+                        help="Pretrained resource to load. Defaults to the resource of the model config, an empty string uses random weights")
+    calib = parser.add_mutually_exclusive_group(required=True)
+    calib.add_argument("--calib_dir", type=str, help="Folder of images to calibrate on")
+    calib.add_argument("--calib_dataset", type=str, help="Dataset to calibrate on, its online_eval split is used")
+    parser.add_argument("--calib_samples", type=int, default=32, help="Number of calibration images")
+    parser.add_argument("--backend", type=str, default=None,
+                        help="Quantized engine, e.g. fbgemm, x86 or qnnpack. Defaults to torch.backends.quantized.engine")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Path to save the quantized model to")
+    parser.add_argument("-d", "--dataset", type=str, default=None, help="Held-out eval dataset to measure the accuracy delta on")
+    parser.add_argument("-n", "--repeats", type=int, default=3, help="Number of timed inferences")
+    parser.add_argument("--size", type=int, nargs=2, default=[480, 640], metavar=("H", "W"), help="Input image size for timing")
+    main(parser.parse_args())
@@ -4,9 +4,6 @@ from zoedepth.models.builder import build_model
 from zoedepth.utils.config import get_config
 from zoedepth.utils.misc import pil_to_batched_tensor, colorize, save_raw_16bit
 
-# Fetch MiDaS repository
-torch.hub.help("intel-isl/MiDaS", "DPT_BEiT_L_384", force_reload=True)
-
 # Load the ZoeD_N model
 conf = get_config("zoedepth", "infer")
 model_zoe_n = build_model(conf)
@@ -32,9 +32,6 @@ from zoedepth.models.builder import build_model
 from zoedepth.utils.config import get_config
 from pprint import pprint
 
-
-torch.hub.help("intel-isl/MiDaS", "DPT_BEiT_L_384", force_reload=True) 
-
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 if DEVICE == "cpu":
     print("WARNING: Running on CPU. This will be slow. Check your CUDA installation.")
@@ -33,11 +33,6 @@ from zoedepth.utils.config import get_config
 from pprint import pprint
 
 
-
-# Trigger reload of MiDaS
-torch.hub.help("intel-isl/MiDaS", "DPT_BEiT_L_384", force_reload=True) 
-
-
 model = torch.hub.load(".", "ZoeD_K", source="local", pretrained=True)
 model = torch.hub.load(".", "ZoeD_NK", source="local", pretrained=True)
 model = torch.hub.load(".", "ZoeD_N", source="local", pretrained=True)
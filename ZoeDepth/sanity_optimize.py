@@ -0,0 +1,77 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Checks that model.optimize_for_inference() doesn't change the predictions and reports the speedup.
+
+    python sanity_optimize.py -m zoedepth
+    python sanity_optimize.py -m zoedepth_nk -p ""   # random weights, no download
+"""
+
+import argparse
+import time
+
+import torch
+
+from zoedepth.models.builder import build_model
+from zoedepth.utils.config import get_config
+
+
+def timed(model, x, repeats, **kwargs):
+    with torch.no_grad():
+        out = model(x, **kwargs)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(x, **kwargs)
+    return out, (time.perf_counter() - start) / max(repeats, 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="zoedepth", help="Name of the model to check")
+    parser.add_argument("-p", "--pretrained_resource", type=str, default=None,
+                        help="Pretrained resource to load. Defaults to the resource of the model config, an empty string uses random weights")
+    parser.add_argument("-n", "--repeats", type=int, default=3, help="Number of timed forward passes")
+    parser.add_argument("--atol", type=float, default=1e-4, help="Maximum allowed absolute difference of the metric depth")
+    args = parser.parse_args()
+
+    DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+    overwrite = dict(pretrained_resource=args.pretrained_resource or None) if args.pretrained_resource is not None else {}
+    torch.manual_seed(0)
+    model = build_model(get_config(args.model, "infer", **overwrite)).to(DEVICE).eval()
+    x = torch.rand(2, 3, 384, 512, device=DEVICE)
+
+    ref, t_ref = timed(model, x, args.repeats)
+    ref_probs, _ = timed(model, x, 0, return_probs=True)
+    model.optimize_for_inference()
+    out, t_opt = timed(model, x, args.repeats)
+    out_probs, _ = timed(model, x, 0, return_probs=True)
+
+    diffs = {
+        "metric_depth": (out['metric_depth'] - ref['metric_depth']).abs().max().item(),
+        "metric_depth (return_probs)": (out_probs['metric_depth'] - ref_probs['metric_depth']).abs().max().item(),
+        "probs": (out_probs['probs'] - ref_probs['probs']).abs().max().item(),
+    }
+    for k, v in diffs.items():
+        print(f"max abs diff {k}: {v:.2e}")
+    print(f"forward: {t_ref * 1000:.0f}ms -> {t_opt * 1000:.0f}ms")
+    assert all(v <= args.atol for v in diffs.values()), "optimized model differs from the original"
+    print("OK")
@@ -0,0 +1,98 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Serves a Flask app from several pre-forked worker processes that share one copy of the model weights.
+
+The app module is imported (and the model loaded) once, then the workers are forked, see zoedepth/serving/prefork.py.
+
+    python serve.py app:app --workers 4               # ZoeDepth/app.py, from ZoeDepth/
+    python ZoeDepth/serve.py app:app --workers 4      # root app.py, from the repo root
+
+With ZOE_PRETRAINED_RESOURCE=mmap::<ckpt>.safetensors the weights are shared through the page cache instead, pass --no_share_memory.
+
+The depth maps behind /depth/<key> are cached per worker, and the request for a key can land on another worker than the upload that
+computed it. With more than one worker the cache's disk tier is therefore always on, in ZOE_CACHE_DIR (or --cache_dir) or else in a
+temporary directory shared by the workers.
+
+CPU replicas (ZOE_REPLICAS, see zoedepth/serving/replicas.py) pin processes to disjoint cores and already use every core, they run in a
+single worker: --workers 1.
+"""
+
+import argparse
+import importlib
+import logging
+import os
+import sys
+import tempfile
+
+import torch.nn as nn
+
+from zoedepth.serving.cache import DepthCache
+from zoedepth.serving.prefork import PreforkServer, prepare_for_fork
+from zoedepth.serving.replicas import ReplicaExecutor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("app", type=str, help="module:attribute of the WSGI app, imported from the current directory, e.g. app:app")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("-w", "--workers", type=int, default=2)
+    parser.add_argument("-t", "--threads_per_worker", type=int, default=None, help="torch threads per worker. Defaults to cpu count // workers")
+    parser.add_argument("--no_share_memory", action="store_true", help="Don't move the models to shared memory, e.g. when they were loaded from an mmap:: checkpoint")
+    parser.add_argument("--report_interval", type=float, default=60, help="Seconds between per-worker memory reports, 0 disables them")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Disk tier of the depth cache, shared by the workers. Defaults to ZOE_CACHE_DIR, "
+                        "or a temporary directory when there is more than one worker")
+    args = parser.parse_args()
+
+    if args.workers > 1 and int(os.environ.get("ZOE_REPLICAS", 0)):
+        # every worker would start its own replicas, pinned to the same cores as those of the other workers
+        parser.error("ZOE_REPLICAS needs --workers 1, the replicas of one worker already use all cores")
+
+    logging.basicConfig(level=logging.INFO)
+    if args.cache_dir:
+        os.environ["ZOE_CACHE_DIR"] = args.cache_dir
+    elif args.workers > 1 and not os.environ.get("ZOE_CACHE_DIR"):
+        os.environ["ZOE_CACHE_DIR"] = tempfile.mkdtemp(prefix="zoedepth-cache-")
+        logging.info(f"Caching depth maps for all workers in {os.environ['ZOE_CACHE_DIR']}, set ZOE_CACHE_DIR to keep them across restarts")
+
+    sys.path.insert(0, os.getcwd())
+    module_name, attr = args.app.split(":")
+    module = importlib.import_module(module_name)
+    app = getattr(module, attr)
+    if args.workers > 1 and any(c.cache_dir is None for c in vars(module).values() if isinstance(c, DepthCache)):
+        raise ValueError(f"{module_name} has a DepthCache without a disk tier, its entries would not be visible to the other workers. "
+                         "Create it with cache_dir=os.environ.get('ZOE_CACHE_DIR')")
+
+    executors = [e for e in vars(module).values() if isinstance(e, ReplicaExecutor)]
+    if args.workers > 1 and executors:
+        raise ValueError(f"{module_name} runs inference on CPU replicas, serve it with --workers 1")
+    for executor in executors:
+        # the worker starts its own replicas after the fork, those of the parent would sit idle on the same cores
+        executor.close()
+
+    models = list({id(m): m for m in vars(module).values() if isinstance(m, nn.Module)}.values())
+    prepare_for_fork(models, share_memory=not args.no_share_memory)
+
+    server = PreforkServer(app, host=args.host, port=args.port, workers=args.workers, threads_per_worker=args.threads_per_worker,
+                           report_interval=args.report_interval)
+    server.serve_forever()
@@ -1,3 +1,4 @@
 import torch
 
+# Only needed with midas_source=hub (e.g. for MiDaS_small), the DPT MiDaS models are built from zoedepth/models/base_models/midas_dpt
 torch.hub.help("intel-isl/MiDaS", "DPT_BEiT_L_384", force_reload=True)
@@ -0,0 +1,115 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Sweeps the split of this host's cores into (replicas x threads per replica) for CPU inference, see zoedepth/serving/replicas.py.
+
+For every split, a ReplicaExecutor is started and fed requests from as many client threads as there are replicas times --concurrency,
+and the throughput and latency percentiles are reported:
+
+    python sweep_replicas.py                       # every power of two number of replicas that fits
+    python sweep_replicas.py --splits 1x8 2x4 4x2  # replicas x threads
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from zoedepth.models.builder import build_model
+from zoedepth.serving.replicas import ReplicaExecutor
+from zoedepth.utils.config import get_config
+
+
+def default_splits(n_cores):
+    splits = []
+    replicas = 1
+    while replicas <= n_cores:
+        splits.append((replicas, n_cores // replicas))
+        replicas *= 2
+    return splits
+
+
+def run_split(model, replicas, threads, images, args):
+    executor = ReplicaExecutor(model, replicas=replicas, threads_per_replica=threads, policy=args.policy,
+                               with_flip_aug=not args.no_flip_aug)
+    try:
+        # warm up every replica
+        for f in [executor.submit(images[0]) for _ in range(replicas)]:
+            f.result()
+
+        latencies = []
+
+        def request(img):
+            t = time.perf_counter()
+            executor.infer_pil(img)
+            latencies.append(time.perf_counter() - t)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(replicas * args.concurrency) as clients:
+            list(clients.map(request, images))
+        elapsed = time.perf_counter() - start
+    finally:
+        executor.close()
+
+    latencies = np.array(latencies) * 1000
+    return dict(throughput=len(images) / elapsed, p50=np.percentile(latencies, 50), p99=np.percentile(latencies, 99))
+
+
+def main(args):
+    overwrite = dict(pretrained_resource=args.pretrained_resource or None) if args.pretrained_resource is not None else {}
+    conf = get_config(args.model, "infer", **overwrite)
+    model = build_model(conf).eval()
+
+    n_cores = len(os.sched_getaffinity(0))
+    splits = [tuple(int(v) for v in s.split("x")) for s in args.splits] if args.splits else default_splits(n_cores)
+
+    h, w = args.size
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 255, (h, w, 3), dtype=np.uint8)) for _ in range(args.requests)]
+
+    print(f"{n_cores} cores, {args.requests} requests of {w}x{h}, {args.concurrency} in flight per replica")
+    print(f"{'replicas':>8} {'threads':>8} {'img/s':>8} {'p50 ms':>9} {'p99 ms':>9}")
+    for replicas, threads in splits:
+        if replicas * threads > n_cores:
+            print(f"{replicas:>8} {threads:>8}  skipped, needs {replicas * threads} cores")
+            continue
+        r = run_split(model, replicas, threads, images, args)
+        print(f"{replicas:>8} {threads:>8} {r['throughput']:>8.2f} {r['p50']:>9.1f} {r['p99']:>9.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default="zoedepth", help="Name of the model to benchmark")
+    parser.add_argument("-p", "--pretrained_resource", type=str, default=None,
+                        help="Pretrained resource to load. Defaults to the resource of the model config, an empty string skips loading weights")
+    parser.add_argument("--splits", type=str, nargs="+", default=None, help="replicas x threads splits to run, e.g. 2x4. Defaults to every power of two number of replicas")
+    parser.add_argument("--policy", type=str, default="least_load", choices=["least_load", "round_robin"])
+    parser.add_argument("-n", "--requests", type=int, default=64, help="Number of timed requests per split")
+    parser.add_argument("-c", "--concurrency", type=int, default=2, help="Requests in flight per replica")
+    parser.add_argument("--size", type=int, nargs=2, default=[384, 512], metavar=("H", "W"), help="Input image size")
+    parser.add_argument("--no_flip_aug", action="store_true", help="Disable flip augmentation")
+    torch.set_grad_enabled(False)
+    main(parser.parse_args())
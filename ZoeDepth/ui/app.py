@@ -22,9 +22,15 @@
 
 # File author: Shariq Farooq Bhat
 
+import os
+
 import gradio as gr
 import torch
 
+from zoedepth.models.builder import build_model
+from zoedepth.serving.cache import DepthCache, CachedInference, inference_settings
+from zoedepth.utils.config import get_config
+
 from .gradio_depth_pred import create_demo as create_depth_pred_demo
 from .gradio_im_to_3d import create_demo as create_im_to_3d_demo
 from .gradio_pano_to_3d import create_demo as create_pano_to_3d_demo
@@ -43,7 +49,12 @@ css = """
     
 """
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
-model = torch.hub.load('isl-org/ZoeDepth', "ZoeD_N", pretrained=True).to(DEVICE).eval()
+conf = get_config("zoedepth", "infer")
+model = build_model(conf).to(DEVICE).eval()
+# predict_depth helpers only use infer_pil, so the cached wrapper can be passed in place of the model
+cache = DepthCache(max_bytes=int(os.environ.get("ZOE_CACHE_MB", 256)) * 2**20, cache_dir=os.environ.get("ZOE_CACHE_DIR"))
+model = CachedInference(model, cache, model_id=f"{conf.model}_{conf.version_name}", checkpoint=conf.pretrained_resource,
+                        settings=inference_settings(model, conf))
 
 title = "# ZoeDepth"
 description = """Official demo for **ZoeDepth: Zero-shot Transfer by Combining Relative and Metric Depth**.
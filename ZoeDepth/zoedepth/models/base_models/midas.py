@@ -27,6 +27,10 @@ import torch.nn as nn
 import numpy as np
 from torchvision.transforms import Normalize
 
+from .midas_dpt.backbones import ActivationBank, collect_activations, get_activation
+from .midas_dpt.dpt_depth import MIDAS_MODELS, build_midas
+from ..layers.fusion import fuse_conv_bn
+
 
 def denormalize(x):
     """Reverses the imagenet normalization applied to the input.
@@ -41,12 +45,6 @@ def denormalize(x):
     std = torch.Tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1).to(x.device)
     return x * std + mean
 
-def get_activation(name, bank):
-    def hook(model, input, output):
-        bank[name] = output
-    return hook
-
-
 class Resize(object):
     """Resize sample to given size (width, height).
     """
@@ -182,8 +180,8 @@ class PrepForMidas(object):
         self.resizer = Resize(net_w, net_h, keep_aspect_ratio=keep_aspect_ratio, ensure_multiple_of=32, resize_method=resize_mode) \
             if do_resize else nn.Identity()
 
-    def __call__(self, x):
-        return self.normalization(self.resizer(x))
+    def __call__(self, x, do_resize=True):
+        return self.normalization(self.resizer(x) if do_resize else x)
 
 
 class MidasCore(nn.Module):
@@ -203,7 +201,8 @@ class MidasCore(nn.Module):
         super().__init__()
         self.core = midas
         self.output_channels = None
-        self.core_out = {}
+        # outputs of the hooked layers of torch hub models, per thread and only for the duration of a forward pass
+        self.core_out = ActivationBank()
         self.trainable = trainable
         self.fetch_features = fetch_features
         # midas.scratch.output_conv = nn.Identity()
@@ -228,9 +227,14 @@ class MidasCore(nn.Module):
             self.freeze()
         return self
 
+    @property
+    def explicit_features(self):
+        """Whether the MiDaS model returns its features from forward_features (the vendored DPT models) rather than through hooks (torch hub)"""
+        return hasattr(self.core, "forward_features")
+
     def set_fetch_features(self, fetch_features):
         self.fetch_features = fetch_features
-        if fetch_features:
+        if fetch_features and not self.explicit_features:
             if len(self.handles) == 0:
                 self.attach_hooks(self.core)
         else:
@@ -255,26 +259,42 @@ class MidasCore(nn.Module):
                 m.eval()
         return self
 
-    def forward(self, x, denorm=False, return_rel_depth=False):
+    def forward(self, x, denorm=False, return_rel_depth=False, do_resize=True):
         with torch.no_grad():
             if denorm:
                 x = denormalize(x)
-            x = self.prep(x)
+            # without do_resize, x is expected at the network resolution already (a multiple of 32)
+            x = self.prep(x, do_resize=do_resize)
             # print("Shape after prep: ", x.shape)
 
         with torch.set_grad_enabled(self.trainable):
 
             # print("Input size to Midascore", x.shape)
-            rel_depth = self.core(x)
-            # print("Output from midas shape", rel_depth.shape)
-            if not self.fetch_features:
-                return rel_depth
-        out = [self.core_out[k] for k in self.layer_names]
+            if self.fetch_features and self.explicit_features:
+                # features are returned by the forward pass itself instead of being collected by hooks, which also makes it traceable
+                rel_depth, features = self.core.forward_features(x)
+            elif not self.fetch_features:
+                return self.core(x)
+            else:
+                with collect_activations(self.core_out) as features:
+                    rel_depth = self.core(x)
+        out = [features[k] for k in self.layer_names]
 
         if return_rel_depth:
             return rel_depth, out
         return out
 
+    def optimize_for_inference(self):
+        """Folds the BatchNorm layers of the MiDaS decoder (scratch) into the preceding convs. The result is for inference only."""
+        for m in self.core.scratch.modules():
+            # ResidualConvUnit_custom with bn, of the vendored or the torch hub MiDaS code
+            if getattr(m, "bn", False) is True and hasattr(m, "bn1"):
+                m.conv1 = fuse_conv_bn(m.conv1, m.bn1.eval())
+                m.conv2 = fuse_conv_bn(m.conv2, m.bn2.eval())
+                del m.bn1, m.bn2
+                m.bn = False
+        return self
+
     def get_rel_pos_params(self):
         for name, p in self.core.pretrained.named_parameters():
             if "relative_position" in name:
@@ -330,7 +350,14 @@ class MidasCore(nn.Module):
         self.output_channels = MIDAS_SETTINGS[model_type]
 
     @staticmethod
-    def build(midas_model_type="DPT_BEiT_L_384", train_midas=False, use_pretrained_midas=True, fetch_features=False, freeze_bn=True, force_keep_ar=False, force_reload=False, **kwargs):
+    def build(midas_model_type="DPT_BEiT_L_384", train_midas=False, use_pretrained_midas=True, fetch_features=False, freeze_bn=True, force_keep_ar=False, force_reload=False,
+              midas_source="local", **kwargs):
+        """Builds the MiDaS model and wraps it in a MidasCore.
+
+        midas_source selects where the MiDaS code comes from: "local" (default) builds it from the vendored copy in midas_dpt and needs no network
+        unless pretrained MiDaS weights are requested and not cached yet. "hub" loads it with torch.hub.load("intel-isl/MiDaS", ...), which
+        fetches the MiDaS repo (again if force_reload) and is required for model types that are not vendored (MiDaS_small).
+        """
         if midas_model_type not in MIDAS_SETTINGS:
             raise ValueError(
                 f"Invalid model type: {midas_model_type}. Must be one of {list(MIDAS_SETTINGS.keys())}")
@@ -338,8 +365,16 @@ class MidasCore(nn.Module):
             kwargs = MidasCore.parse_img_size(kwargs)
         img_size = kwargs.pop("img_size", [384, 384])
         print("img_size", img_size)
-        midas = torch.hub.load("intel-isl/MiDaS", midas_model_type,
-                               pretrained=use_pretrained_midas, force_reload=force_reload)
+        if midas_source == "local":
+            if midas_model_type not in MIDAS_MODELS:
+                raise ValueError(
+                    f"MiDaS model type {midas_model_type} is not available locally, use midas_source='hub'. Local model types are {list(MIDAS_MODELS.keys())}")
+            midas = build_midas(midas_model_type, pretrained=use_pretrained_midas)
+        elif midas_source == "hub":
+            midas = torch.hub.load("intel-isl/MiDaS", midas_model_type,
+                                   pretrained=use_pretrained_midas, force_reload=force_reload)
+        else:
+            raise ValueError(f"Invalid midas_source: {midas_source}. Must be 'local' or 'hub'")
         kwargs.update({'keep_aspect_ratio': force_keep_ar})
         midas_core = MidasCore(midas, trainable=train_midas, fetch_features=fetch_features,
                                freeze_bn=freeze_bn, img_size=img_size, **kwargs)
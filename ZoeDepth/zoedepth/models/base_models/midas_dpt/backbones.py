@@ -0,0 +1,475 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Transformer backbones of the MiDaS v3.1 DPT models, adapted from https://github.com/isl-org/MiDaS/tree/master/midas/backbones (MIT License).
+
+The timm models are patched the same way as in MiDaS so that they accept arbitrary input resolutions. Unlike MiDaS, intermediate activations
+are returned by every call (see forward_activations) instead of being stored in a module level dict shared by every model in the process,
+so that concurrent threads can share a model and no activations are kept alive between calls.
+"""
+
+import math
+import threading
+import types
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+import timm
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from timm.models.beit import gen_relative_position_index
+
+
+class Slice(nn.Module):
+    def __init__(self, start_index=1):
+        super().__init__()
+        self.start_index = start_index
+
+    def forward(self, x):
+        return x[:, self.start_index:]
+
+
+class AddReadout(nn.Module):
+    def __init__(self, start_index=1):
+        super().__init__()
+        self.start_index = start_index
+
+    def forward(self, x):
+        if self.start_index == 2:
+            readout = (x[:, 0] + x[:, 1]) / 2
+        else:
+            readout = x[:, 0]
+        return x[:, self.start_index:] + readout.unsqueeze(1)
+
+
+class ProjectReadout(nn.Module):
+    def __init__(self, in_features, start_index=1):
+        super().__init__()
+        self.start_index = start_index
+        self.project = nn.Sequential(nn.Linear(2 * in_features, in_features), nn.GELU())
+
+    def forward(self, x):
+        readout = x[:, 0].unsqueeze(1).expand_as(x[:, self.start_index:])
+        features = torch.cat((x[:, self.start_index:], readout), -1)
+        return self.project(features)
+
+
+class Transpose(nn.Module):
+    def __init__(self, dim0, dim1):
+        super().__init__()
+        self.dim0 = dim0
+        self.dim1 = dim1
+
+    def forward(self, x):
+        return x.transpose(self.dim0, self.dim1)
+
+
+class ActivationBank(threading.local):
+    """Outputs of hooked layers. Every thread collects them into its own dict, which only exists during a forward pass, see collect_activations"""
+
+    def __init__(self):
+        self.current = None
+
+
+def get_activation(name, bank):
+    def hook(model, input, output):
+        if bank.current is not None:
+            bank.current[name] = output
+    return hook
+
+
+@contextmanager
+def collect_activations(bank):
+    """Context manager that yields a dict into which the hooks of bank store the outputs of their layers for this thread"""
+    previous, bank.current = bank.current, {}
+    try:
+        yield bank.current
+    finally:
+        bank.current = previous
+
+
+def get_readout_oper(vit_features, features, use_readout, start_index=1):
+    if use_readout == "ignore":
+        return [Slice(start_index)] * len(features)
+    elif use_readout == "add":
+        return [AddReadout(start_index)] * len(features)
+    elif use_readout == "project":
+        return [ProjectReadout(vit_features, start_index) for _ in features]
+    raise ValueError(f"Invalid readout operation {use_readout}, must be one of 'ignore', 'add' or 'project'")
+
+
+def forward_activations(pretrained, x, function_name="forward_features"):
+    """Runs the timm model of a backbone and returns its intermediate activations "1" to "4" of this call.
+
+    The patched forward functions of BEiT and ViT return the outputs of the blocks in model.block_outputs themselves. Layers of timm code
+    (the Swin blocks, the ResNet stages of the hybrid ViT) are collected by hooks into pretrained.activations, see ActivationBank.
+    """
+    if not hasattr(pretrained, "activations"):
+        return getattr(pretrained.model, function_name)(x)[1]
+    with collect_activations(pretrained.activations) as activations:
+        out = getattr(pretrained.model, function_name)(x)
+    if isinstance(out, tuple):
+        activations.update(out[1])
+    return activations
+
+
+def forward_default(pretrained, x, function_name="forward_features"):
+    activations = forward_activations(pretrained, x, function_name)
+    return tuple(getattr(pretrained, f"act_postprocess{i}")(activations[str(i)]) for i in range(1, 5))
+
+
+def forward_adapted_unflatten(pretrained, x, function_name="forward_features"):
+    b, c, h, w = x.shape
+    activations = forward_activations(pretrained, x, function_name)
+
+    # the patch grid, as sizes rather than an nn.Unflatten so that it stays traceable
+    grid = (h // pretrained.model.patch_size[1], w // pretrained.model.patch_size[0])
+    layers = []
+    for i in range(1, 5):
+        postprocess = getattr(pretrained, f"act_postprocess{i}")
+        layer = postprocess[0:2](activations[str(i)])
+        if layer.ndim == 3:
+            layer = layer.unflatten(2, grid)
+        layers.append(postprocess[3:](layer))
+    return tuple(layers)
+
+
+def make_backbone_default(model, features=[96, 192, 384, 768], size=[384, 384], hooks=[2, 5, 8, 11], vit_features=768, use_readout="ignore",
+                          start_index=1, start_index_readout=1):
+    pretrained = nn.Module()
+    pretrained.model = model
+    # returned by the patched forward_features / forward_flex
+    pretrained.model.block_outputs = {hook: str(i + 1) for i, hook in enumerate(hooks)}
+
+    readout_oper = get_readout_oper(vit_features, features, use_readout, start_index_readout)
+    grid = torch.Size([size[0] // 16, size[1] // 16])
+
+    pretrained.act_postprocess1 = nn.Sequential(
+        readout_oper[0], Transpose(1, 2), nn.Unflatten(2, grid),
+        nn.Conv2d(vit_features, features[0], kernel_size=1, stride=1, padding=0),
+        nn.ConvTranspose2d(features[0], features[0], kernel_size=4, stride=4, padding=0, bias=True, dilation=1, groups=1),
+    )
+    pretrained.act_postprocess2 = nn.Sequential(
+        readout_oper[1], Transpose(1, 2), nn.Unflatten(2, grid),
+        nn.Conv2d(vit_features, features[1], kernel_size=1, stride=1, padding=0),
+        nn.ConvTranspose2d(features[1], features[1], kernel_size=2, stride=2, padding=0, bias=True, dilation=1, groups=1),
+    )
+    pretrained.act_postprocess3 = nn.Sequential(
+        readout_oper[2], Transpose(1, 2), nn.Unflatten(2, grid),
+        nn.Conv2d(vit_features, features[2], kernel_size=1, stride=1, padding=0),
+    )
+    pretrained.act_postprocess4 = nn.Sequential(
+        readout_oper[3], Transpose(1, 2), nn.Unflatten(2, grid),
+        nn.Conv2d(vit_features, features[3], kernel_size=1, stride=1, padding=0),
+        nn.Conv2d(features[3], features[3], kernel_size=3, stride=2, padding=1),
+    )
+
+    pretrained.model.start_index = start_index
+    pretrained.model.patch_size = [16, 16]
+    return pretrained
+
+
+# ---------------------------------------------------------------- BEiT ----------------------------------------------------------------
+
+def forward_beit(pretrained, x):
+    return forward_adapted_unflatten(pretrained, x, "forward_features")
+
+
+def beit_patch_embed_forward(self, x):
+    """timm PatchEmbed.forward without the input size check"""
+    x = self.proj(x)
+    if self.flatten:
+        x = x.flatten(2).transpose(1, 2)
+    x = self.norm(x)
+    return x
+
+
+def beit_get_rel_pos_bias(self, window_size):
+    """timm beit Attention._get_rel_pos_bias for arbitrary window sizes. The relative position bias table is bilinearly resized to window_size."""
+    old_height = 2 * self.window_size[0] - 1
+    old_width = 2 * self.window_size[1] - 1
+    new_height = 2 * window_size[0] - 1
+    new_width = 2 * window_size[1] - 1
+
+    table = self.relative_position_bias_table
+    num_distance = self.num_relative_distance
+    if (new_height, new_width) != (old_height, old_width):
+        sub_table = table[:num_distance - 3].reshape(1, old_width, old_height, -1).permute(0, 3, 1, 2)
+        sub_table = F.interpolate(sub_table, size=(new_height, new_width), mode="bilinear")
+        sub_table = sub_table.permute(0, 2, 3, 1).reshape(new_height * new_width, -1)
+        table = torch.cat([sub_table, table[num_distance - 3:]])
+
+    key = f"{window_size[1]},{window_size[0]}"
+    index = self.relative_position_indices.get(key)
+    if index is None or index.device != table.device:
+        index = gen_relative_position_index(window_size).to(table.device)
+        self.relative_position_indices[key] = index
+
+    n = window_size[0] * window_size[1] + 1
+    relative_position_bias = table[index.view(-1)].view(n, n, -1)  # Wh*Ww,Wh*Ww,nH
+    relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+    return relative_position_bias.unsqueeze(0)
+
+
+def beit_attention_forward(self, x, resolution, shared_rel_pos_bias: Optional[torch.Tensor] = None):
+    """timm beit Attention.forward for arbitrary window sizes"""
+    B, N, C = x.shape
+
+    # bias is added after the projection (instead of F.linear with the concatenated bias) so that qkv stays a plain nn.Linear call
+    qkv = self.qkv(x)
+    if self.q_bias is not None:
+        qkv = qkv + torch.cat((self.q_bias, self.k_bias, self.v_bias))
+    qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv.unbind(0)
+
+    q = q * self.scale
+    attn = q @ k.transpose(-2, -1)
+
+    if self.relative_position_bias_table is not None:
+        window_size = (resolution[0] // 16, resolution[1] // 16)
+        attn = attn + self._get_rel_pos_bias(window_size)
+    if shared_rel_pos_bias is not None:
+        attn = attn + shared_rel_pos_bias
+
+    attn = attn.softmax(dim=-1)
+    attn = self.attn_drop(attn)
+
+    x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
+    x = self.proj(x)
+    x = self.proj_drop(x)
+    return x
+
+
+def beit_block_forward(self, x, resolution, shared_rel_pos_bias: Optional[torch.Tensor] = None):
+    """timm beit Block.forward that passes the input resolution on to the attention"""
+    # timm >= 0.9 has separate drop_path1 / drop_path2
+    if hasattr(self, "drop_path1"):
+        drop_path1, drop_path2 = self.drop_path1, self.drop_path2
+    else:
+        drop_path1 = drop_path2 = self.drop_path
+    if self.gamma_1 is None:
+        x = x + drop_path1(self.attn(self.norm1(x), resolution, shared_rel_pos_bias=shared_rel_pos_bias))
+        x = x + drop_path2(self.mlp(self.norm2(x)))
+    else:
+        x = x + drop_path1(self.gamma_1 * self.attn(self.norm1(x), resolution, shared_rel_pos_bias=shared_rel_pos_bias))
+        x = x + drop_path2(self.gamma_2 * self.mlp(self.norm2(x)))
+    return x
+
+
+def beit_forward_features(self, x):
+    """timm Beit.forward_features for arbitrary input resolutions. Also returns the outputs of the blocks in self.block_outputs, by name."""
+    resolution = x.shape[2:]
+
+    x = self.patch_embed(x)
+    x = torch.cat((self.cls_token.expand(x.shape[0], -1, -1), x), dim=1)
+    if self.pos_embed is not None:
+        x = x + self.pos_embed
+    x = self.pos_drop(x)
+
+    rel_pos_bias = self.rel_pos_bias() if self.rel_pos_bias is not None else None
+    activations = {}
+    for i, blk in enumerate(self.blocks):
+        x = blk(x, resolution, shared_rel_pos_bias=rel_pos_bias)
+        if i in self.block_outputs:
+            activations[self.block_outputs[i]] = x
+    x = self.norm(x)
+    return x, activations
+
+
+def _make_beit_backbone(model, features=[96, 192, 384, 768], size=[384, 384], hooks=[0, 4, 8, 11], vit_features=768, use_readout="ignore",
+                        start_index=1, start_index_readout=1):
+    backbone = make_backbone_default(model, features, size, hooks, vit_features, use_readout, start_index, start_index_readout)
+
+    backbone.model.patch_embed.forward = types.MethodType(beit_patch_embed_forward, backbone.model.patch_embed)
+    backbone.model.forward_features = types.MethodType(beit_forward_features, backbone.model)
+
+    for block in backbone.model.blocks:
+        attn = block.attn
+        attn._get_rel_pos_bias = types.MethodType(beit_get_rel_pos_bias, attn)
+        attn.forward = types.MethodType(beit_attention_forward, attn)
+        attn.relative_position_indices = {}
+        block.forward = types.MethodType(beit_block_forward, block)
+
+    return backbone
+
+
+def _make_pretrained_beitl16_512(pretrained, use_readout="ignore", hooks=None):
+    model = timm.create_model("beit_large_patch16_512", pretrained=pretrained)
+    hooks = [5, 11, 17, 23] if hooks is None else hooks
+    return _make_beit_backbone(model, features=[256, 512, 1024, 1024], size=[512, 512], hooks=hooks, vit_features=1024, use_readout=use_readout)
+
+
+def _make_pretrained_beitl16_384(pretrained, use_readout="ignore", hooks=None):
+    model = timm.create_model("beit_large_patch16_384", pretrained=pretrained)
+    hooks = [5, 11, 17, 23] if hooks is None else hooks
+    return _make_beit_backbone(model, features=[256, 512, 1024, 1024], hooks=hooks, vit_features=1024, use_readout=use_readout)
+
+
+def _make_pretrained_beitb16_384(pretrained, use_readout="ignore", hooks=None):
+    model = timm.create_model("beit_base_patch16_384", pretrained=pretrained)
+    hooks = [2, 5, 8, 11] if hooks is None else hooks
+    return _make_beit_backbone(model, features=[96, 192, 384, 768], hooks=hooks, use_readout=use_readout)
+
+
+# --------------------------------------------------------------- SwinV2 ---------------------------------------------------------------
+
+def forward_swin(pretrained, x):
+    return forward_default(pretrained, x)
+
+
+def _make_swin_backbone(model, hooks=[1, 1, 17, 1], patch_grid=[96, 96]):
+    pretrained = nn.Module()
+    pretrained.model = model
+    pretrained.activations = ActivationBank()
+    for i, hook in enumerate(hooks):
+        pretrained.model.layers[i].blocks[hook].register_forward_hook(get_activation(str(i + 1), pretrained.activations))
+
+    patch_grid = np.array(getattr(model, "patch_grid", patch_grid), dtype=int)
+    pretrained.act_postprocess1 = nn.Sequential(Transpose(1, 2), nn.Unflatten(2, torch.Size(patch_grid.tolist())))
+    pretrained.act_postprocess2 = nn.Sequential(Transpose(1, 2), nn.Unflatten(2, torch.Size((patch_grid // 2).tolist())))
+    pretrained.act_postprocess3 = nn.Sequential(Transpose(1, 2), nn.Unflatten(2, torch.Size((patch_grid // 4).tolist())))
+    pretrained.act_postprocess4 = nn.Sequential(Transpose(1, 2), nn.Unflatten(2, torch.Size((patch_grid // 8).tolist())))
+    return pretrained
+
+
+def _make_pretrained_swin2l24_384(pretrained, hooks=None):
+    model = timm.create_model("swinv2_large_window12to24_192to384_22kft1k", pretrained=pretrained)
+    hooks = [1, 1, 17, 1] if hooks is None else hooks
+    return _make_swin_backbone(model, hooks=hooks)
+
+
+def _make_pretrained_swin2b24_384(pretrained, hooks=None):
+    model = timm.create_model("swinv2_base_window12to24_192to384_22kft1k", pretrained=pretrained)
+    hooks = [1, 1, 17, 1] if hooks is None else hooks
+    return _make_swin_backbone(model, hooks=hooks)
+
+
+def _make_pretrained_swin2t16_256(pretrained, hooks=None):
+    model = timm.create_model("swinv2_tiny_window16_256", pretrained=pretrained)
+    hooks = [1, 1, 5, 1] if hooks is None else hooks
+    return _make_swin_backbone(model, hooks=hooks, patch_grid=[64, 64])
+
+
+# ----------------------------------------------------------------- ViT ----------------------------------------------------------------
+
+def forward_vit(pretrained, x):
+    return forward_adapted_unflatten(pretrained, x, "forward_flex")
+
+
+def vit_resize_pos_embed(self, posemb, gs_h, gs_w):
+    posemb_tok, posemb_grid = posemb[:, :self.start_index], posemb[0, self.start_index:]
+    gs_old = int(math.sqrt(len(posemb_grid)))
+
+    posemb_grid = posemb_grid.reshape(1, gs_old, gs_old, -1).permute(0, 3, 1, 2)
+    posemb_grid = F.interpolate(posemb_grid, size=(gs_h, gs_w), mode="bilinear")
+    posemb_grid = posemb_grid.permute(0, 2, 3, 1).reshape(1, gs_h * gs_w, -1)
+    return torch.cat([posemb_tok, posemb_grid], dim=1)
+
+
+def vit_forward_flex(self, x):
+    """timm VisionTransformer.forward_features with the position embedding resized to the input resolution. Also returns the outputs of the
+    blocks in self.block_outputs, by name."""
+    B, c, h, w = x.shape
+    pos_embed = self._resize_pos_embed(self.pos_embed, h // self.patch_size[1], w // self.patch_size[0])
+
+    if hasattr(self.patch_embed, "backbone"):
+        x = self.patch_embed.backbone(x)
+        if isinstance(x, (list, tuple)):
+            x = x[-1]  # last feature if backbone outputs list/tuple of features
+    x = self.patch_embed.proj(x).flatten(2).transpose(1, 2)
+
+    no_embed_class = getattr(self, "no_embed_class", False)
+    if getattr(self, "dist_token", None) is not None:
+        x = torch.cat((self.cls_token.expand(B, -1, -1), self.dist_token.expand(B, -1, -1), x), dim=1)
+    else:
+        if no_embed_class:
+            x = x + pos_embed
+        x = torch.cat((self.cls_token.expand(B, -1, -1), x), dim=1)
+
+    if not no_embed_class:
+        x = x + pos_embed
+    x = self.pos_drop(x)
+
+    activations = {}
+    for i, blk in enumerate(self.blocks):
+        x = blk(x)
+        if i in self.block_outputs:
+            activations[self.block_outputs[i]] = x
+    x = self.norm(x)
+    return x, activations
+
+
+def _make_vit_b16_backbone(model, features=[96, 192, 384, 768], size=[384, 384], hooks=[2, 5, 8, 11], vit_features=768, use_readout="ignore",
+                           start_index=1, start_index_readout=1):
+    pretrained = make_backbone_default(model, features, size, hooks, vit_features, use_readout, start_index, start_index_readout)
+    pretrained.model.forward_flex = types.MethodType(vit_forward_flex, pretrained.model)
+    pretrained.model._resize_pos_embed = types.MethodType(vit_resize_pos_embed, pretrained.model)
+    return pretrained
+
+
+def _make_pretrained_vitl16_384(pretrained, use_readout="ignore", hooks=None):
+    model = timm.create_model("vit_large_patch16_384", pretrained=pretrained)
+    hooks = [5, 11, 17, 23] if hooks is None else hooks
+    return _make_vit_b16_backbone(model, features=[256, 512, 1024, 1024], hooks=hooks, vit_features=1024, use_readout=use_readout)
+
+
+def _make_vit_b_rn50_backbone(model, features=[256, 512, 768, 768], size=[384, 384], hooks=[0, 1, 8, 11], vit_features=768, patch_size=[16, 16],
+                              number_stages=2, use_vit_only=False, use_readout="ignore", start_index=1):
+    pretrained = nn.Module()
+    pretrained.model = model
+    pretrained.activations = ActivationBank()
+
+    used_number_stages = 0 if use_vit_only else number_stages
+    for s in range(used_number_stages):
+        pretrained.model.patch_embed.backbone.stages[s].register_forward_hook(get_activation(str(s + 1), pretrained.activations))
+    pretrained.model.block_outputs = {hooks[s]: str(s + 1) for s in range(used_number_stages, 4)}
+
+    readout_oper = get_readout_oper(vit_features, features, use_readout, start_index)
+
+    for s in range(used_number_stages):
+        setattr(pretrained, f"act_postprocess{s + 1}", nn.Sequential(nn.Identity(), nn.Identity(), nn.Identity()))
+    for s in range(used_number_stages, 4):
+        layers = [
+            readout_oper[s], Transpose(1, 2), nn.Unflatten(2, torch.Size([size[0] // 16, size[1] // 16])),
+            nn.Conv2d(vit_features, features[s], kernel_size=1, stride=1, padding=0),
+        ]
+        if s < number_stages:
+            layers.append(nn.ConvTranspose2d(features[s], features[s], kernel_size=4 // (2 ** s), stride=4 // (2 ** s), padding=0, bias=True,
+                                             dilation=1, groups=1))
+        elif s > number_stages:
+            layers.append(nn.Conv2d(features[3], features[3], kernel_size=3, stride=2, padding=1))
+        setattr(pretrained, f"act_postprocess{s + 1}", nn.Sequential(*layers))
+
+    pretrained.model.start_index = start_index
+    pretrained.model.patch_size = patch_size
+    pretrained.model.forward_flex = types.MethodType(vit_forward_flex, pretrained.model)
+    pretrained.model._resize_pos_embed = types.MethodType(vit_resize_pos_embed, pretrained.model)
+    return pretrained
+
+
+def _make_pretrained_vitb_rn50_384(pretrained, use_readout="ignore", hooks=None, use_vit_only=False):
+    model = timm.create_model("vit_base_resnet50_384", pretrained=pretrained)
+    hooks = [0, 1, 8, 11] if hooks is None else hooks
+    return _make_vit_b_rn50_backbone(model, features=[256, 512, 768, 768], size=[384, 384], hooks=hooks, use_vit_only=use_vit_only,
+                                     use_readout=use_readout)
@@ -0,0 +1,178 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""MiDaS v3.1 DPT depth models, adapted from https://github.com/isl-org/MiDaS/blob/master/midas/dpt_depth.py (MIT License).
+
+Builds the same networks as torch.hub.load("intel-isl/MiDaS", model_type) from code in this package, so no MiDaS repo download is needed.
+"""
+
+import torch
+import torch.nn as nn
+
+from .backbones import (_make_pretrained_beitb16_384, _make_pretrained_beitl16_384, _make_pretrained_beitl16_512,
+                        _make_pretrained_swin2b24_384, _make_pretrained_swin2l24_384, _make_pretrained_swin2t16_256,
+                        _make_pretrained_vitb_rn50_384, _make_pretrained_vitl16_384, forward_beit, forward_swin, forward_vit)
+from .blocks import Interpolate, _make_fusion_block, _make_scratch
+
+# backbone name -> (backbone constructor, hooks, backbone output channels)
+# For the Swin 2 Transformers, the hierarchical architecture prevents setting the hooks freely, allowed ranges are [0, 1], [0, 1], [0, 17 (5 for T)], [0, 1]
+BACKBONES = {
+    "beitl16_512": (_make_pretrained_beitl16_512, [5, 11, 17, 23], [256, 512, 1024, 1024]),
+    "beitl16_384": (_make_pretrained_beitl16_384, [5, 11, 17, 23], [256, 512, 1024, 1024]),
+    "beitb16_384": (_make_pretrained_beitb16_384, [2, 5, 8, 11], [96, 192, 384, 768]),
+    "swin2l24_384": (_make_pretrained_swin2l24_384, [1, 1, 17, 1], [192, 384, 768, 1536]),
+    "swin2b24_384": (_make_pretrained_swin2b24_384, [1, 1, 17, 1], [128, 256, 512, 1024]),
+    "swin2t16_256": (_make_pretrained_swin2t16_256, [1, 1, 5, 1], [96, 192, 384, 768]),
+    "vitl16_384": (_make_pretrained_vitl16_384, [5, 11, 17, 23], [256, 512, 1024, 1024]),
+    "vitb_rn50_384": (_make_pretrained_vitb_rn50_384, [0, 1, 8, 11], [256, 512, 768, 768]),
+}
+
+# MiDaS hub model type -> (backbone, checkpoint url)
+MIDAS_MODELS = {
+    "DPT_BEiT_L_512": ("beitl16_512", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_beit_large_512.pt"),
+    "DPT_BEiT_L_384": ("beitl16_384", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_beit_large_384.pt"),
+    "DPT_BEiT_B_384": ("beitb16_384", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_beit_base_384.pt"),
+    "DPT_SwinV2_L_384": ("swin2l24_384", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_swin2_large_384.pt"),
+    "DPT_SwinV2_B_384": ("swin2b24_384", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_swin2_base_384.pt"),
+    "DPT_SwinV2_T_256": ("swin2t16_256", "https://github.com/isl-org/MiDaS/releases/download/v3_1/dpt_swin2_tiny_256.pt"),
+    "DPT_Large": ("vitl16_384", "https://github.com/isl-org/MiDaS/releases/download/v3/dpt_large_384.pt"),
+    "DPT_Hybrid": ("vitb_rn50_384", "https://github.com/isl-org/MiDaS/releases/download/v3/dpt_hybrid_384.pt"),
+}
+
+
+class DPT(nn.Module):
+    def __init__(self, head, features=256, backbone="vitb_rn50_384", readout="project", use_bn=False, **kwargs):
+        """Dense Prediction Transformer: transformer encoder (self.pretrained) + convolutional reassemble and fusion decoder (self.scratch)
+
+        Args:
+            head (nn.Module): Output head, applied to the output of the last fusion block
+            features (int, optional): Number of decoder features. Defaults to 256.
+            backbone (str, optional): Backbone name, one of BACKBONES. Defaults to "vitb_rn50_384".
+            readout (str, optional): Readout token handling of ViT and BEiT backbones, "ignore", "add" or "project". Defaults to "project".
+            use_bn (bool, optional): Use BatchNorm in the fusion blocks. Defaults to False.
+        """
+        super().__init__()
+        if backbone not in BACKBONES:
+            raise ValueError(f"Invalid backbone: {backbone}. Must be one of {list(BACKBONES.keys())}")
+        make_backbone, hooks, in_shape = BACKBONES[backbone]
+
+        if "swin" in backbone:
+            self.pretrained = make_backbone(False, hooks=hooks)
+            self.forward_transformer = forward_swin
+        else:
+            self.pretrained = make_backbone(False, hooks=hooks, use_readout=readout)
+            self.forward_transformer = forward_beit if "beit" in backbone else forward_vit
+
+        self.scratch = _make_scratch(in_shape, features, groups=1, expand=False)
+        self.scratch.stem_transpose = None
+        self.scratch.refinenet1 = _make_fusion_block(features, use_bn)
+        self.scratch.refinenet2 = _make_fusion_block(features, use_bn)
+        self.scratch.refinenet3 = _make_fusion_block(features, use_bn)
+        self.scratch.refinenet4 = _make_fusion_block(features, use_bn)
+        self.scratch.output_conv = head
+
+    def forward(self, x):
+        return self.forward_features(x)[0]
+
+    def forward_features(self, x):
+        """Forward pass that also returns the decoder features used by ZoeDepth
+
+        Returns:
+            tuple(torch.Tensor, dict): output of the head and the features, keyed by the layer names of MidasCore: 'out_conv' (output of
+            the 4th head layer), 'l4_rn' (last encoder layer after the reassemble conv) and 'r4' ... 'r1' (fusion block outputs)
+        """
+        layer_1, layer_2, layer_3, layer_4 = self.forward_transformer(self.pretrained, x)
+
+        layer_1_rn = self.scratch.layer1_rn(layer_1)
+        layer_2_rn = self.scratch.layer2_rn(layer_2)
+        layer_3_rn = self.scratch.layer3_rn(layer_3)
+        layer_4_rn = self.scratch.layer4_rn(layer_4)
+
+        path_4 = self.scratch.refinenet4(layer_4_rn, size=layer_3_rn.shape[2:])
+        path_3 = self.scratch.refinenet3(path_4, layer_3_rn, size=layer_2_rn.shape[2:])
+        path_2 = self.scratch.refinenet2(path_3, layer_2_rn, size=layer_1_rn.shape[2:])
+        path_1 = self.scratch.refinenet1(path_2, layer_1_rn)
+
+        out_conv = self.scratch.output_conv[:4](path_1)
+        out = self.scratch.output_conv[4:](out_conv)
+        return out, dict(out_conv=out_conv, l4_rn=layer_4_rn, r4=path_4, r3=path_3, r2=path_2, r1=path_1)
+
+
+class DPTDepthModel(DPT):
+    def __init__(self, path=None, non_negative=True, features=256, head_features_1=None, head_features_2=32, **kwargs):
+        """DPT with the MiDaS relative depth head
+
+        Args:
+            path (str, optional): Checkpoint to load. Defaults to None.
+            non_negative (bool, optional): Clamp the output to non negative values. Defaults to True.
+            features (int, optional): Number of decoder features. Defaults to 256.
+            head_features_1 (int, optional): Input features of the head. Defaults to features.
+            head_features_2 (int, optional): Hidden features of the head. Defaults to 32.
+            kwargs: passed on to DPT (backbone, readout, use_bn)
+        """
+        head_features_1 = features if head_features_1 is None else head_features_1
+        head = nn.Sequential(
+            nn.Conv2d(head_features_1, head_features_1 // 2, kernel_size=3, stride=1, padding=1),
+            Interpolate(scale_factor=2, mode="bilinear", align_corners=True),
+            nn.Conv2d(head_features_1 // 2, head_features_2, kernel_size=3, stride=1, padding=1),
+            nn.ReLU(True),
+            nn.Conv2d(head_features_2, 1, kernel_size=1, stride=1, padding=0),
+            nn.ReLU(True) if non_negative else nn.Identity(),
+            nn.Identity(),
+        )
+        super().__init__(head, features=features, **kwargs)
+
+        if path is not None:
+            self.load(path)
+
+    def load(self, path):
+        parameters = torch.load(path, map_location=torch.device('cpu'))
+        if "optimizer" in parameters:
+            parameters = parameters["model"]
+        self.load_state_dict(parameters)
+
+    def forward(self, x):
+        return super().forward(x).squeeze(dim=1)
+
+    def forward_features(self, x):
+        out, features = super().forward_features(x)
+        return out.squeeze(dim=1), features
+
+
+def build_midas(model_type="DPT_BEiT_L_384", pretrained=True):
+    """Builds a MiDaS DPT model from the vendored code. Equivalent to torch.hub.load("intel-isl/MiDaS", model_type, pretrained=pretrained).
+
+    Args:
+        model_type (str, optional): MiDaS model type, one of MIDAS_MODELS. Defaults to "DPT_BEiT_L_384".
+        pretrained (bool, optional): Load the MiDaS weights. They are downloaded once into the torch hub checkpoint cache. Defaults to True.
+
+    Returns:
+        DPTDepthModel: MiDaS model
+    """
+    if model_type not in MIDAS_MODELS:
+        raise ValueError(f"Invalid MiDaS model type: {model_type}. Must be one of {list(MIDAS_MODELS.keys())}")
+    backbone, url = MIDAS_MODELS[model_type]
+    model = DPTDepthModel(path=None, backbone=backbone, non_negative=True)
+    if pretrained:
+        state_dict = torch.hub.load_state_dict_from_url(url, map_location=torch.device('cpu'), progress=True, check_hash=True)
+        model.load_state_dict(state_dict)
+    return model
@@ -0,0 +1,172 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Shape bucketed inference with torch.compile.
+
+MiDaS resizes inputs keeping their aspect ratio, to sides that are multiples of 32, so almost every photo aspect ratio gives a new input
+shape and a compiled model recompiles for most requests. BucketedDepthModel resizes inputs as usual, pads them in network space to the
+smallest of a few fixed shapes (buckets) that holds them, runs the model compiled for that shape and crops the outputs back:
+
+    model = BucketedDepthModel(build_model(config), cache_dir="~/.cache/zoedepth/compile")
+    model.warmup()  # compiles every bucket, or loads the compiled graphs from cache_dir
+    depth = model.infer_pil(image)
+"""
+
+import logging
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+from zoedepth.models.depth_model import DepthModel
+
+# network resolutions of 4:3, 16:9 and 20:9 photos in both orientations and of square images, for the default MiDaS input size of
+# ZoeD_N / ZoeD_K / ZoeD_NK (384x512)
+DEFAULT_BUCKETS = ((384, 512), (384, 672), (384, 864), (512, 512), (672, 512), (896, 512))
+
+
+def parse_buckets(spec):
+    """Parses buckets given as "384x512,672x512" (h x w), or "default" for DEFAULT_BUCKETS"""
+    if spec == "default":
+        return DEFAULT_BUCKETS
+    return tuple(tuple(int(d) for d in bucket.split("x")) for bucket in spec.split(","))
+
+
+def select_bucket(buckets, h, w):
+    """Selects the bucket for an input at network resolution (h, w): the one that needs the least downscaling, then the smallest one.
+
+    Returns:
+        tuple: bucket (bh, bw) and the scale factor (<= 1) to apply to the input before padding it to the bucket
+    """
+    def scale(bucket):
+        return min(1., bucket[0] / h, bucket[1] / w)
+    bucket = min(buckets, key=lambda b: (-scale(b), b[0] * b[1]))
+    return bucket, scale(bucket)
+
+
+def pad_to_bucket(x, size, bucket, padding_mode="reflect"):
+    """Resizes a batch x to size (h, w) and pads it to bucket (bh, bw), centered.
+
+    Returns:
+        tuple: padded batch and a function that crops an output (..., oh, ow) of the padded batch back to the unpadded region, at the
+            output's own resolution
+    """
+    (h, w), (bh, bw) = size, bucket
+    if (h, w) != tuple(x.shape[-2:]):
+        # same resize as PrepForMidas
+        x = F.interpolate(x, (h, w), mode='bilinear', align_corners=True)
+
+    top, left = (bh - h) // 2, (bw - w) // 2
+    padding = (left, bw - w - left, top, bh - h - top)
+    # reflect padding can't be wider than the input
+    x = F.pad(x, padding, mode=padding_mode if max(padding) < min(h, w) else "replicate")
+
+    def crop(t):
+        oh, ow = t.shape[-2:]
+        return t[..., round(top * oh / bh):round((top + h) * oh / bh), round(left * ow / bw):round((left + w) * ow / bw)]
+    return x, crop
+
+
+def enable_compile_cache(cache_dir):
+    """Persists the graphs and kernels compiled by torch.compile (inductor) in cache_dir, so that restarted processes load them instead
+    of compiling them again"""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+
+
+class BucketedDepthModel(DepthModel):
+    def __init__(self, model, buckets=DEFAULT_BUCKETS, use_compile=True, cache_dir=None, padding_mode="reflect", **compile_kwargs):
+        """Runs a ZoeDepth model on a fixed set of input shapes. infer, infer_pil and infer_with_tta work as for the wrapped model.
+
+        Args:
+            model (zoedepth.models.depth_model.DepthModel): ZoeDepth or ZoeDepthNK model
+            buckets (tuple, optional): network resolutions (h, w), multiples of 32. Defaults to DEFAULT_BUCKETS.
+            use_compile (bool, optional): Compile the model with torch.compile, one graph per bucket and batch size. Without it, or with
+                torch versions that lack torch.compile, the model runs eagerly. Defaults to True.
+            cache_dir (str, optional): Directory the compiled graphs are persisted in, see enable_compile_cache. Defaults to None.
+            padding_mode (str, optional): Padding of inputs to their bucket. Defaults to "reflect".
+            **compile_kwargs: passed to torch.compile, e.g. mode="max-autotune"
+        """
+        super().__init__()
+        for h, w in buckets:
+            if h % 32 or w % 32:
+                raise ValueError(f"Bucket sizes must be multiples of 32, got {(h, w)}")
+        self.model = model
+        self.buckets = [tuple(b) for b in buckets]
+        self.padding_mode = padding_mode
+        self.device = model.device
+        self.precision = model.precision
+
+        self._forward = self._forward_bucket
+        self._shapes = set()
+        if use_compile and hasattr(torch, "compile"):
+            if cache_dir:
+                enable_compile_cache(os.path.expanduser(cache_dir))
+            import torch._dynamo.config as dynamo_config
+            # one graph per bucket and batch size, dynamo must not fall back to eager before every bucket is compiled
+            limit = "recompile_limit" if hasattr(dynamo_config, "recompile_limit") else "cache_size_limit"
+            setattr(dynamo_config, limit, max(getattr(dynamo_config, limit), 4 * len(self.buckets)))
+            self._forward = torch.compile(self._forward_bucket, dynamic=False, **compile_kwargs)
+
+    def _forward_bucket(self, x, **kwargs):
+        return self.model(x, do_resize=False, **kwargs)
+
+    def _run(self, x, **kwargs):
+        if self._forward is not self._forward_bucket and tuple(x.shape) not in self._shapes:
+            # the first pass at a shape builds state the model caches per shape (the relative position indices of BEiT). It runs
+            # eagerly, compiling it would guard on the empty cache and recompile on the next call.
+            self._forward_bucket(x, **kwargs)
+            self._shapes.add(tuple(x.shape))
+        return self._forward(x, **kwargs)
+
+    def network_size(self, h, w):
+        """Size (h, w) the wrapped model resizes an (h, w) input to"""
+        return self.model.network_size(h, w)
+
+    def forward(self, x, **kwargs):
+        h, w = self.network_size(*x.shape[-2:])
+        bucket, scale = select_bucket(self.buckets, h, w)
+        x, crop = pad_to_bucket(x, (max(1, round(h * scale)), max(1, round(w * scale))), bucket, self.padding_mode)
+        out = self._run(x, **kwargs)
+        return {k: crop(v) if v.dim() == 4 else v for k, v in out.items()}
+
+    @torch.no_grad()
+    def warmup(self, batch_sizes=(1, 2)):
+        """Compiles the model for every bucket and batch size (or loads it from the cache dir). infer runs the flip augmentation as a
+        second view in the same batch, so it needs batch size 2 per image.
+
+        Returns:
+            dict: (batch size, h, w) -> warm up time in seconds
+        """
+        times = {}
+        for b in batch_sizes:
+            for h, w in self.buckets:
+                start = time.perf_counter()
+                x, autocast = self._autocast(torch.zeros(b, 3, h, w, device=self.device))
+                with autocast:
+                    self._run(x)
+                times[(b, h, w)] = time.perf_counter() - start
+                logging.info(f"Warmed up bucket {h}x{w}, batch size {b} in {times[(b, h, w)]:.1f}s")
+        return times
@@ -31,18 +31,103 @@ import PIL.Image
 from PIL import Image
 from typing import Union
 
+from zoedepth.models.base_models.midas import Resize
+from zoedepth.models.tta import TTAView, run_views, run_views_many, merge_views
+from zoedepth.models.precision import PRECISIONS, WEIGHT_DTYPES, restore_weights, store_weights_in
+
 
 class DepthModel(nn.Module):
     def __init__(self):
         super().__init__()
         self.device = 'cpu'
+        self.precision = 'fp32'
+        self.weights_dtype = None
     
     def to(self, device) -> nn.Module:
         self.device = device
         return super().to(device)
+
+    def set_precision(self, precision: str="fp32") -> nn.Module:
+        """
+        Sets the precision of the inference interfaces (infer, infer_pil, infer_with_tta)
+        Args:
+            precision (str, optional): One of
+                - "fp32": float32 weights and compute
+                - "bf16": bfloat16 autocast (convolutions and matrix multiplications) in channels_last memory format, for CPUs with bf16
+                  matrix units. The bin centers and the output distribution are computed in float32.
+                - "fp16-weights": weights of the linear and conv layers stored in float16 and upcast per layer when used, half the weight
+                  memory with float32 compute. Switching back to another precision keeps the float16 rounding of the weights.
+                Defaults to "fp32".
+            Weights stored in half precision with set_weights_dtype are kept whatever the precision.
+        Returns:
+            nn.Module: self
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision {precision} not supported. Supported values are {PRECISIONS}")
+        if precision == "fp16-weights":
+            store_weights_in(self, torch.float16)
+        elif self.weights_dtype is None:
+            restore_weights(self)
+        memory_format = torch.channels_last if precision == "bf16" else torch.contiguous_format
+        nn.Module.to(self, memory_format=memory_format)
+        self.precision = precision
+        return self
+
+    def set_weights_dtype(self, weights_dtype=None) -> nn.Module:
+        """
+        Stores the weights of the linear and conv layers in half precision and upcasts them per layer when used, which halves the weight
+        memory (see zoedepth.models.precision.store_weights_in). This is the weights_dtype build option.
+        Combined with the "bf16" precision, bfloat16 weights are used as they are by the bfloat16 autocast.
+        Args:
+            weights_dtype (str, optional): "float16", "bfloat16" or None for float32 weights. Defaults to None.
+        Returns:
+            nn.Module: self
+        """
+        if weights_dtype is not None and weights_dtype not in WEIGHT_DTYPES:
+            raise ValueError(f"weights_dtype {weights_dtype} not supported. Supported values are {list(WEIGHT_DTYPES)} or None")
+        restore_weights(self)
+        if weights_dtype is not None:
+            store_weights_in(self, WEIGHT_DTYPES[weights_dtype])
+        self.weights_dtype = weights_dtype
+        return self
+
+    def _autocast(self, x):
+        """Input in the memory format of the model and the autocast context of its precision"""
+        if self.precision == "bf16":
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x, torch.autocast(torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.precision == "bf16")
     
     def forward(self, x, *args, **kwargs):
         raise NotImplementedError
+
+    def network_size(self, h, w):
+        """Size (h, w) the model resizes an (h, w) input to, see PrepForMidas"""
+        resizer = self.core.prep.resizer
+        if isinstance(resizer, Resize):
+            w, h = resizer.get_size(w, h)
+        return int(h), int(w)
+
+    @staticmethod
+    def _output_size(h, w, output_size=None, output_scale=None, max_side=None):
+        """Size (h, w) of the output for an (h, w) input, "network", or None if it is the input size. See infer for the arguments"""
+        if output_size == "network":
+            if output_scale is not None or max_side is not None:
+                raise ValueError("output_size='network' can not be combined with output_scale or max_side")
+            return "network"
+        if output_size is not None and output_scale is not None:
+            raise ValueError("Only one of output_size and output_scale can be given")
+        if output_size is not None:
+            out_h, out_w = output_size
+        elif output_scale is not None:
+            out_h, out_w = max(1, round(h * output_scale)), max(1, round(w * output_scale))
+        else:
+            out_h, out_w = h, w
+        if max_side is not None and max(out_h, out_w) > max_side:
+            scale = max_side / max(out_h, out_w)
+            out_h, out_w = max(1, round(out_h * scale)), max(1, round(out_w * scale))
+        if (out_h, out_w) == (h, w):
+            return None
+        return int(out_h), int(out_w)
     
     def _infer(self, x: torch.Tensor):
         """
@@ -54,7 +139,8 @@ class DepthModel(nn.Module):
         """
         return self(x)['metric_depth']
     
-    def _infer_with_pad_aug(self, x: torch.Tensor, pad_input: bool=True, fh: float=3, fw: float=3, upsampling_mode: str='bicubic', padding_mode="reflect", **kwargs) -> torch.Tensor:
+    def _infer_with_pad_aug(self, x: torch.Tensor, pad_input: bool=True, fh: float=3, fw: float=3, upsampling_mode: str='bicubic', padding_mode="reflect", resize_first: bool=False,
+                            output_size=None, output_scale=None, max_side=None, **kwargs) -> torch.Tensor:
         """
         Inference interface for the model with padding augmentation
         Padding augmentation fixes the boundary artifacts in the output depth map.
@@ -69,6 +155,9 @@ class DepthModel(nn.Module):
             fw (float, optional): width padding factor. The padding is calculated as sqrt(w/2) * fw. Defaults to 3.
             upsampling_mode (str, optional): upsampling mode. Defaults to 'bicubic'.
             padding_mode (str, optional): padding mode. Defaults to "reflect".
+            resize_first (bool, optional): resize the input to the network resolution first and pad it there, see infer_with_tta. Defaults to False.
+            output_size, output_scale, max_side: resolution of the output, see infer. Default to None (size of the input).
+            **kwargs: passed to F.pad, e.g. value for padding_mode="constant".
         Returns:
             torch.Tensor: output tensor of shape (b, 1, h, w)
         """
@@ -76,6 +165,11 @@ class DepthModel(nn.Module):
         assert x.dim() == 4, "x must be 4 dimensional, got {}".format(x.dim())
         assert x.shape[1] == 3, "x must have 3 channels, got {}".format(x.shape[1])
 
+        if resize_first or self._output_size(*x.shape[-2:], output_size, output_scale, max_side) is not None:
+            view = TTAView(pad=(fh, fw) if pad_input else None)
+            return self.infer_with_tta(x, views=[view], upsampling_mode=upsampling_mode, padding_mode=padding_mode, resize_first=resize_first,
+                                       output_size=output_size, output_scale=output_scale, max_side=max_side, **kwargs)
+
         if pad_input:
             assert fh > 0 or fw > 0, "atlease one of fh and fw must be greater than 0"
             pad_h = int(np.sqrt(x.shape[2]/2) * fh)
@@ -84,8 +178,10 @@ class DepthModel(nn.Module):
             if pad_h > 0:
                 padding += [pad_h, pad_h]
             
-            x = F.pad(x, padding, mode=padding_mode, **kwargs)
-        out = self._infer(x)
+            x = F.pad(x, padding, **{"mode": padding_mode, **kwargs})
+        x, autocast = self._autocast(x)
+        with autocast:
+            out = self._infer(x).float()
         if out.shape[-2:] != x.shape[-2:]:
             out = F.interpolate(out, size=(x.shape[2], x.shape[3]), mode=upsampling_mode, align_corners=False)
         if pad_input:
@@ -96,37 +192,169 @@ class DepthModel(nn.Module):
                 out = out[:, :, :, pad_w:-pad_w]
         return out
     
-    def infer_with_flip_aug(self, x, pad_input: bool=True, **kwargs) -> torch.Tensor:
+    def _infer_with_confidence(self, x: torch.Tensor):
+        """
+        Inference interface for the model that also returns the predictive standard deviation, computed from the output probability distribution over bin centers
+        Args:
+            x (torch.Tensor): input tensor of shape (b, c, h, w)
+        Returns:
+            tuple(torch.Tensor, torch.Tensor): depth and standard deviation, both of shape (b, 1, h, w)
+        """
+        out = self(x, return_probs=True)
+        depth, probs, centers = out['metric_depth'], out['probs'], out['bin_centers']
+        var = torch.sum(probs * (centers - depth) ** 2, dim=1, keepdim=True)
+        return depth, torch.sqrt(var)
+
+    @torch.no_grad()
+    def infer_with_tta(self, x, views=("id", "flip"), merge="mean", upsampling_mode='bicubic', padding_mode="reflect", resize_first: bool=False,
+                       output_size=None, output_scale=None, max_side=None, **kwargs) -> torch.Tensor:
+        """
+        Inference interface for the model with test time augmentation
+        All views with the same shape are stacked along the batch dimension and run through a single forward pass. The outputs are then mapped back to the original view and merged.
+        Args:
+            x (torch.Tensor): input tensor of shape (b, c, h, w)
+            views (List[str, TTAView], optional): views to run, either TTAView objects or strings as parsed by TTAView.parse. Defaults to ("id", "flip").
+            merge (str, optional): merge rule, one of "mean", "median" or "confidence". Defaults to "mean".
+            upsampling_mode (str, optional): upsampling mode. Defaults to 'bicubic'.
+            padding_mode (str, optional): padding mode. Defaults to "reflect".
+            resize_first (bool, optional): resize the input to the network resolution first and pad it there, with the padding scaled to the
+                network resolution, instead of padding the full resolution input. The padding is cropped from the output at its own resolution,
+                so the output is upsampled once, to the input size. Saves the large padded copies of high resolution inputs. Defaults to False.
+            output_size, output_scale, max_side: resolution of the output, see infer. Default to None (size of the input).
+            **kwargs: passed to F.pad when padding the views, e.g. value for padding_mode="constant".
+        Returns:
+            torch.Tensor: output tensor of shape (b, 1, h, w), or of the requested output size
+        """
+        assert x.dim() == 4, "x must be 4 dimensional, got {}".format(x.dim())
+        assert x.shape[1] == 3, "x must have 3 channels, got {}".format(x.shape[1])
+
+        views = [TTAView.parse(v) for v in views]
+        forward_fn = self._infer_with_confidence if merge == "confidence" else self._infer
+        x, autocast = self._autocast(x)
+        with autocast:
+            results = run_views(forward_fn, x, views, padding_mode=padding_mode, upsampling_mode=upsampling_mode,
+                                network_size=self.network_size if resize_first else None,
+                                output_size=self._output_size(*x.shape[-2:], output_size, output_scale, max_side), pad_kwargs=kwargs)
+        results = [tuple(t.float() for t in r) for r in results]
+        preds = [r[0] for r in results]
+        stds = [r[1] for r in results] if merge == "confidence" else None
+        return merge_views(preds, merge=merge, stds=stds)
+
+    def infer_with_flip_aug(self, x, pad_input: bool=True, fh: float=3, fw: float=3, **kwargs) -> torch.Tensor:
         """
         Inference interface for the model with horizontal flip augmentation
         Horizontal flip augmentation improves the accuracy of the model by averaging the output of the model with and without horizontal flip.
+        Both views are run as a single batch through one forward pass.
         Args:
             x (torch.Tensor): input tensor of shape (b, c, h, w)
             pad_input (bool, optional): whether to use padding augmentation. Defaults to True.
+            fh, fw (float, optional): padding factors, see _infer_with_pad_aug. Default to 3.
+            **kwargs: passed to infer_with_tta, e.g. padding_mode, resize_first or output_size. Others are passed to F.pad.
         Returns:
             torch.Tensor: output tensor of shape (b, 1, h, w)
         """
-        # infer with horizontal flip and average
-        out = self._infer_with_pad_aug(x, pad_input=pad_input, **kwargs)
-        out_flip = self._infer_with_pad_aug(torch.flip(x, dims=[3]), pad_input=pad_input, **kwargs)
-        out = (out + torch.flip(out_flip, dims=[3])) / 2
-        return out
-    
-    def infer(self, x, pad_input: bool=True, with_flip_aug: bool=True, **kwargs) -> torch.Tensor:
+        pad = (fh, fw) if pad_input else None
+        views = [TTAView(pad=pad), TTAView(flip=True, pad=pad)]
+        return self.infer_with_tta(x, views=views, merge="mean", **kwargs)
+
+    @torch.no_grad()
+    def infer_with_adaptive_flip_aug(self, x, flip_threshold: float, pad_input: bool=True, fh: float=3, fw: float=3, upsampling_mode: str='bicubic',
+                                     padding_mode="reflect", resize_first: bool=False, output_size=None, output_scale=None, max_side=None,
+                                     return_uncertainty: bool=False, **kwargs):
+        """
+        Inference interface for the model with horizontal flip augmentation only where the model is uncertain
+        The input is run without flip first. The uncertainty of a sample is the mean relative standard deviation (std / depth) of its predicted
+        depth, computed from the output distribution over bin centers (see _infer_with_confidence). Only the samples with an uncertainty above
+        flip_threshold are run again flipped, as a smaller batch, and their two predictions are averaged as in infer_with_flip_aug.
+        Args:
+            x (torch.Tensor): input tensor of shape (b, c, h, w)
+            flip_threshold (float): uncertainty above which a sample gets the flipped pass. 0 flips every sample, see compare_adaptive_tta.py for picking it.
+            pad_input (bool, optional): whether to use padding augmentation. Defaults to True.
+            return_uncertainty (bool, optional): also return the uncertainty of every sample, a tensor of shape (b,). The samples that got the
+                flipped pass are those with uncertainty > flip_threshold. Defaults to False.
+            upsampling_mode, padding_mode, resize_first, output_size, output_scale, max_side: see infer_with_tta.
+            **kwargs: passed to F.pad, e.g. value for padding_mode="constant".
+        Returns:
+            torch.Tensor: output tensor of shape (b, 1, h, w), or of the requested output size
+        """
+        assert x.dim() == 4, "x must be 4 dimensional, got {}".format(x.dim())
+        assert x.shape[1] == 3, "x must have 3 channels, got {}".format(x.shape[1])
+
+        pad = (fh, fw) if pad_input else None
+        view_kwargs = dict(padding_mode=padding_mode, upsampling_mode=upsampling_mode, network_size=self.network_size if resize_first else None,
+                           output_size=self._output_size(*x.shape[-2:], output_size, output_scale, max_side), pad_kwargs=kwargs)
+        uncertainty = []
+
+        def forward_fn(x):
+            depth, std = self._infer_with_confidence(x)
+            # at the output resolution, before the prediction is mapped back and upsampled
+            uncertainty.append((std.float() / depth.float().clamp(min=1e-3)).flatten(1).mean(dim=1))
+            return depth
+
+        x, autocast = self._autocast(x)
+        with autocast:
+            (pred,), = run_views(forward_fn, x, [TTAView(pad=pad)], **view_kwargs)
+            pred = pred.float()
+            # the size of the second batch is needed on the host, this is the only sync
+            idx = (uncertainty[0] > flip_threshold).nonzero().squeeze(1)
+            if len(idx):
+                (flip_pred,), = run_views(self._infer, x[idx], [TTAView(flip=True, pad=pad)], **view_kwargs)
+                pred = pred.index_copy(0, idx, (pred[idx] + flip_pred.float()) / 2)
+        if return_uncertainty:
+            return pred, uncertainty[0]
+        return pred
+
+    @torch.no_grad()
+    def infer(self, x, pad_input: bool=True, with_flip_aug: bool=True, flip_threshold: float=None, **kwargs) -> torch.Tensor:
         """
         Inference interface for the model
         Args:
             x (torch.Tensor): input tensor of shape (b, c, h, w)
             pad_input (bool, optional): whether to use padding augmentation. Defaults to True.
             with_flip_aug (bool, optional): whether to use horizontal flip augmentation. Defaults to True.
+            flip_threshold (float, optional): with flip augmentation, run the flipped pass only for the samples whose uncertainty is above this
+                threshold, see infer_with_adaptive_flip_aug. Defaults to None (flip every sample).
+            output_size (tuple or str, optional): (h, w) of the output, or "network" for the resolution the model predicts at, which skips
+                the upsampling entirely. Defaults to None (size of the input).
+            output_scale (float, optional): size of the output relative to the input, instead of output_size. Defaults to None.
+            max_side (int, optional): downscale the output, keeping its aspect ratio, so that its longer side is at most max_side. Defaults to None.
+            Predictions are cropped and resized once, straight to the output size, so a small output saves the upsampling to the full input
+            resolution and the transfer of the full resolution depth map.
         Returns:
-            torch.Tensor: output tensor of shape (b, 1, h, w)
+            torch.Tensor: output tensor of shape (b, 1, h, w), or of the requested output size
         """
+        if with_flip_aug and flip_threshold is not None:
+            return self.infer_with_adaptive_flip_aug(x, flip_threshold, pad_input=pad_input, **kwargs)
         if with_flip_aug:
             return self.infer_with_flip_aug(x, pad_input=pad_input, **kwargs)
         else:
             return self._infer_with_pad_aug(x, pad_input=pad_input, **kwargs)
-    
+
+    @torch.no_grad()
+    def infer_many(self, xs, pad_input: bool=True, with_flip_aug: bool=True, fh: float=3, fw: float=3, upsampling_mode: str='bicubic',
+                   padding_mode="reflect", output_sizes=None, **kwargs):
+        """
+        Inference interface for several inputs of different sizes, e.g. the images of concurrent requests
+        Every input is resized to its network resolution first and padded there, as with infer(x, resize_first=True), so inputs that the model
+        resizes to the same resolution share forward passes. Each prediction is upsampled once, to the output size of its input.
+        Args:
+            xs (List[torch.Tensor]): inputs of shape (b_i, c, h_i, w_i)
+            pad_input, with_flip_aug, fh, fw, upsampling_mode, padding_mode: see infer and _infer_with_pad_aug
+            output_sizes (list, optional): output size of every input, (h, w), "network" or None for the size of the input, see
+                _output_size. Defaults to None (size of every input).
+            **kwargs: passed to F.pad, e.g. value for padding_mode="constant".
+        Returns:
+            List[torch.Tensor]: prediction of every input, of shape (b_i, 1, h_i, w_i) or of its output size
+        """
+        pad = (fh, fw) if pad_input else None
+        views = [TTAView(pad=pad), TTAView(flip=True, pad=pad)] if with_flip_aug else [TTAView(pad=pad)]
+        _, autocast = self._autocast(xs[0])
+        xs = [self._autocast(x)[0] for x in xs]
+        with autocast:
+            results = run_views_many(self._infer, xs, views, padding_mode=padding_mode, upsampling_mode=upsampling_mode,
+                                     network_size=self.network_size, output_sizes=output_sizes, pad_kwargs=kwargs)
+        return [merge_views([r[0].float() for r in views_out]) for views_out in results]
+
     @torch.no_grad()
     def infer_pil(self, pil_img, pad_input: bool=True, with_flip_aug: bool=True, output_type: str="numpy", **kwargs) -> Union[np.ndarray, PIL.Image.Image, torch.Tensor]:
         """
@@ -136,6 +364,7 @@ class DepthModel(nn.Module):
             pad_input (bool, optional): whether to use padding augmentation. Defaults to True.
             with_flip_aug (bool, optional): whether to use horizontal flip augmentation. Defaults to True.
             output_type (str, optional): output type. Supported values are 'numpy', 'pil' and 'tensor'. Defaults to "numpy".
+            **kwargs: passed to infer, e.g. output_size, output_scale or max_side for a depth map smaller than the image
         """
         x = transforms.ToTensor()(pil_img).unsqueeze(0).to(self.device)
         out_tensor = self.infer(x, pad_input=pad_input, with_flip_aug=with_flip_aug, **kwargs)
@@ -57,11 +57,62 @@ def inv_attractor(dx, alpha: float = 300, gamma: int = 2):
     return dx.div(1+alpha*dx.pow(gamma))
 
 
+def attractor_shift(A, b_centers, attractor_type='exp', kind='sum', chunk_size=None, alpha: float = 300, gamma: int = 2):
+    """Shift of the bin centers by the attractors: the sum (or mean) over attractors i of dist(A_i - c_j), with dist exp_attractor or inv_attractor.
+
+    The shifts are computed for chunk_size attractors at a time, so the intermediate tensor is (n, chunk_size, nbins, h, w) instead of
+    (n, n_attractors, nbins, h, w), and accumulated into the output. When no gradient is needed, the intermediates are updated in place,
+    which makes chunk_size=1 both the leanest and (on CPU) the fastest choice.
+
+    Args:
+        A (torch.Tensor): attractor points; shape - n, n_attractors, h, w
+        b_centers (torch.Tensor): bin centers; shape - n, nbins, h, w
+        attractor_type (str, optional): "exp" or "inv". Defaults to 'exp'.
+        kind (str, optional): Attraction aggregation "sum" or "mean". Defaults to 'sum'.
+        chunk_size (int, optional): Number of attractors processed at once. Defaults to 1 without autograd and all attractors with it.
+        alpha (float, optional): see exp_attractor. Defaults to 300.
+        gamma (int, optional): see exp_attractor. Defaults to 2.
+
+    Returns:
+        torch.Tensor: shift of the bin centers; shape - n, nbins, h, w
+    """
+    n_attractors = A.shape[1]
+    inplace = not (torch.is_grad_enabled() and (A.requires_grad or b_centers.requires_grad))
+    if chunk_size is None:
+        chunk_size = 1 if inplace else n_attractors
+    dist = exp_attractor if attractor_type == 'exp' else inv_attractor
+
+    delta_c = None
+    for i in range(0, n_attractors, chunk_size):
+        dx = A[:, i:i + chunk_size].unsqueeze(2) - b_centers.unsqueeze(1)  # n, chunk, nbins, h, w
+        if inplace:
+            # same expressions as exp_attractor and inv_attractor, with one temporary instead of one per operation
+            if gamma == 2:
+                t = dx.square()
+            else:
+                # exp_attractor uses |dx|^gamma, inv_attractor the signed dx^gamma
+                t = dx.abs().pow_(gamma) if attractor_type == 'exp' else dx.pow(gamma)
+            if attractor_type == 'exp':
+                dx.mul_(t.mul_(-alpha).exp_())
+            else:
+                dx.div_(t.mul_(alpha).add_(1))
+        else:
+            dx = dist(dx, alpha, gamma)
+        shift = dx.sum(dim=1)
+        delta_c = shift if delta_c is None else delta_c.add_(shift)
+
+    if kind == 'mean':
+        delta_c = delta_c.div_(n_attractors)
+    return delta_c
+
+
 class AttractorLayer(nn.Module):
     def __init__(self, in_features, n_bins, n_attractors=16, mlp_dim=128, min_depth=1e-3, max_depth=10,
-                 alpha=300, gamma=2, kind='sum', attractor_type='exp', memory_efficient=False):
+                 alpha=300, gamma=2, kind='sum', attractor_type='exp', memory_efficient=False, chunk_size=None):
         """
         Attractor layer for bin centers. Bin centers are bounded on the interval (min_depth, max_depth)
+        chunk_size is the number of attractors whose shifts are computed at once, see attractor_shift. By default all of them when training
+        (one at a time if memory_efficient) and one at a time, in place, otherwise.
         """
         super().__init__()
 
@@ -74,6 +125,7 @@ class AttractorLayer(nn.Module):
         self.kind = kind
         self.attractor_type = attractor_type
         self.memory_efficient = memory_efficient
+        self.chunk_size = chunk_size
 
         self._net = nn.Sequential(
             nn.Conv2d(in_features, mlp_dim, 1, 1, 0),
@@ -82,6 +134,11 @@ class AttractorLayer(nn.Module):
             nn.ReLU(inplace=True)
         )
 
+    def _chunk_size(self):
+        if self.chunk_size is None and self.memory_efficient:
+            return 1
+        return self.chunk_size
+
     def forward(self, x, b_prev, prev_b_embedding=None, interpolate=True, is_for_query=False):
         """
         Args:
@@ -97,7 +154,7 @@ class AttractorLayer(nn.Module):
                     prev_b_embedding, x.shape[-2:], mode='bilinear', align_corners=True)
             x = x + prev_b_embedding
 
-        A = self._net(x)
+        A = self._net(x).float()  # attractor shifts are computed in float32 under reduced precision autocast
         eps = 1e-3
         A = A + eps
         n, c, h, w = A.shape
@@ -109,24 +166,8 @@ class AttractorLayer(nn.Module):
             b_prev, (h, w), mode='bilinear', align_corners=True)
         b_centers = b_prev
 
-        if self.attractor_type == 'exp':
-            dist = exp_attractor
-        else:
-            dist = inv_attractor
-
-        if not self.memory_efficient:
-            func = {'mean': torch.mean, 'sum': torch.sum}[self.kind]
-            # .shape N, nbins, h, w
-            delta_c = func(dist(A_normed.unsqueeze(
-                2) - b_centers.unsqueeze(1)), dim=1)
-        else:
-            delta_c = torch.zeros_like(b_centers, device=b_centers.device)
-            for i in range(self.n_attractors):
-                # .shape N, nbins, h, w
-                delta_c += dist(A_normed[:, i, ...].unsqueeze(1) - b_centers)
-
-            if self.kind == 'mean':
-                delta_c = delta_c / self.n_attractors
+        # .shape N, nbins, h, w
+        delta_c = attractor_shift(A_normed, b_centers, self.attractor_type, self.kind, chunk_size=self._chunk_size())
 
         b_new_centers = b_centers + delta_c
         B_centers = (self.max_depth - self.min_depth) * \
@@ -138,9 +179,11 @@ class AttractorLayer(nn.Module):
 
 class AttractorLayerUnnormed(nn.Module):
     def __init__(self, in_features, n_bins, n_attractors=16, mlp_dim=128, min_depth=1e-3, max_depth=10,
-                 alpha=300, gamma=2, kind='sum', attractor_type='exp', memory_efficient=False):
+                 alpha=300, gamma=2, kind='sum', attractor_type='exp', memory_efficient=False, chunk_size=None):
         """
         Attractor layer for bin centers. Bin centers are unbounded
+        chunk_size is the number of attractors whose shifts are computed at once, see attractor_shift. By default all of them when training
+        (one at a time if memory_efficient) and one at a time, in place, otherwise.
         """
         super().__init__()
 
@@ -153,6 +196,7 @@ class AttractorLayerUnnormed(nn.Module):
         self.kind = kind
         self.attractor_type = attractor_type
         self.memory_efficient = memory_efficient
+        self.chunk_size = chunk_size
 
         self._net = nn.Sequential(
             nn.Conv2d(in_features, mlp_dim, 1, 1, 0),
@@ -161,6 +205,11 @@ class AttractorLayerUnnormed(nn.Module):
             nn.Softplus()
         )
 
+    def _chunk_size(self):
+        if self.chunk_size is None and self.memory_efficient:
+            return 1
+        return self.chunk_size
+
     def forward(self, x, b_prev, prev_b_embedding=None, interpolate=True, is_for_query=False):
         """
         Args:
@@ -176,31 +225,15 @@ class AttractorLayerUnnormed(nn.Module):
                     prev_b_embedding, x.shape[-2:], mode='bilinear', align_corners=True)
             x = x + prev_b_embedding
 
-        A = self._net(x)
+        A = self._net(x).float()
         n, c, h, w = A.shape
 
         b_prev = nn.functional.interpolate(
             b_prev, (h, w), mode='bilinear', align_corners=True)
         b_centers = b_prev
 
-        if self.attractor_type == 'exp':
-            dist = exp_attractor
-        else:
-            dist = inv_attractor
-
-        if not self.memory_efficient:
-            func = {'mean': torch.mean, 'sum': torch.sum}[self.kind]
-            # .shape N, nbins, h, w
-            delta_c = func(
-                dist(A.unsqueeze(2) - b_centers.unsqueeze(1)), dim=1)
-        else:
-            delta_c = torch.zeros_like(b_centers, device=b_centers.device)
-            for i in range(self.n_attractors):
-                delta_c += dist(A[:, i, ...].unsqueeze(1) -
-                                b_centers)  # .shape N, nbins, h, w
-
-            if self.kind == 'mean':
-                delta_c = delta_c / self.n_attractors
+        # .shape N, nbins, h, w
+        delta_c = attractor_shift(A, b_centers, self.attractor_type, self.kind, chunk_size=self._chunk_size())
 
         b_new_centers = b_centers + delta_c
         B_centers = b_new_centers
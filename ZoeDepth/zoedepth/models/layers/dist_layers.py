@@ -47,6 +47,18 @@ class LogBinomial(nn.Module):
             0, n_classes).view(1, -1, 1, 1))
         self.register_buffer('K_minus_1', torch.Tensor(
             [self.K-1]).view(1, -1, 1, 1))
+        # log(nCk) of every class, set by precompute()
+        self.register_buffer('log_binom_k', None, persistent=False)
+
+    def precompute(self):
+        """Caches log_binom(K-1, k), which only depends on the number of classes. Only for inference, it is not updated if the buffers change."""
+        self.log_binom_k = log_binom(self.K_minus_1, self.k_idx)
+        return self
+
+    def _log_binom(self, k0=0, k1=None):
+        if self.log_binom_k is not None:
+            return self.log_binom_k[:, k0:k1]
+        return log_binom(self.K_minus_1, self.k_idx[:, k0:k1])
 
     def forward(self, x, t=1., eps=1e-4):
         """Compute log binomial distribution for x
@@ -64,10 +76,61 @@ class LogBinomial(nn.Module):
 
         one_minus_x = torch.clamp(1 - x, eps, 1)
         x = torch.clamp(x, eps, 1)
-        y = log_binom(self.K_minus_1, self.k_idx) + self.k_idx * \
+        y = self._log_binom() + self.k_idx * \
             torch.log(x) + (self.K - 1 - self.k_idx) * torch.log(one_minus_x)
         return self.act(y/t, dim=1)
 
+    @torch.no_grad()
+    def expected_value(self, x, values, t=1., eps=1e-4, chunk_size=8):
+        """Expected value sum_k probs_k * values_k under the distribution of forward(x, t), without materializing the distribution.
+
+        The classes are processed chunk_size at a time with an online softmax (running maximum, normalizer and weighted sum), so the
+        largest intermediate is (N, chunk_size, H, W) instead of (N, n_classes, H, W). Only for inference and act=torch.softmax.
+
+        Args:
+            x (torch.Tensor - NHW or NCHW): probabilities
+            values (torch.Tensor - NCHW): value of every class, C = n_classes. Bilinearly interpolated to the size of x a chunk at a time if
+                its size differs.
+            t (float, torch.Tensor - NCHW, optional): Temperature of distribution. Defaults to 1..
+            eps (float, optional): Small number for numerical stability. Defaults to 1e-4.
+            chunk_size (int, optional): Number of classes processed at once. Defaults to 8.
+
+        Returns:
+            torch.Tensor - N1HW: expected value
+        """
+        if x.ndim == 3:
+            x = x.unsqueeze(1)  # make it nchw
+        values = values.float()
+
+        log_one_minus_x = torch.log(torch.clamp(1 - x, eps, 1))
+        log_x = torch.log(torch.clamp(x, eps, 1))
+        size = x.shape[-2:]
+
+        m = s = acc = None
+        for k0 in range(0, self.K, chunk_size):
+            k = self.k_idx[:, k0:k0 + chunk_size]
+            y = self._log_binom(k0, k0 + chunk_size) + k * log_x + (self.K - 1 - k) * log_one_minus_x
+            y = y.div_(t)
+            v = values[:, k0:k0 + chunk_size]
+            if v.shape[-2:] != size:
+                v = nn.functional.interpolate(v, size, mode='bilinear', align_corners=True)
+
+            m_chunk = y.amax(dim=1, keepdim=True)
+            if m is None:
+                m = m_chunk
+            else:
+                m_new = torch.maximum(m, m_chunk)
+                scale = torch.exp(m - m_new)
+                s.mul_(scale)
+                acc.mul_(scale)
+                m = m_new
+            e = y.sub_(m).exp_()
+            chunk_s = e.sum(dim=1, keepdim=True)
+            chunk_acc = e.mul_(v).sum(dim=1, keepdim=True)
+            s = chunk_s if s is None else s.add_(chunk_s)
+            acc = chunk_acc if acc is None else acc.add_(chunk_acc)
+        return acc.div_(s)
+
 
 class ConditionalLogBinomial(nn.Module):
     def __init__(self, in_features, condition_dim, n_classes=256, bottleneck_factor=2, p_eps=1e-4, max_temp=50, min_temp=1e-7, act=torch.softmax):
@@ -107,7 +170,28 @@ class ConditionalLogBinomial(nn.Module):
         Returns:
             torch.Tensor: Output log binomial distribution
         """
-        pt = self.mlp(torch.concat((x, cond), dim=1))
+        p, t = self._distribution_params(x, cond)
+        return self.log_binomial_transform(p, t)
+
+    def expected_value(self, x, cond, values, chunk_size=8):
+        """Expected value of values under the output distribution, i.e. torch.sum(forward(x, cond) * values, dim=1, keepdim=True), computed
+        without materializing the distribution. See LogBinomial.expected_value
+
+        Args:
+            x (torch.Tensor - NCHW): Main feature
+            cond (torch.Tensor - NCHW): condition feature
+            values (torch.Tensor - NCHW): value of every class, interpolated to the size of x if needed
+            chunk_size (int, optional): Number of classes processed at once. Defaults to 8.
+
+        Returns:
+            torch.Tensor - N1HW: expected value
+        """
+        p, t = self._distribution_params(x, cond)
+        return self.log_binomial_transform.expected_value(p, values, t, chunk_size=chunk_size)
+
+    def _distribution_params(self, x, cond):
+        # the distribution parameters, the temperature and the log binomial are computed in float32 under reduced precision autocast
+        pt = self.mlp(torch.concat((x, cond), dim=1)).float()
         p, t = pt[:, :2, ...], pt[:, 2:, ...]
 
         p = p + self.p_eps
@@ -117,5 +201,4 @@ class ConditionalLogBinomial(nn.Module):
         t = t[:, 0, ...] / (t[:, 0, ...] + t[:, 1, ...])
         t = t.unsqueeze(1)
         t = (self.max_temp - self.min_temp) * t + self.min_temp
-
-        return self.log_binomial_transform(p, t)
+        return p, t
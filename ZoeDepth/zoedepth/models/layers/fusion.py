@@ -0,0 +1,78 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Inference-time rewrites of convolutions: BatchNorm folding, folding a 1x1 conv into the following conv and concatenating sibling convs."""
+
+import torch
+import torch.nn as nn
+
+
+@torch.no_grad()
+def fuse_conv_bn(conv, bn):
+    """Returns a conv equivalent to bn(conv(x)) for a BatchNorm in eval mode"""
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    fused = _like(conv, conv.in_channels, conv.out_channels)
+    fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
+@torch.no_grad()
+def fold_pointwise_conv(pointwise, conv):
+    """Returns a conv equivalent to conv(pointwise(x)), where pointwise is a 1x1 conv.
+
+    conv can have any kernel size and stride but no padding (unless pointwise has no bias): the padding of the output of pointwise is
+    zero, which is not the image of zero padding of x.
+    """
+    if pointwise.kernel_size != (1, 1) or pointwise.stride != (1, 1) or pointwise.groups != 1 or conv.groups != 1:
+        raise ValueError("Only a non-grouped 1x1 conv with stride 1 can be folded into the following conv")
+    if pointwise.bias is not None and any(p != 0 for p in conv.padding):
+        raise ValueError("A 1x1 conv with bias can't be folded into a zero padded conv")
+    fused = _like(conv, pointwise.in_channels, conv.out_channels)
+    w_point = pointwise.weight[:, :, 0, 0]  # mid, in
+    fused.weight.copy_(torch.einsum("omhw,mi->oihw", conv.weight, w_point))
+    bias = conv.bias if conv.bias is not None else torch.zeros(conv.out_channels, device=conv.weight.device, dtype=conv.weight.dtype)
+    if pointwise.bias is not None:
+        bias = bias + conv.weight.sum(dim=(2, 3)) @ pointwise.bias
+    fused.bias.copy_(bias)
+    return fused
+
+
+@torch.no_grad()
+def concat_convs(convs):
+    """Returns one conv whose output channels are the outputs of convs that have the same input and geometry, in order"""
+    first = convs[0]
+    for c in convs[1:]:
+        if (c.in_channels, c.kernel_size, c.stride, c.padding, c.dilation, c.groups) != \
+                (first.in_channels, first.kernel_size, first.stride, first.padding, first.dilation, first.groups):
+            raise ValueError("Only convs with the same input channels and geometry can be concatenated")
+    fused = _like(first, first.in_channels, sum(c.out_channels for c in convs))
+    fused.weight.copy_(torch.cat([c.weight for c in convs]))
+    fused.bias.copy_(torch.cat([c.bias if c.bias is not None else torch.zeros(c.out_channels, device=c.weight.device, dtype=c.weight.dtype)
+                                for c in convs]))
+    return fused
+
+
+def _like(conv, in_channels, out_channels):
+    return nn.Conv2d(in_channels, out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding, dilation=conv.dilation,
+                     groups=conv.groups, bias=True, padding_mode=conv.padding_mode).to(device=conv.weight.device, dtype=conv.weight.dtype)
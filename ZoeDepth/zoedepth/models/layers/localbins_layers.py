@@ -53,7 +53,7 @@ class SeedBinRegressor(nn.Module):
         """
         Returns tensor of bin_width vectors (centers). One vector b for every pixel
         """
-        B = self._net(x)
+        B = self._net(x).float()  # bin centers are computed in float32 under reduced precision autocast
         eps = 1e-3
         B = B + eps
         B_widths_normed = B / B.sum(dim=1, keepdim=True)
@@ -92,7 +92,7 @@ class SeedBinRegressorUnnormed(nn.Module):
         """
         Returns tensor of bin_width vectors (centers). One vector b for every pixel
         """
-        B_centers = self._net(x)
+        B_centers = self._net(x).float()
         return B_centers, B_centers
 
 
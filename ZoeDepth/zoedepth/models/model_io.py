@@ -22,7 +22,74 @@
 
 # File author: Shariq Farooq Bhat
 
+import json
+import mmap
+import struct
+from contextlib import contextmanager
+
 import torch
+import torch.nn as nn
+
+
+@contextmanager
+def init_empty_weights(enabled=True):
+    """Context manager under which parameters of newly constructed modules are created on the meta device.
+
+    Meta parameters have no storage, so no memory is allocated for them and the random initialization of the modules does no work.
+    Buffers are created as usual since they are often computed in __init__ and not all of them are saved in checkpoints.
+    A model built this way must get all of its parameters from a checkpoint, see load_state_dict.
+
+    Args:
+        enabled (bool, optional): If False, this is a no-op. Defaults to True.
+    """
+    if not enabled:
+        yield
+        return
+
+    register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            module._parameters[name] = nn.Parameter(param.to(torch.device("meta")), requires_grad=param.requires_grad)
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def has_meta_parameters(model):
+    return any(p.is_meta for p in model.parameters())
+
+
+def _assign_meta_parameters(model, state):
+    """Replaces the meta parameters of model with the checkpoint tensors themselves (no copy). Returns the entries of state that are left to load."""
+    rest = dict(state)
+    for module_name, module in model.named_modules():
+        for name, param in list(module._parameters.items()):
+            if param is None or not param.is_meta:
+                continue
+            key = f"{module_name}.{name}" if module_name else name
+            if key not in state:
+                continue
+            value = rest.pop(key)
+            if value.shape != param.shape:
+                raise RuntimeError(f"size mismatch for {key}: copying a param with shape {value.shape} from checkpoint, the shape in current model is {param.shape}.")
+            module._parameters[name] = nn.Parameter(value.to(param.dtype), requires_grad=param.requires_grad)
+    return rest
+
+
+def _rename_parametrized(model, state):
+    """Checkpoints of models without parametrizations (see zoedepth.models.precision) hold parametrized tensors under their plain name"""
+    for module_name, module in model.named_modules():
+        prefix = f"{module_name}." if module_name else ""
+        for name in getattr(module, "parametrizations", {}):
+            if prefix + name in state:
+                state[f"{prefix}parametrizations.{name}.original"] = state.pop(prefix + name)
+    return state
+
 
 def load_state_dict(model, state_dict):
     """Load state_dict into model, handling DataParallel and DistributedDataParallel. Also checks for "model" key in state_dict.
@@ -46,12 +113,103 @@ def load_state_dict(model, state_dict):
 
         state[k] = v
 
-    model.load_state_dict(state)
+    state = _rename_parametrized(model, state)
+
+    if has_meta_parameters(model):
+        # model was built under init_empty_weights, parameters are taken over from the checkpoint and only buffers are copied
+        expected = set(model.state_dict().keys())
+        missing = sorted(expected - set(state.keys()))
+        unexpected = sorted(set(state.keys()) - expected)
+        if missing or unexpected:
+            raise RuntimeError(f"Error(s) in loading state_dict for {model.__class__.__name__}: missing keys {missing}, unexpected keys {unexpected}")
+        state = _assign_meta_parameters(model, state)
+        model.load_state_dict(state, strict=False)
+        leftover = [name for name, p in model.named_parameters() if p.is_meta]
+        if leftover:
+            raise RuntimeError(f"Parameters {leftover} were not materialized from the checkpoint")
+    else:
+        model.load_state_dict(state)
     print("Loaded successfully")
     return model
 
 
+# Flat tensor file format, compatible with safetensors: an 8 byte little-endian header length, a JSON header mapping every tensor name to
+# its dtype, shape and [begin, end) byte offsets in the data section, then the raw tensor bytes.
+_DTYPES = {
+    torch.float64: "F64", torch.float32: "F32", torch.float16: "F16", torch.bfloat16: "BF16",
+    torch.int64: "I64", torch.int32: "I32", torch.int16: "I16", torch.int8: "I8", torch.uint8: "U8", torch.bool: "BOOL",
+}
+_DTYPES_BY_NAME = {v: k for k, v in _DTYPES.items()}
+
+
+def save_mmap_checkpoint(state_dict, path, metadata=None):
+    """Saves a state dict of tensors as a flat, memory-mappable (safetensors compatible) file
+
+    Args:
+        state_dict (dict): name -> torch.Tensor
+        path (str): output path, conventionally *.safetensors
+        metadata (dict, optional): str -> str metadata stored in the header. Defaults to None.
+    """
+    tensors = {k: v.detach().cpu().contiguous() for k, v in state_dict.items()}
+    # largest element size first, so every tensor starts at an offset aligned to its dtype without padding between tensors
+    order = sorted(tensors, key=lambda k: (-tensors[k].element_size(), k))
+
+    header = {}
+    offset = 0
+    for k in order:
+        t = tensors[k]
+        if t.dtype not in _DTYPES:
+            raise ValueError(f"Unsupported dtype {t.dtype} of {k}")
+        nbytes = t.numel() * t.element_size()
+        header[k] = {"dtype": _DTYPES[t.dtype], "shape": list(t.shape), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    if metadata:
+        header["__metadata__"] = {str(k): str(v) for k, v in metadata.items()}
+
+    header = json.dumps(header, separators=(",", ":")).encode()
+    header += b" " * (-len(header) % 8)  # data section starts 8 byte aligned
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for k in order:
+            t = tensors[k]
+            if t.numel():
+                f.write(t.reshape(-1).view(torch.uint8).numpy())
+
+
+def load_mmap_checkpoint(path):
+    """Loads a file written by save_mmap_checkpoint (or any safetensors file) by memory mapping it.
+
+    The returned tensors are views of a private (copy-on-write) mapping of the file: loading does not read the weights, pages are read
+    when first touched, and processes that map the same file share the page cache instead of each holding a private copy, as long as
+    the tensors are not written to. A model built with meta_init keeps these tensors as its parameters.
+
+    Returns:
+        dict: name -> torch.Tensor
+    """
+    with open(path, "rb") as f:
+        header_len, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+        # ACCESS_COPY maps the file MAP_PRIVATE: writable tensors, and writes never reach the file
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    header.pop("__metadata__", None)
+
+    data_start = 8 + header_len
+    state_dict = {}
+    for k, info in header.items():
+        dtype = _DTYPES_BY_NAME[info["dtype"]]
+        begin, end = info["data_offsets"]
+        count = (end - begin) // torch.tensor([], dtype=dtype).element_size()
+        if count == 0:
+            state_dict[k] = torch.empty(info["shape"], dtype=dtype)
+        else:
+            state_dict[k] = torch.frombuffer(buf, dtype=dtype, count=count, offset=data_start + begin).reshape(info["shape"])
+    return state_dict
+
+
 def load_wts(model, checkpoint_path):
+    if checkpoint_path.endswith(".safetensors"):
+        return load_state_dict(model, load_mmap_checkpoint(checkpoint_path))
     ckpt = torch.load(checkpoint_path, map_location='cpu')
     return load_state_dict(model, ckpt)
 
@@ -61,6 +219,28 @@ def load_state_dict_from_url(model, url, **kwargs):
     return load_state_dict(model, state_dict)
 
 
+def state_dict_from_resource(resource: str):
+    """Loads the state dict of a resource without loading it to a model. See load_state_from_resource for the resource types"""
+    print(f"Using pretrained resource {resource}")
+
+    if resource.startswith('url::'):
+        url = resource.split('url::')[1]
+        return torch.hub.load_state_dict_from_url(url, map_location='cpu', progress=True)
+
+    elif resource.startswith('local::'):
+        path = resource.split('local::')[1]
+        if path.endswith(".safetensors"):
+            return load_mmap_checkpoint(path)
+        return torch.load(path, map_location='cpu')
+
+    elif resource.startswith('mmap::'):
+        path = resource.split('mmap::')[1]
+        return load_mmap_checkpoint(path)
+
+    else:
+        raise ValueError("Invalid resource type, only url::, local:: and mmap:: are supported")
+
+
 def load_state_from_resource(model, resource: str):
     """Loads weights to the model from a given resource. A resource can be of following types:
         1. URL. Prefixed with "url::"
@@ -68,6 +248,10 @@ def load_state_from_resource(model, resource: str):
 
         2. Local path. Prefixed with "local::"
                 e.g. local::/path/to/ckpt.pt
+            *.safetensors files are memory mapped
+
+        3. Memory mapped local file written by save_mmap_checkpoint (see convert_checkpoint.py). Prefixed with "mmap::"
+                e.g. mmap::/path/to/ckpt.safetensors
 
 
     Args:
@@ -77,16 +261,4 @@ def load_state_from_resource(model, resource: str):
     Returns:
         torch.nn.Module: Model with loaded weights
     """
-    print(f"Using pretrained resource {resource}")
-
-    if resource.startswith('url::'):
-        url = resource.split('url::')[1]
-        return load_state_dict_from_url(model, url, progress=True)
-
-    elif resource.startswith('local::'):
-        path = resource.split('local::')[1]
-        return load_wts(model, path)
-        
-    else:
-        raise ValueError("Invalid resource type, only url:: and local:: are supported")
-    
\ No newline at end of file
+    return load_state_dict(model, state_dict_from_resource(resource))
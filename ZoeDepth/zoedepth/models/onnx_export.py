@@ -0,0 +1,110 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""ONNX export of ZoeDepth models and an ONNX Runtime backend that serves infer / infer_pil from the exported graph.
+
+The graph covers the whole model, from the input image in [0, 1] to the metric depth at the MiDaS output resolution, at a fixed network
+resolution (the size MiDaS resizes inputs to) and a dynamic batch size. The resolution can't be dynamic: the relative position bias of
+the BEiT backbones and the head geometry are computed from the input size in python, so OnnxDepthModel letterboxes inputs of other
+aspect ratios: they are resized to fit the export resolution and padded, and the depth is cropped back, as in BucketedDepthModel. ZoeDepthNK is exported with both metric heads, the
+head of every image is selected in the graph (see ZoeDepthNK.forward, all_heads).
+
+    export_onnx(model, "zoed_n.onnx", size=(384, 512))
+    model = OnnxDepthModel("zoed_n.onnx")
+    depth = model.infer_pil(image)
+
+See export_onnx.py for validation against the PyTorch model and a CPU benchmark.
+"""
+
+import inspect
+
+import torch
+import torch.nn as nn
+
+from zoedepth.models.bucketing import pad_to_bucket
+from zoedepth.models.depth_model import DepthModel
+
+# torch >= 2.9 defaults to the torch.export based exporter, the model is exported with the TorchScript based one
+_EXPORT_KWARGS = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+
+
+class _ExportWrapper(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        # inputs are resized to the network resolution outside of the graph. all_heads is only used by ZoeDepthNK, ZoeDepth ignores it
+        return self.model(x, all_heads=True, do_resize=False)['metric_depth']
+
+
+def export_onnx(model, path, size=(384, 512), opset_version=17):
+    """Exports a ZoeDepth or ZoeDepthNK model to ONNX.
+
+    Args:
+        model (zoedepth.models.depth_model.DepthModel): model to export
+        path (str): output path
+        size (tuple, optional): network resolution (height, width), multiples of 32. Inputs of OnnxDepthModel are letterboxed to it.
+            Defaults to (384, 512), the resolution MiDaS uses for 4:3 images. Export one model per orientation to serve portrait
+            images at full resolution.
+        opset_version (int, optional): ONNX opset. Defaults to 17.
+    """
+    h, w = size
+    if h % 32 or w % 32:
+        raise ValueError(f"size must be a multiple of 32, got {size}")
+    model = model.eval()
+    x = torch.rand(1, 3, h, w, device=next(model.parameters()).device)
+    with torch.no_grad():
+        torch.onnx.export(_ExportWrapper(model), (x,), path, input_names=["image"], output_names=["metric_depth"],
+                          dynamic_axes={"image": {0: "batch"}, "metric_depth": {0: "batch"}}, opset_version=opset_version,
+                          **_EXPORT_KWARGS)
+
+
+class OnnxDepthModel(DepthModel):
+    def __init__(self, path, providers=("CPUExecutionProvider",), sess_options=None, padding_mode="reflect"):
+        """DepthModel that runs a model exported with export_onnx in ONNX Runtime. infer, infer_pil and infer_with_tta work as for the
+        PyTorch model, except for merge="confidence" which needs the output distribution.
+
+        Args:
+            path (str): exported model
+            providers (tuple, optional): ONNX Runtime execution providers. Defaults to ("CPUExecutionProvider",).
+            sess_options (onnxruntime.SessionOptions, optional): session options, e.g. the number of threads. Defaults to None.
+            padding_mode (str, optional): Padding of inputs whose aspect ratio differs from the export resolution. Defaults to "reflect".
+        """
+        super().__init__()
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(path, sess_options, providers=list(providers))
+        _, _, self.net_h, self.net_w = self.session.get_inputs()[0].shape
+        self.padding_mode = padding_mode
+
+    def network_size(self, h, w):
+        """Largest size with the aspect ratio of an (h, w) input that fits the export resolution"""
+        scale = min(self.net_h / h, self.net_w / w)
+        return max(1, round(h * scale)), max(1, round(w * scale))
+
+    def forward(self, x, return_final_centers=False, return_probs=False, **kwargs):
+        if return_final_centers or return_probs:
+            raise NotImplementedError("The exported model only returns the metric depth")
+        x, crop = pad_to_bucket(x, self.network_size(*x.shape[-2:]), (self.net_h, self.net_w), self.padding_mode)
+        out, = self.session.run(None, {"image": x.detach().cpu().float().numpy()})
+        return dict(metric_depth=crop(torch.from_numpy(out).to(x.device)))
@@ -0,0 +1,85 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Reduced precision inference, see DepthModel.set_precision.
+
+Weights of the large layers can be stored in half precision and upcast to float32 when a layer runs (store_weights_in), which halves
+their resident memory while the computation stays in float32. Weights stored in the dtype of an active autocast are used as they are.
+"""
+
+import torch
+import torch.nn as nn
+from torch.nn.utils import parametrize
+
+PRECISIONS = ("fp32", "bf16", "fp16-weights")
+
+WEIGHT_DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16}
+
+# layers that hold nearly all of the weights of ZoeDepth models
+WEIGHT_MODULES = (nn.Linear, nn.Conv2d, nn.ConvTranspose2d)
+
+
+def _autocast_dtype(device_type):
+    """dtype of the autocast active for device_type, None if autocast is disabled (or not supported, like on meta tensors)"""
+    if device_type not in ("cpu", "cuda"):
+        return None
+    if hasattr(torch, "get_autocast_dtype"):  # torch >= 2.4
+        return torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else None
+    if device_type == "cpu":
+        return torch.get_autocast_cpu_dtype() if torch.is_autocast_cpu_enabled() else None
+    return torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else None
+
+
+class Upcast(nn.Module):
+    """Parametrization that computes a float32 weight from a stored half precision one. Under an autocast to the stored dtype (bfloat16
+    weights with the "bf16" precision) the layer computes in that dtype anyway, so the weight is not upcast."""
+
+    def forward(self, weight):
+        if weight.dtype == _autocast_dtype(weight.device.type):
+            return weight
+        return weight.float()
+
+
+def store_weights_in(model, dtype=torch.float16, modules=WEIGHT_MODULES):
+    """Stores the weights (not the biases) of the given layer types of model in dtype. They are upcast to float32 every time a layer
+    uses them, so the outputs keep float32 precision apart from the rounding of the weights. The parametrized weights show up as
+    <layer>.parametrizations.weight.original in the state dict.
+
+    Returns:
+        model
+    """
+    for module in model.modules():
+        if isinstance(module, modules) and not parametrize.is_parametrized(module, "weight"):
+            parametrize.register_parametrization(module, "weight", Upcast())
+            original = module.parametrizations.weight.original
+            original.data = original.data.to(dtype)
+    return model
+
+
+def restore_weights(model):
+    """Undoes store_weights_in, the weights are converted back to float32 (with the rounding of dtype)"""
+    for module in model.modules():
+        if parametrize.is_parametrized(module, "weight") and isinstance(module.parametrizations.weight[0], Upcast):
+            original = module.parametrizations.weight.original
+            original.data = original.data.float()
+            parametrize.remove_parametrizations(module, "weight", leave_parametrized=False)
+    return model
@@ -0,0 +1,151 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Int8 quantization of ZoeDepth models for CPU inference.
+
+- The Linear layers of the MiDaS backbone (attention, MLP and readout projections) are quantized dynamically: int8 weights, activations are
+  quantized on the fly.
+- The 1x1 convs of the metric head are quantized statically: their activation ranges are calibrated on representative images. Each conv
+  (fused with a following ReLU) is wrapped with its own quantize/dequantize, the rest of the head stays in fp32.
+
+    model = build_model(config)
+    quantize_model(model, calibration_images)
+    save_quantized(model, "zoed_n_int8.pt", config)
+    model = load_quantized("zoed_n_int8.pt")
+
+See quantize.py for the command line workflow.
+"""
+
+import warnings
+
+import torch
+import torch.nn as nn
+from torch.ao import quantization as tq
+from PIL import Image
+
+from zoedepth.utils.easydict import EasyDict as edict
+
+
+def quantize_backbone_dynamic(model):
+    """Dynamically quantizes the nn.Linear layers of the MiDaS core of model to int8, in place"""
+    tq.quantize_dynamic(model.core, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def _head_convs(model):
+    """(parent, name) of every 1x1 conv outside the MiDaS core"""
+    for module_name, module in model.named_modules():
+        if module_name == "core" or module_name.startswith("core."):
+            continue
+        for name, child in module.named_children():
+            if isinstance(child, nn.Conv2d) and child.kernel_size == (1, 1):
+                yield module, name
+
+
+def prepare_head_static(model, backend=None):
+    """Wraps the 1x1 convs of the metric head for static quantization and attaches observers to them.
+
+    Returns:
+        list[torch.ao.quantization.QuantWrapper]: the wrapped convs, to be converted with convert_head_static after calibration
+    """
+    qconfig = tq.get_default_qconfig(backend or torch.backends.quantized.engine)
+    wrappers = []
+    for parent, name in list(_head_convs(model)):
+        conv = parent._modules[name]
+        if isinstance(parent, nn.Sequential) and name.isdigit() and int(name) + 1 < len(parent) and isinstance(parent[int(name) + 1], nn.ReLU):
+            # conv + relu run as one quantized op, the relu is replaced with an identity
+            tq.fuse_modules(parent, [[name, str(int(name) + 1)]], inplace=True)
+            conv = parent._modules[name]
+        wrapper = tq.QuantWrapper(conv)
+        wrapper.qconfig = qconfig
+        tq.prepare(wrapper, inplace=True)
+        parent._modules[name] = wrapper
+        wrappers.append(wrapper)
+    return wrappers
+
+
+def convert_head_static(wrappers):
+    for wrapper in wrappers:
+        tq.convert(wrapper, inplace=True)
+
+
+@torch.no_grad()
+def calibrate(model, images, **infer_kwargs):
+    """Runs images through the model to record the activation ranges of the observed layers.
+
+    Args:
+        model (zoedepth.models.depth_model.DepthModel): model prepared with prepare_head_static
+        images (iterable): PIL images (run through model.infer_pil) or image tensors of shape (b, 3, h, w) (run through model.infer)
+        **infer_kwargs: passed to infer_pil / infer, e.g. pad_input, with_flip_aug
+    """
+    model.eval()
+    for image in images:
+        if isinstance(image, Image.Image):
+            model.infer_pil(image, **infer_kwargs)
+        else:
+            model.infer(image.to(model.device), **infer_kwargs)
+
+
+def quantize_model(model, calibration_images, backend=None, **infer_kwargs):
+    """Quantizes model in place: dynamic int8 Linear layers in the backbone, static int8 1x1 convs in the head calibrated on
+    calibration_images (see calibrate). The model has to be on the CPU.
+
+    Args:
+        model (zoedepth.models.depth_model.DepthModel): ZoeDepth or ZoeDepthNK model
+        calibration_images (iterable): see calibrate
+        backend (str, optional): quantized engine, e.g. "fbgemm", "x86" or "qnnpack". Defaults to torch.backends.quantized.engine.
+
+    Returns:
+        model
+    """
+    if backend is not None:
+        torch.backends.quantized.engine = backend
+    model.eval()
+    quantize_backbone_dynamic(model)
+    wrappers = prepare_head_static(model, backend)
+    calibrate(model, calibration_images, **infer_kwargs)
+    convert_head_static(wrappers)
+    return model
+
+
+def save_quantized(model, path, config):
+    """Saves a quantized model with the config it was built from, see load_quantized"""
+    torch.save(dict(config=dict(config), backend=torch.backends.quantized.engine, state_dict=model.state_dict()), path)
+
+
+def load_quantized(path):
+    """Loads a model saved with save_quantized. The model is rebuilt from its config and quantized without calibration, the quantization
+    parameters then come from the saved state dict."""
+    from zoedepth.models.builder import build_model
+
+    artifact = torch.load(path, map_location="cpu")
+    torch.backends.quantized.engine = artifact["backend"]
+    config = edict({**artifact["config"], "pretrained_resource": None, "use_pretrained_midas": False})
+    model = build_model(config).eval()
+    quantize_backbone_dynamic(model)
+    wrappers = prepare_head_static(model, artifact["backend"])
+    with warnings.catch_warnings():
+        # the observers have not seen data, their placeholder quantization parameters are overwritten by the state dict
+        warnings.simplefilter("ignore")
+        convert_head_static(wrappers)
+    model.load_state_dict(artifact["state_dict"])
+    return model
@@ -0,0 +1,226 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Test-time augmentation with all views of an image run through a single forward pass."""
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class TTAView(object):
+    def __init__(self, flip=False, pad=None, scale=1.):
+        """A single test-time augmentation view of the input.
+
+        Args:
+            flip (bool, optional): Horizontally flip the input. Defaults to False.
+            pad (tuple(float, float), optional): (fh, fw) padding factors. Padding is computed as in DepthModel._infer_with_pad_aug, i.e. sqrt(h/2) * fh. Defaults to None (no padding).
+            scale (float, optional): Resize the input by this factor before padding. Note that the base model resizes its input to the network resolution,
+                                     so this only changes how the image is resampled. Defaults to 1.
+        """
+        if pad is not None:
+            assert pad[0] > 0 or pad[1] > 0, "atlease one of fh and fw must be greater than 0"
+        self.flip = flip
+        self.pad = pad
+        self.scale = scale
+
+    @staticmethod
+    def parse(spec):
+        """Parses a view from a string of '+' separated tokens: 'id', 'flip', 'pad', 'pad=fh,fw', 'scale=s'. e.g 'flip+pad' or 'scale=0.75+flip'"""
+        if isinstance(spec, TTAView):
+            return spec
+        view = TTAView()
+        for token in spec.split("+"):
+            name, _, value = token.strip().partition("=")
+            if name == "id":
+                continue
+            elif name == "flip":
+                view.flip = True
+            elif name == "pad":
+                view.pad = tuple(map(float, value.split(","))) if value else (3, 3)
+            elif name == "scale":
+                view.scale = float(value)
+            else:
+                raise ValueError(f"Unknown TTA view token '{token}' in '{spec}'")
+        return view
+
+    def padding(self, h, w):
+        """Padding (pad_h, pad_w) of an (h, w) input"""
+        if self.pad is None:
+            return 0, 0
+        fh, fw = self.pad
+        return int(np.sqrt(h/2) * fh), int(np.sqrt(w/2) * fw)
+
+    def apply(self, x, padding_mode="reflect", network_size=None, **pad_kwargs):
+        """Transforms the input (b, c, h, w). Returns the transformed input and the padding (pad_h, pad_w) needed to invert it.
+        pad_kwargs are passed to F.pad, e.g. value for padding_mode="constant", and take precedence over padding_mode.
+
+        With network_size, a function mapping an input size (h, w) to the size the model resizes it to, the input is resized first and
+        padded at the network resolution: the result has the size the model resizes the padded input to, with the padding scaled to it,
+        so no padded copy of a large input is made and the model does not resize again.
+        """
+        h, w = x.shape[-2:]
+        if self.scale != 1:
+            if network_size is None:
+                x = F.interpolate(x, scale_factor=self.scale, mode='bilinear', align_corners=False)
+            h, w = int(h * self.scale), int(w * self.scale)
+        pad_h, pad_w = self.padding(h, w)
+        if network_size is not None:
+            net_h, net_w = network_size(h + 2 * pad_h, w + 2 * pad_w)
+            pad_h, pad_w = round(pad_h * net_h / (h + 2 * pad_h)), round(pad_w * net_w / (w + 2 * pad_w))
+            # same resize as PrepForMidas
+            x = F.interpolate(x, (net_h - 2 * pad_h, net_w - 2 * pad_w), mode='bilinear', align_corners=True)
+        if pad_h > 0 or pad_w > 0:
+            padding = [pad_w, pad_w]
+            if pad_h > 0:
+                padding += [pad_h, pad_h]
+            x = F.pad(x, padding, **{"mode": padding_mode, **pad_kwargs})
+        if self.flip:
+            x = torch.flip(x, dims=[3])
+        return x, (pad_h, pad_w)
+
+    def invert(self, out, view_size, padding, size, upsampling_mode='bicubic', crop_at_output_resolution=False):
+        """Maps a prediction for the transformed input back to the original view.
+
+        Args:
+            out (torch.Tensor): prediction of shape (b, 1, h', w')
+            view_size (tuple): (h, w) of the transformed input
+            padding (tuple): (pad_h, pad_w) as returned by apply
+            size (tuple): (h, w) to resize the result to, usually that of the original input. None keeps the resolution of the prediction.
+            crop_at_output_resolution (bool, optional): Crop the padding from the prediction at its own resolution, so that it is upsampled
+                only once, to size. Otherwise it is upsampled to view_size first. Defaults to False.
+        """
+        pad_h, pad_w = padding
+        if crop_at_output_resolution:
+            # padding in the resolution of the prediction
+            pad_h, pad_w = round(pad_h * out.shape[-2] / view_size[0]), round(pad_w * out.shape[-1] / view_size[1])
+        elif out.shape[-2:] != view_size:
+            out = F.interpolate(out, size=view_size, mode=upsampling_mode, align_corners=False)
+        if self.flip:
+            out = torch.flip(out, dims=[3])
+        if pad_h > 0:
+            out = out[:, :, pad_h:-pad_h, :]
+        if pad_w > 0:
+            out = out[:, :, :, pad_w:-pad_w]
+        if size is not None and tuple(out.shape[-2:]) != tuple(size):
+            out = F.interpolate(out, size=size, mode=upsampling_mode, align_corners=False)
+        return out
+
+    def __repr__(self):
+        return f"TTAView(flip={self.flip}, pad={self.pad}, scale={self.scale})"
+
+
+def run_views(forward_fn, x, views, padding_mode="reflect", upsampling_mode='bicubic', network_size=None, output_size=None, pad_kwargs=None):
+    """Runs all views through forward_fn, stacking views of equal shape along the batch dimension so that they share a single forward pass.
+
+    Args:
+        forward_fn (Callable): maps a batch (B, c, h, w) to a tensor (B, 1, h', w') or to a tuple of such tensors
+        x (torch.Tensor): input of shape (b, c, h, w)
+        views (List[TTAView]): views to run
+        network_size (Callable, optional): maps an input size (h, w) to the size the model resizes it to. If given, views are resized
+            first and padded at the network resolution, and their outputs are cropped at the output resolution, see TTAView.apply.
+        output_size (tuple or str, optional): (h, w) of the outputs, or "network" to keep the resolution of the predictions (that of the
+            first view if views differ). If given, outputs are cropped at the output resolution and resized once, or not at all.
+            Defaults to None (size of the input).
+        pad_kwargs (dict, optional): passed to F.pad when padding the views, see TTAView.apply. Defaults to None.
+
+    Returns:
+        List[tuple(torch.Tensor)]: for every view, the outputs of forward_fn mapped back to the original view, each of shape (b, 1, h, w)
+    """
+    return run_views_many(forward_fn, [x], views, padding_mode=padding_mode, upsampling_mode=upsampling_mode, network_size=network_size,
+                          output_sizes=[output_size], pad_kwargs=pad_kwargs)[0]
+
+
+def run_views_many(forward_fn, xs, views, padding_mode="reflect", upsampling_mode='bicubic', network_size=None, output_sizes=None,
+                   pad_kwargs=None):
+    """run_views for several inputs of different sizes. The views of all inputs are stacked by transformed shape, so with network_size,
+    inputs that the model resizes to the same resolution (e.g. photos of the same aspect ratio) share forward passes.
+
+    Args:
+        xs (List[torch.Tensor]): inputs of shape (b_i, c, h_i, w_i)
+        output_sizes (list, optional): output_size of every input, see run_views. Defaults to None (size of every input).
+        forward_fn, views, padding_mode, upsampling_mode, network_size, pad_kwargs: see run_views
+
+    Returns:
+        List[List[tuple(torch.Tensor)]]: for every input, the outputs of every view as returned by run_views
+    """
+    output_sizes = [None] * len(xs) if output_sizes is None else output_sizes
+    transformed = {}  # (input, view) -> (transformed input, padding)
+    groups = {}
+    for i, x in enumerate(xs):
+        for j, view in enumerate(views):
+            transformed[i, j] = view.apply(x, padding_mode=padding_mode, network_size=network_size, **(pad_kwargs or {}))
+            # group views by transformed shape
+            groups.setdefault(tuple(transformed[i, j][0].shape[-2:]), []).append((i, j))
+
+    results = [[None] * len(views) for _ in xs]
+    for view_size, idxs in groups.items():
+        batch = torch.cat([transformed[k][0] for k in idxs], dim=0) if len(idxs) > 1 else transformed[idxs[0]][0]
+        outs = forward_fn(batch)
+        if isinstance(outs, torch.Tensor):
+            outs = (outs,)
+        start = 0
+        for i, j in idxs:
+            (xv, padding), b = transformed[i, j], xs[i].shape[0]
+            size = tuple(xs[i].shape[-2:]) if output_sizes[i] is None else output_sizes[i]
+            crop_at_output_resolution = network_size is not None or output_sizes[i] is not None
+            results[i][j] = tuple(views[j].invert(o[start:start + b], view_size, padding, None if size == "network" else size,
+                                                  upsampling_mode=upsampling_mode, crop_at_output_resolution=crop_at_output_resolution)
+                                  for o in outs)
+            start += b
+
+    for i, output_size in enumerate(output_sizes):
+        if output_size == "network":
+            # views of different scale or padding have predictions of different sizes, they are resized to that of the first view
+            size = tuple(results[i][0][0].shape[-2:])
+            results[i] = [tuple(t if tuple(t.shape[-2:]) == size else F.interpolate(t, size=size, mode=upsampling_mode, align_corners=False)
+                                for t in r) for r in results[i]]
+    return results
+
+
+def merge_views(preds, merge="mean", stds=None, eps=1e-6):
+    """Merges per-view predictions
+
+    Args:
+        preds (List[torch.Tensor]): per-view predictions of shape (b, 1, h, w)
+        merge (str, optional): "mean", "median" or "confidence". Defaults to "mean".
+        stds (List[torch.Tensor], optional): per-view predictive standard deviations, required for "confidence". Defaults to None.
+
+    Returns:
+        torch.Tensor: merged prediction of shape (b, 1, h, w)
+    """
+    if len(preds) == 1:
+        return preds[0]
+    if merge == "mean":
+        return sum(preds) / len(preds)
+    elif merge == "median":
+        stacked = torch.stack(preds).sort(dim=0).values
+        k = len(preds) // 2
+        if len(preds) % 2:
+            return stacked[k]
+        return (stacked[k - 1] + stacked[k]) / 2
+    elif merge == "confidence":
+        assert stds is not None, "confidence weighted merge requires per-view standard deviations"
+        weights = [1. / (s + eps) for s in stds]
+        return sum(w * p for w, p in zip(weights, preds)) / sum(weights)
+    else:
+        raise ValueError(f"merge {merge} not supported. Supported values are 'mean', 'median' and 'confidence'")
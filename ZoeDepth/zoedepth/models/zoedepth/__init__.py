@@ -23,6 +23,7 @@
 # File author: Shariq Farooq Bhat
 
 from .zoedepth_v1 import ZoeDepth 
+from .zoedepth_multihead import ZoeDepthMultiHead
 
 all_versions = {
     "v1": ZoeDepth,
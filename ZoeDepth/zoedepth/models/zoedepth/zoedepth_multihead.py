@@ -0,0 +1,157 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from zoedepth.models.depth_model import DepthModel
+from zoedepth.models.model_io import init_empty_weights, load_state_dict, state_dict_from_resource
+from zoedepth.models.zoedepth.zoedepth_v1 import ZoeDepth
+
+
+class ZoeDepthMultiHead(DepthModel):
+    def __init__(self, core, heads):
+        """ZoeDepth metric heads of several models on one shared MiDaS core, e.g. the NYU and KITTI heads of ZoeD_N and ZoeD_K.
+        The core runs once per forward pass and every head runs on its features.
+
+        The metric depth of all heads is returned as the channels of one tensor, in the order of heads, so infer, infer_pil and
+        infer_with_tta work as for a single model and return (b, len(heads), h, w) tensors (numpy arrays of shape (len(heads), h, w) from
+        infer_pil, or of one head with infer_pil(..., head=name)). Use split_heads to get them by name.
+
+        Args:
+            core (models.base_models.midas.MidasCore): The shared MiDaS core
+            heads (dict): name -> ZoeDepth. Their own cores are dropped, only their metric heads are used.
+        """
+        super().__init__()
+        self.core = core
+        for head in heads.values():
+            # the head runs on the shared core, its own must not be part of this model's parameters and state_dict
+            head._modules.pop('core', None)
+        self.heads = nn.ModuleDict(heads)
+
+    @property
+    def head_names(self):
+        return list(self.heads.keys())
+
+    def split_heads(self, depth):
+        """Maps the channels of a (b, len(heads), h, w) prediction (or (len(heads), h, w), as returned by infer_pil) to the head names"""
+        return {name: depth[..., i, :, :] for i, name in enumerate(self.head_names)}
+
+    def forward(self, x, return_final_centers=False, denorm=False, return_probs=False, do_resize=True, **kwargs):
+        """
+        Args:
+            x (torch.Tensor): Input image tensor of shape (B, C, H, W)
+            return_final_centers (bool, optional): Whether to return the final bin centers of every head. Defaults to False.
+            denorm (bool, optional): Whether to denormalize the input image. Defaults to False.
+            return_probs (bool, optional): Whether to return the output probability distribution of every head. Defaults to False.
+            do_resize (bool, optional): Whether to resize the input to the MiDaS input resolution. Defaults to True.
+
+        Returns:
+            dict: Dictionary containing the following keys:
+                - metric_depth (torch.Tensor): Metric depth maps of all heads of shape (B, len(heads), H, W)
+                - bin_centers_{name} (torch.Tensor): Bin centers of head name. Present only if return_final_centers or return_probs is True
+                - probs_{name} (torch.Tensor): Output probability distribution of head name. Present only if return_probs is True
+        """
+        rel_depth, out = self.core(x, denorm=denorm, return_rel_depth=True, do_resize=do_resize)
+        outputs = {name: head._metric_head(rel_depth, out, return_final_centers, return_probs) for name, head in self.heads.items()}
+
+        output = dict(metric_depth=torch.cat([o['metric_depth'] for o in outputs.values()], dim=1))
+        for name, o in outputs.items():
+            output.update({f"{k}_{name}": v for k, v in o.items() if k != 'metric_depth'})
+        return output
+
+    def infer_pil(self, pil_img, pad_input: bool=True, with_flip_aug: bool=True, output_type: str="numpy", head=None, **kwargs):
+        """Same as DepthModel.infer_pil, returns the depth of every head as (len(heads), h, w), or of head only as (h, w).
+        A 'pil' depth image holds a single depth map, so output_type="pil" requires head.
+        """
+        if output_type not in ("numpy", "pil", "tensor"):
+            raise ValueError(f"output_type {output_type} not supported. Supported values are 'numpy', 'pil' and 'tensor'")
+        if head is None:
+            if output_type == "pil":
+                raise ValueError(f"output_type 'pil' needs the head to return, one of {self.head_names}")
+            return super().infer_pil(pil_img, pad_input=pad_input, with_flip_aug=with_flip_aug, output_type=output_type, **kwargs)
+        if head not in self.heads:
+            raise ValueError(f"Unknown head {head}, expected one of {self.head_names}")
+
+        depth = super().infer_pil(pil_img, pad_input=pad_input, with_flip_aug=with_flip_aug, output_type="tensor", **kwargs)
+        depth = depth[self.head_names.index(head)]
+        if output_type == "tensor":
+            return depth
+        if output_type == "numpy":
+            return depth.numpy()
+        # uint16 is required for depth pil image
+        return Image.fromarray((depth.numpy() * 256).astype(np.uint16))
+
+    def _infer_with_confidence(self, x: torch.Tensor):
+        """Depth and predictive standard deviation of every head, both of shape (b, len(heads), h, w). See DepthModel._infer_with_confidence"""
+        out = self(x, return_probs=True)
+        depth = out['metric_depth']
+        stds = [torch.sqrt(torch.sum(out[f'probs_{name}'] * (out[f'bin_centers_{name}'] - depth[:, i:i+1]) ** 2, dim=1, keepdim=True))
+                for i, name in enumerate(self.head_names)]
+        return depth, torch.cat(stds, dim=1)
+
+    def optimize_for_inference(self):
+        """See ZoeDepth.optimize_for_inference"""
+        self.eval()
+        self.core.optimize_for_inference()
+        for head in self.heads.values():
+            head._optimize_head_for_inference()
+        return self
+
+    @staticmethod
+    def build(head_configs, core_head=None, weights_dtype=None):
+        """Builds the model from the configs of single head ZoeDepth models (as returned by get_config("zoedepth", ...)).
+
+        The core, and its head, are built and loaded as ZoeDepth.build does from the config of core_head. The other heads load only the head
+        weights of their pretrained_resource: the core of those checkpoints is never assigned to the model (and never read from an mmap
+        checkpoint). Note that the cores of ZoeD_N and ZoeD_K were fine-tuned with their heads, so the heads other than core_head run on
+        features they were not trained with and the core runs at the resolution of core_head. Compare with the single models (see
+        evaluate.py) before relying on them. ZoeD_NK was trained with a shared core.
+
+        Args:
+            head_configs (dict): name -> config of a single head ZoeDepth model
+            core_head (str, optional): name of the head whose checkpoint provides the core. Defaults to None (the first head).
+            weights_dtype (str, optional): see ZoeDepth.build. Defaults to None.
+        """
+        core_head = core_head or next(iter(head_configs))
+        model = ZoeDepth.build(**{**head_configs[core_head], "weights_dtype": weights_dtype})
+        heads = {}
+        for name, config in head_configs.items():
+            if name == core_head:
+                heads[name] = model
+                continue
+            resource = config.get("pretrained_resource")
+            with init_empty_weights(enabled=bool(resource)):
+                head = ZoeDepth(model.core, **config)
+            # only the head is loaded
+            del head.core
+            if weights_dtype is not None:
+                head.set_weights_dtype(weights_dtype)
+            if resource:
+                state = state_dict_from_resource(resource)
+                state = state.get('model', state)
+                load_state_dict(head, {k: v for k, v in state.items() if not k.startswith(('core.', 'module.core.'))})
+            heads[name] = head
+        multi_head = ZoeDepthMultiHead(model.core, heads)
+        multi_head.weights_dtype = weights_dtype
+        return multi_head
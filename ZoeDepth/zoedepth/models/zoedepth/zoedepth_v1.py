@@ -30,15 +30,16 @@ from zoedepth.models.depth_model import DepthModel
 from zoedepth.models.base_models.midas import MidasCore
 from zoedepth.models.layers.attractor import AttractorLayer, AttractorLayerUnnormed
 from zoedepth.models.layers.dist_layers import ConditionalLogBinomial
+from zoedepth.models.layers.fusion import concat_convs, fold_pointwise_conv
 from zoedepth.models.layers.localbins_layers import (Projector, SeedBinRegressor,
                                             SeedBinRegressorUnnormed)
-from zoedepth.models.model_io import load_state_from_resource
+from zoedepth.models.model_io import init_empty_weights, load_state_from_resource
 
 
 class ZoeDepth(DepthModel):
     def __init__(self, core,  n_bins=64, bin_centers_type="softplus", bin_embedding_dim=128, min_depth=1e-3, max_depth=10,
-                 n_attractors=[16, 8, 4, 1], attractor_alpha=300, attractor_gamma=2, attractor_kind='sum', attractor_type='exp', min_temp=5, max_temp=50, train_midas=True,
-                 midas_lr_factor=10, encoder_lr_factor=10, pos_enc_lr_factor=10, inverse_midas=False, **kwargs):
+                 n_attractors=[16, 8, 4, 1], attractor_alpha=300, attractor_gamma=2, attractor_kind='sum', attractor_type='exp', attractor_chunk_size=None, min_temp=5, max_temp=50, train_midas=True,
+                 midas_lr_factor=10, encoder_lr_factor=10, pos_enc_lr_factor=10, inverse_midas=False, head_resolution=None, **kwargs):
         """ZoeDepth model. This is the version of ZoeDepth that has a single metric head
 
         Args:
@@ -54,12 +55,15 @@ class ZoeDepth(DepthModel):
             attractor_gamma (int, optional): Exponential attractor strength. Refer to models.layers.attractor for more details. Defaults to 2.
             attractor_kind (str, optional): Attraction aggregation "sum" or "mean". Defaults to 'sum'.
             attractor_type (str, optional): Type of attractor to use; "inv" (Inverse attractor) or "exp" (Exponential attractor). Defaults to 'exp'.
+            attractor_chunk_size (int, optional): Number of attractors whose shifts are computed at once. Refer to models.layers.attractor.attractor_shift for more details. Defaults to None.
             min_temp (int, optional): Lower bound for temperature of output probability distribution. Defaults to 5.
             max_temp (int, optional): Upper bound for temperature of output probability distribution. Defaults to 50.
             train_midas (bool, optional): Whether to train "core", the base midas model. Defaults to True.
             midas_lr_factor (int, optional): Learning rate reduction factor for base midas model except its encoder and positional encodings. Defaults to 10.
             encoder_lr_factor (int, optional): Learning rate reduction factor for the encoder in midas model. Defaults to 10.
             pos_enc_lr_factor (int, optional): Learning rate reduction factor for positional encodings in the base midas model. Defaults to 10.
+            head_resolution (float, optional): Resolution of the final metric head (conditional log binomial) as a fraction of the MiDaS output resolution, in (0, 1].
+                                               0.5 is the resolution of the finest decoder level, where bin centers and embeddings need no upsampling. Defaults to None (1).
         """
         super().__init__()
 
@@ -74,6 +78,9 @@ class ZoeDepth(DepthModel):
         self.pos_enc_lr_factor = pos_enc_lr_factor
         self.train_midas = train_midas
         self.inverse_midas = inverse_midas
+        if head_resolution is not None and not 0 < head_resolution <= 1:
+            raise ValueError(f"head_resolution should be in (0, 1], got {head_resolution}")
+        self.head_resolution = head_resolution
 
         if self.encoder_lr_factor <= 0:
             self.core.freeze_encoder(
@@ -85,6 +92,7 @@ class ZoeDepth(DepthModel):
 
         self.conv2 = nn.Conv2d(btlnck_features, btlnck_features,
                                kernel_size=1, stride=1, padding=0)  # btlnck conv
+        self.conv2_split = None  # output name -> channels of conv2, see optimize_for_inference
 
         if bin_centers_type == "normed":
             SeedBinRegressorLayer = SeedBinRegressor
@@ -111,7 +119,8 @@ class ZoeDepth(DepthModel):
         ])
         self.attractors = nn.ModuleList([
             Attractor(bin_embedding_dim, n_bins, n_attractors=n_attractors[i], min_depth=min_depth, max_depth=max_depth,
-                      alpha=attractor_alpha, gamma=attractor_gamma, kind=attractor_kind, attractor_type=attractor_type)
+                      alpha=attractor_alpha, gamma=attractor_gamma, kind=attractor_kind, attractor_type=attractor_type,
+                      chunk_size=attractor_chunk_size)
             for i in range(len(num_out_features))
         ])
 
@@ -121,13 +130,14 @@ class ZoeDepth(DepthModel):
         self.conditional_log_binomial = ConditionalLogBinomial(
             last_in, bin_embedding_dim, n_classes=n_bins, min_temp=min_temp, max_temp=max_temp)
 
-    def forward(self, x, return_final_centers=False, denorm=False, return_probs=False, **kwargs):
+    def forward(self, x, return_final_centers=False, denorm=False, return_probs=False, do_resize=True, **kwargs):
         """
         Args:
             x (torch.Tensor): Input image tensor of shape (B, C, H, W)
             return_final_centers (bool, optional): Whether to return the final bin centers. Defaults to False.
             denorm (bool, optional): Whether to denormalize the input image. This reverses ImageNet normalization as midas normalization is different. Defaults to False.
             return_probs (bool, optional): Whether to return the output probability distribution. Defaults to False.
+            do_resize (bool, optional): Whether to resize the input to the MiDaS input resolution. If False, x must already be at the network resolution. Defaults to True.
         
         Returns:
             dict: Dictionary containing the following keys:
@@ -139,18 +149,21 @@ class ZoeDepth(DepthModel):
         """
         b, c, h, w = x.shape
         # print("input shape ", x.shape)
-        self.orig_input_width = w
-        self.orig_input_height = h
-        rel_depth, out = self.core(x, denorm=denorm, return_rel_depth=True)
+        rel_depth, out = self.core(x, denorm=denorm, return_rel_depth=True, do_resize=do_resize)
         # print("output shapes", rel_depth.shape, out.shape)
+        return self._metric_head(rel_depth, out, return_final_centers, return_probs)
 
+    def _metric_head(self, rel_depth, out, return_final_centers=False, return_probs=False):
+        """Runs the metric head on the relative depth and the features returned by the MiDaS core. Returns the output dict of forward"""
         outconv_activation = out[0]
         btlnck = out[1]
         x_blocks = out[2:]
 
         x_d0 = self.conv2(btlnck)
         x = x_d0
-        _, seed_b_centers = self.seed_bin_regressor(x)
+        # after optimize_for_inference, conv2 also computes the first layers of the seed bin regressor and projector
+        xs = dict(zip(self.conv2_split, torch.split(x, list(self.conv2_split.values()), dim=1))) if self.conv2_split else {}
+        _, seed_b_centers = self.seed_bin_regressor(xs.get('seed_bin_regressor', x))
 
         if self.bin_centers_type == 'normed' or self.bin_centers_type == 'hybrid2':
             b_prev = (seed_b_centers - self.min_depth) / \
@@ -158,7 +171,7 @@ class ZoeDepth(DepthModel):
         else:
             b_prev = seed_b_centers
 
-        prev_b_embedding = self.seed_projector(x)
+        prev_b_embedding = self.seed_projector(xs.get('seed_projector', x))
 
         # unroll this loop for better performance
         for projector, attractor, x in zip(self.projectors, self.attractors, x_blocks):
@@ -169,6 +182,9 @@ class ZoeDepth(DepthModel):
             prev_b_embedding = b_embedding.clone()
 
         last = outconv_activation
+        if self.head_resolution is not None and self.head_resolution < 1:
+            # the metric head works at a lower resolution, only the final single channel depth is upsampled (by infer)
+            last = nn.functional.adaptive_avg_pool2d(last, [max(1, round(d * self.head_resolution)) for d in last.shape[-2:]])
 
         if self.inverse_midas:
             # invert depth followed by normalization
@@ -181,14 +197,23 @@ class ZoeDepth(DepthModel):
             rel_cond, size=last.shape[2:], mode='bilinear', align_corners=True)
         last = torch.cat([last, rel_cond], dim=1)
 
-        b_embedding = nn.functional.interpolate(
-            b_embedding, last.shape[-2:], mode='bilinear', align_corners=True)
+        if b_embedding.shape[-2:] != last.shape[-2:]:
+            b_embedding = nn.functional.interpolate(
+                b_embedding, last.shape[-2:], mode='bilinear', align_corners=True)
+
+        if not (return_final_centers or return_probs or torch.is_grad_enabled()) and \
+                self.conditional_log_binomial.log_binomial_transform.act is torch.softmax:
+            # Expected depth streamed over the bins, the probabilities and upsampled bin centers are never materialized
+            out = self.conditional_log_binomial.expected_value(last, b_embedding, b_centers)
+            return dict(metric_depth=out)
+
         x = self.conditional_log_binomial(last, b_embedding)
 
         # Now depth value is Sum px * cx , where cx are bin_centers from the last bin tensor
         # print(x.shape, b_centers.shape)
-        b_centers = nn.functional.interpolate(
-            b_centers, x.shape[-2:], mode='bilinear', align_corners=True)
+        if b_centers.shape[-2:] != x.shape[-2:]:
+            b_centers = nn.functional.interpolate(
+                b_centers, x.shape[-2:], mode='bilinear', align_corners=True)
         out = torch.sum(x * b_centers, dim=1, keepdim=True)
 
         # Structure output dict
@@ -201,6 +226,34 @@ class ZoeDepth(DepthModel):
 
         return output
 
+    def optimize_for_inference(self):
+        """Rewrites the model into an equivalent one that is faster at inference. The result is for inference only: its state_dict
+        differs from the checkpoint format and it can't be trained.
+
+        - conv2 (1x1, linear) is folded into the first convs of the seed bin regressor and the seed projector, which are concatenated
+          into one wide conv that replaces conv2
+        - BatchNorm layers of the MiDaS decoder are folded into the preceding convs
+        - log binomial coefficients of the output distribution are precomputed
+
+        Returns:
+            ZoeDepth: self
+        """
+        self.eval()
+        self.core.optimize_for_inference()
+        return self._optimize_head_for_inference()
+
+    def _optimize_head_for_inference(self):
+        """optimize_for_inference for the layers of the metric head only"""
+        stems = dict(seed_bin_regressor=self.seed_bin_regressor._net, seed_projector=self.seed_projector._net)
+        fused = {name: fold_pointwise_conv(self.conv2, net[0]) for name, net in stems.items()}
+        self.conv2 = concat_convs(list(fused.values()))
+        self.conv2_split = {name: conv.out_channels for name, conv in fused.items()}
+        for net in stems.values():
+            del net[0]
+            net[0].inplace = False  # the input is a view of the output of conv2
+        self.conditional_log_binomial.log_binomial_transform.precompute()
+        return self
+
     def get_lr_params(self, lr):
         """
         Learning rate configuration for different layers of the model
@@ -236,10 +289,17 @@ class ZoeDepth(DepthModel):
         return param_conf
 
     @staticmethod
-    def build(midas_model_type="DPT_BEiT_L_384", pretrained_resource=None, use_pretrained_midas=False, train_midas=False, freeze_midas_bn=True, **kwargs):
-        core = MidasCore.build(midas_model_type=midas_model_type, use_pretrained_midas=use_pretrained_midas,
-                               train_midas=train_midas, fetch_features=True, freeze_bn=freeze_midas_bn, **kwargs)
-        model = ZoeDepth(core, **kwargs)
+    def build(midas_model_type="DPT_BEiT_L_384", pretrained_resource=None, use_pretrained_midas=False, train_midas=False, freeze_midas_bn=True, meta_init=False, weights_dtype=None, **kwargs):
+        # With meta_init, parameters are not allocated or initialized but taken over from the checkpoint. This needs a checkpoint with all weights.
+        # With weights_dtype ("float16" or "bfloat16"), the weights of the linear and conv layers are kept in half precision, see DepthModel.set_weights_dtype.
+        # They are converted while loading, one tensor at a time, and taken over without a copy from an mmap checkpoint already in that dtype.
+        meta_init = meta_init and bool(pretrained_resource) and not use_pretrained_midas
+        with init_empty_weights(enabled=meta_init):
+            core = MidasCore.build(midas_model_type=midas_model_type, use_pretrained_midas=use_pretrained_midas,
+                                   train_midas=train_midas, fetch_features=True, freeze_bn=freeze_midas_bn, **kwargs)
+            model = ZoeDepth(core, **kwargs)
+        if weights_dtype is not None:
+            model.set_weights_dtype(weights_dtype)
         if pretrained_resource:
             assert isinstance(pretrained_resource, str), "pretrained_resource must be a string"
             model = load_state_from_resource(model, pretrained_resource)
@@ -31,18 +31,19 @@ from zoedepth.models.depth_model import DepthModel
 from zoedepth.models.base_models.midas import MidasCore
 from zoedepth.models.layers.attractor import AttractorLayer, AttractorLayerUnnormed
 from zoedepth.models.layers.dist_layers import ConditionalLogBinomial
+from zoedepth.models.layers.fusion import concat_convs, fold_pointwise_conv
 from zoedepth.models.layers.localbins_layers import (Projector, SeedBinRegressor,
                                             SeedBinRegressorUnnormed)
 from zoedepth.models.layers.patch_transformer import PatchTransformerEncoder
-from zoedepth.models.model_io import load_state_from_resource
+from zoedepth.models.model_io import init_empty_weights, load_state_from_resource
 
 
 class ZoeDepthNK(DepthModel):
     def __init__(self, core,  bin_conf, bin_centers_type="softplus", bin_embedding_dim=128,
-                 n_attractors=[16, 8, 4, 1], attractor_alpha=300, attractor_gamma=2, attractor_kind='sum', attractor_type='exp',
+                 n_attractors=[16, 8, 4, 1], attractor_alpha=300, attractor_gamma=2, attractor_kind='sum', attractor_type='exp', attractor_chunk_size=None,
                  min_temp=5, max_temp=50,
                  memory_efficient=False, train_midas=True,
-                 is_midas_pretrained=True, midas_lr_factor=1, encoder_lr_factor=10, pos_enc_lr_factor=10, inverse_midas=False,  **kwargs):
+                 is_midas_pretrained=True, midas_lr_factor=1, encoder_lr_factor=10, pos_enc_lr_factor=10, inverse_midas=False, head_resolution=None,  **kwargs):
         """ZoeDepthNK model. This is the version of ZoeDepth that has two metric heads and uses a learned router to route to experts.
 
         Args:
@@ -61,6 +62,7 @@ class ZoeDepthNK(DepthModel):
             attractor_gamma (int, optional): Exponential attractor strength. Refer to models.layers.attractor for more details. Defaults to 2.
             attractor_kind (str, optional): Attraction aggregation "sum" or "mean". Defaults to 'sum'.
             attractor_type (str, optional): Type of attractor to use; "inv" (Inverse attractor) or "exp" (Exponential attractor). Defaults to 'exp'.
+            attractor_chunk_size (int, optional): Number of attractors whose shifts are computed at once. Refer to models.layers.attractor.attractor_shift for more details. Defaults to None.
 
             min_temp (int, optional): Lower bound for temperature of output probability distribution. Defaults to 5.
             max_temp (int, optional): Upper bound for temperature of output probability distribution. Defaults to 50.
@@ -72,6 +74,8 @@ class ZoeDepthNK(DepthModel):
             midas_lr_factor (int, optional): Learning rate reduction factor for base midas model except its encoder and positional encodings. Defaults to 10.
             encoder_lr_factor (int, optional): Learning rate reduction factor for the encoder in midas model. Defaults to 10.
             pos_enc_lr_factor (int, optional): Learning rate reduction factor for positional encodings in the base midas model. Defaults to 10.
+            head_resolution (float, optional): Resolution of the final metric head (conditional log binomial) as a fraction of the MiDaS output resolution, in (0, 1].
+                                               0.5 is the resolution of the finest decoder level, where bin centers and embeddings need no upsampling. Defaults to None (1).
 
         """
 
@@ -88,6 +92,9 @@ class ZoeDepthNK(DepthModel):
         self.encoder_lr_factor = encoder_lr_factor
         self.pos_enc_lr_factor = pos_enc_lr_factor
         self.inverse_midas = inverse_midas
+        if head_resolution is not None and not 0 < head_resolution <= 1:
+            raise ValueError(f"head_resolution should be in (0, 1], got {head_resolution}")
+        self.head_resolution = head_resolution
 
         N_MIDAS_OUT = 32
         btlnck_features = self.core.output_channels[0]
@@ -96,6 +103,7 @@ class ZoeDepthNK(DepthModel):
 
         self.conv2 = nn.Conv2d(
             btlnck_features, btlnck_features, kernel_size=1, stride=1, padding=0)
+        self.conv2_split = None  # output name -> channels of conv2, see optimize_for_inference
 
         # Transformer classifier on the bottleneck
         self.patch_transformer = PatchTransformerEncoder(
@@ -142,7 +150,7 @@ class ZoeDepthNK(DepthModel):
                 Attractor(bin_embedding_dim, n_attractors[i],
                           mlp_dim=bin_embedding_dim, alpha=attractor_alpha,
                           gamma=attractor_gamma, kind=attractor_kind,
-                          attractor_type=attractor_type, memory_efficient=memory_efficient,
+                          attractor_type=attractor_type, memory_efficient=memory_efficient, chunk_size=attractor_chunk_size,
                           min_depth=conf["min_depth"], max_depth=conf["max_depth"])
                 for i in range(len(n_attractors))
             ])
@@ -156,13 +164,18 @@ class ZoeDepthNK(DepthModel):
              for conf in bin_conf}
         )
 
-    def forward(self, x, return_final_centers=False, denorm=False, return_probs=False, **kwargs):
+    def forward(self, x, return_final_centers=False, denorm=False, return_probs=False, all_heads=False, do_resize=True, **kwargs):
         """
         Args:
-            x (torch.Tensor): Input image tensor of shape (B, C, H, W). Assumes all images are from the same domain.
+            x (torch.Tensor): Input image tensor of shape (B, C, H, W). Every image is routed to the metric head of its own predicted domain.
             return_final_centers (bool, optional): Whether to return the final centers of the attractors. Defaults to False.
             denorm (bool, optional): Whether to denormalize the input image. Defaults to False.
             return_probs (bool, optional): Whether to return the probabilities of the bins. Defaults to False.
+            all_heads (bool, optional): Whether to run every metric head on the whole batch and select the output of each image's head on the
+                device, instead of running every head only on the images routed to it. Avoids the host sync of the routing, which makes the
+                forward pass traceable (see zoedepth.models.onnx_export). Can't be combined with return_final_centers or return_probs. Defaults to False.
+            do_resize (bool, optional): Whether to resize the input to the MiDaS input resolution. If False, x must already be at the
+                network resolution. Defaults to True.
         
         Returns:
             dict: Dictionary of outputs with keys:
@@ -173,9 +186,7 @@ class ZoeDepthNK(DepthModel):
                 - "probs": Bin probabilities of shape (B, N, H, W). Present only if return_probs is True
         """
         b, c, h, w = x.shape
-        self.orig_input_width = w
-        self.orig_input_height = h
-        rel_depth, out = self.core(x, denorm=denorm, return_rel_depth=True)
+        rel_depth, out = self.core(x, denorm=denorm, return_rel_depth=True, do_resize=do_resize)
 
         outconv_activation = out[0]
         btlnck = out[1]
@@ -183,17 +194,48 @@ class ZoeDepthNK(DepthModel):
 
         x_d0 = self.conv2(btlnck)
         x = x_d0
+        # after optimize_for_inference, conv2 also computes the first layers of the patch transformer, seed bin regressors and projector
+        xs = dict(zip(self.conv2_split, torch.split(x, list(self.conv2_split.values()), dim=1))) if self.conv2_split else {}
 
-        # Predict which path to take
-        embedding = self.patch_transformer(x)[0]  # N, E
+        # Predict which path to take, per image
+        embedding = self.patch_transformer(xs.get('patch_transformer', x))[0]  # N, E
         domain_logits = self.mlp_classifier(embedding)  # N, 2
-        domain_vote = torch.softmax(domain_logits.sum(
-            dim=0, keepdim=True), dim=-1)  # 1, 2
-
-        # Get the path
-        bin_conf_name = ["nyu", "kitti"][torch.argmax(
-            domain_vote, dim=-1).squeeze().item()]
-
+        route = torch.argmax(domain_logits, dim=-1)  # N
+        names = ["nyu", "kitti"]  # order of the domain logits
+
+        if all_heads:
+            assert not (return_final_centers or return_probs), "all_heads can't be combined with return_final_centers or return_probs"
+            depths = torch.cat([self._metric_head(name, x, xs, x_blocks, outconv_activation)['metric_depth'] for name in names], dim=1)
+            out = depths.gather(1, route.view(-1, 1, 1, 1).expand(-1, 1, *depths.shape[-2:]))
+            return dict(domain_logits=domain_logits, metric_depth=out)
+
+        # Partition the batch by route: sorting the images by route and counting them per head is the only host sync
+        order = torch.argsort(route)
+        counts = torch.bincount(route, minlength=len(names)).tolist()
+        if max(counts) == b:
+            # the whole batch goes to one head
+            output = self._metric_head(names[counts.index(b)], x, xs, x_blocks, outconv_activation, return_final_centers, return_probs)
+            return dict(domain_logits=domain_logits, **output)
+
+        output = {}
+        for name, idx in zip(names, order.split(counts)):
+            if len(idx) == 0:
+                continue
+            head_output = self._metric_head(name, x.index_select(0, idx), {k: v.index_select(0, idx) for k, v in xs.items()},
+                                            [t.index_select(0, idx) for t in x_blocks], outconv_activation.index_select(0, idx),
+                                            return_final_centers, return_probs)
+            # scatter the outputs of the sub-batch back to the positions of its images
+            for k, v in head_output.items():
+                if k not in output:
+                    output[k] = v.new_empty((b, *v.shape[1:]))
+                elif output[k].shape[1:] != v.shape[1:]:
+                    raise ValueError(f"{k} of the metric heads have different shapes {tuple(output[k].shape[1:])} and {tuple(v.shape[1:])}, "
+                                     "it can only be returned for batches of a single domain")
+                output[k].index_copy_(0, idx, v)
+        return dict(domain_logits=domain_logits, **output)
+
+    def _metric_head(self, bin_conf_name, x, xs, x_blocks, outconv_activation, return_final_centers=False, return_probs=False):
+        """Runs the metric head of bin_conf_name on the output of conv2 (x, or its split xs) and the MiDaS features"""
         try:
             conf = [c for c in self.bin_conf if c.name == bin_conf_name][0]
         except IndexError:
@@ -204,12 +246,12 @@ class ZoeDepthNK(DepthModel):
         max_depth = conf['max_depth']
 
         seed_bin_regressor = self.seed_bin_regressors[bin_conf_name]
-        _, seed_b_centers = seed_bin_regressor(x)
+        _, seed_b_centers = seed_bin_regressor(xs.get(bin_conf_name, x))
         if self.bin_centers_type == 'normed' or self.bin_centers_type == 'hybrid2':
             b_prev = (seed_b_centers - min_depth)/(max_depth - min_depth)
         else:
             b_prev = seed_b_centers
-        prev_b_embedding = self.seed_projector(x)
+        prev_b_embedding = self.seed_projector(xs.get('seed_projector', x))
 
         attractors = self.attractors[bin_conf_name]
         for projector, attractor, x in zip(self.projectors, attractors, x_blocks):
@@ -220,13 +262,23 @@ class ZoeDepthNK(DepthModel):
             prev_b_embedding = b_embedding
 
         last = outconv_activation
+        if self.head_resolution is not None and self.head_resolution < 1:
+            # the metric head works at a lower resolution, only the final single channel depth is upsampled (by infer)
+            last = nn.functional.adaptive_avg_pool2d(last, [max(1, round(d * self.head_resolution)) for d in last.shape[-2:]])
 
-        b_centers = nn.functional.interpolate(
-            b_centers, last.shape[-2:], mode='bilinear', align_corners=True)
-        b_embedding = nn.functional.interpolate(
-            b_embedding, last.shape[-2:], mode='bilinear', align_corners=True)
+        if b_embedding.shape[-2:] != last.shape[-2:]:
+            b_embedding = nn.functional.interpolate(
+                b_embedding, last.shape[-2:], mode='bilinear', align_corners=True)
 
         clb = self.conditional_log_binomial[bin_conf_name]
+        if not (return_final_centers or return_probs or torch.is_grad_enabled()) and clb.log_binomial_transform.act is torch.softmax:
+            # Expected depth streamed over the bins, the probabilities and upsampled bin centers are never materialized
+            out = clb.expected_value(last, b_embedding, b_centers)
+            return dict(metric_depth=out)
+
+        if b_centers.shape[-2:] != last.shape[-2:]:
+            b_centers = nn.functional.interpolate(
+                b_centers, last.shape[-2:], mode='bilinear', align_corners=True)
         x = clb(last, b_embedding)
 
         # Now depth value is Sum px * cx , where cx are bin_centers from the last bin tensor
@@ -234,7 +286,7 @@ class ZoeDepthNK(DepthModel):
         # b_centers = nn.functional.interpolate(b_centers, x.shape[-2:], mode='bilinear', align_corners=True)
         out = torch.sum(x * b_centers, dim=1, keepdim=True)
 
-        output = dict(domain_logits=domain_logits, metric_depth=out)
+        output = dict(metric_depth=out)
         if return_final_centers or return_probs:
             output['bin_centers'] = b_centers
 
@@ -242,6 +294,34 @@ class ZoeDepthNK(DepthModel):
             output['probs'] = x
         return output
 
+    def optimize_for_inference(self):
+        """Rewrites the model into an equivalent one that is faster at inference. The result is for inference only: its state_dict
+        differs from the checkpoint format and it can't be trained.
+
+        - conv2 (1x1, linear) is folded into the patch embedding of the domain classifier (also 1x1) and the first convs of the seed bin
+          regressors and the seed projector, which are concatenated into one wide conv that replaces conv2
+        - BatchNorm layers of the MiDaS decoder are folded into the preceding convs
+        - log binomial coefficients of the output distributions are precomputed
+
+        Returns:
+            ZoeDepthNK: self
+        """
+        self.eval()
+        self.core.optimize_for_inference()
+        fused = {'patch_transformer': fold_pointwise_conv(self.conv2, self.patch_transformer.embedding_convPxP)}
+        stems = {**{name: regressor._net for name, regressor in self.seed_bin_regressors.items()},
+                 'seed_projector': self.seed_projector._net}
+        fused.update({name: fold_pointwise_conv(self.conv2, net[0]) for name, net in stems.items()})
+        self.conv2 = concat_convs(list(fused.values()))
+        self.conv2_split = {name: conv.out_channels for name, conv in fused.items()}
+        self.patch_transformer.embedding_convPxP = nn.Identity()
+        for net in stems.values():
+            del net[0]
+            net[0].inplace = False  # the input is a view of the output of conv2
+        for clb in self.conditional_log_binomial.values():
+            clb.log_binomial_transform.precompute()
+        return self
+
     def get_lr_params(self, lr):
         """
         Learning rate configuration for different layers of the model
@@ -319,10 +399,17 @@ class ZoeDepthNK(DepthModel):
                         p.requires_grad = False
 
     @staticmethod
-    def build(midas_model_type="DPT_BEiT_L_384", pretrained_resource=None, use_pretrained_midas=False, train_midas=False, freeze_midas_bn=True, **kwargs):
-        core = MidasCore.build(midas_model_type=midas_model_type, use_pretrained_midas=use_pretrained_midas,
-                               train_midas=train_midas, fetch_features=True, freeze_bn=freeze_midas_bn, **kwargs)
-        model = ZoeDepthNK(core, **kwargs)
+    def build(midas_model_type="DPT_BEiT_L_384", pretrained_resource=None, use_pretrained_midas=False, train_midas=False, freeze_midas_bn=True, meta_init=False, weights_dtype=None, **kwargs):
+        # With meta_init, parameters are not allocated or initialized but taken over from the checkpoint. This needs a checkpoint with all weights.
+        # With weights_dtype ("float16" or "bfloat16"), the weights of the linear and conv layers are kept in half precision, see DepthModel.set_weights_dtype.
+        # They are converted while loading, one tensor at a time, and taken over without a copy from an mmap checkpoint already in that dtype.
+        meta_init = meta_init and bool(pretrained_resource) and not use_pretrained_midas
+        with init_empty_weights(enabled=meta_init):
+            core = MidasCore.build(midas_model_type=midas_model_type, use_pretrained_midas=use_pretrained_midas,
+                                   train_midas=train_midas, fetch_features=True, freeze_bn=freeze_midas_bn, **kwargs)
+            model = ZoeDepthNK(core, **kwargs)
+        if weights_dtype is not None:
+            model.set_weights_dtype(weights_dtype)
         if pretrained_resource:
             assert isinstance(pretrained_resource, str), "pretrained_resource must be a string"
             model = load_state_from_resource(model, pretrained_resource)
@@ -0,0 +1,192 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Dynamic micro-batching of inference requests for the serving apps."""
+
+import bisect
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+
+import torch
+from torchvision import transforms
+
+# kwargs of model.infer that only set the output resolution of a request, they don't keep requests from sharing a batch
+_OUTPUT_KWARGS = ("output_size", "output_scale", "max_side")
+
+
+class Histogram:
+    """Fixed-bucket histogram. Bucket i counts values in (edges[i-1], edges[i]], the last bucket counts values above edges[-1]."""
+
+    def __init__(self, edges):
+        self.edges = list(edges)
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.edges, value)] += 1
+            self.count += 1
+            self.total += value
+
+    def to_dict(self):
+        with self._lock:
+            labels = [f"<={e}" for e in self.edges] + [f">{self.edges[-1]}"]
+            return dict(buckets=dict(zip(labels, self.counts)), count=self.count,
+                        mean=self.total / self.count if self.count else 0.)
+
+
+class _Request:
+    __slots__ = ("image", "kwargs", "future", "enqueued")
+
+    def __init__(self, image, kwargs, future, enqueued):
+        self.image = image
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued = enqueued
+
+
+class InferenceBatcher:
+    def __init__(self, model, max_batch_size=8, max_wait_ms=10, **infer_kwargs):
+        """Collects concurrent inference requests into batches and runs them through DepthModel.infer_many on a single worker thread.
+
+        A batch is closed when it holds max_batch_size requests or when max_wait_ms has passed since its first request arrived.
+        Requests in a batch are grouped by their inference kwargs. infer_many resizes every image to its network resolution first and pads
+        it there (as infer(x, resize_first=True) does, with the padding of the full resolution image), so images of any size with the same
+        aspect ratio share a forward pass, and upsamples each depth map once, to the size of its image or the output size it asked for.
+        Requests with flip_threshold run one by one through model.infer.
+
+        Args:
+            model (zoedepth.models.depth_model.DepthModel): Model used for inference
+            max_batch_size (int, optional): Maximum number of images per forward pass. Defaults to 8.
+            max_wait_ms (float, optional): Maximum time to hold the first request of a batch while waiting for more. Defaults to 10.
+            **infer_kwargs: Default kwargs passed to model.infer, e.g. pad_input, with_flip_aug. Can be overridden per request.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.infer_kwargs = infer_kwargs
+        self.to_tensor = transforms.ToTensor()
+        self._start()
+
+        # A forked child (e.g. a prefork serving worker) only inherits the forking thread, so it gets its own queue, worker thread and stats
+        start = weakref.WeakMethod(self._start)
+        os.register_at_fork(after_in_child=lambda: start() is not None and start()())
+
+    def _start(self):
+        self.batch_sizes = Histogram(range(1, self.max_batch_size + 1))
+        self.queue_wait_ms = Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500, 1000])
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="zoedepth-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, pil_img, **kwargs) -> Future:
+        """Queue a PIL image for inference.
+
+        Args:
+            pil_img (PIL.Image.Image): input RGB image
+            **kwargs: kwargs passed to model.infer for this request
+
+        Returns:
+            concurrent.futures.Future: resolves to the depth map as a numpy array of shape (H, W)
+        """
+        future = Future()
+        self._queue.put(_Request(pil_img, {**self.infer_kwargs, **kwargs}, future, time.perf_counter()))
+        return future
+
+    def infer_pil(self, pil_img, **kwargs):
+        """Blocking equivalent of DepthModel.infer_pil(pil_img, output_type="numpy") that goes through the batch queue"""
+        return self.submit(pil_img, **kwargs).result()
+
+    def stats(self):
+        return dict(batch_size=self.batch_sizes.to_dict(), queue_wait_ms=self.queue_wait_ms.to_dict(),
+                    pending=self._queue.qsize())
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.enqueued + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if req is None:
+                # finish this batch first, stop on the next call
+                self._queue.put(None)
+                break
+            batch.append(req)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            groups = {}
+            for req in batch:
+                self.queue_wait_ms.add((start - req.enqueued) * 1000)
+                if req.kwargs.get("flip_threshold") is not None:
+                    # the flipped pass depends on the uncertainty of each image, see DepthModel.infer_with_adaptive_flip_aug
+                    self._run_group([req], batched=False)
+                    continue
+                kwargs = tuple(sorted((k, repr(v)) for k, v in req.kwargs.items() if k not in _OUTPUT_KWARGS))
+                groups.setdefault(kwargs, []).append(req)
+            for reqs in groups.values():
+                self._run_group(reqs)
+
+    @torch.no_grad()
+    def _run_group(self, reqs, batched=True):
+        self.batch_sizes.add(len(reqs))
+        try:
+            xs = [self.to_tensor(r.image).unsqueeze(0).to(self.model.device) for r in reqs]
+            if batched:
+                # every image is resized first, explicitly passing resize_first has no effect
+                kwargs = {k: v for k, v in reqs[0].kwargs.items() if k not in _OUTPUT_KWARGS and k != "resize_first"}
+                output_sizes = [self.model._output_size(*x.shape[-2:], **{k: r.kwargs.get(k) for k in _OUTPUT_KWARGS})
+                                for r, x in zip(reqs, xs)]
+                out = self.model.infer_many(xs, output_sizes=output_sizes, **kwargs)
+            else:
+                out = [self.model.infer(x, **r.kwargs) for r, x in zip(reqs, xs)]
+            depths = [depth.cpu().numpy().squeeze() for depth in out]
+        except Exception as e:
+            for r in reqs:
+                r.future.set_exception(e)
+            return
+        for r, depth in zip(reqs, depths):
+            r.future.set_result(depth)
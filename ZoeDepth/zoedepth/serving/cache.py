@@ -0,0 +1,225 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Content-addressed cache for depth predictions."""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+KEY_RE = re.compile(r"[0-9a-f]{64}")
+
+
+def make_key(image_bytes, **params):
+    """Cache key from the encoded image bytes and the inference parameters (pad_input, with_flip_aug, model id, checkpoint etc.)"""
+    h = hashlib.sha256(image_bytes)
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def checkpoint_fingerprint(resource):
+    """Identifies the weights of a pretrained resource (see load_state_from_resource): the resource string with the size and modification
+    time of its file, the torch hub download for url:: resources. Replacing the weights at the same path changes the fingerprint."""
+    if not resource:
+        return ""
+    kind, _, location = resource.partition("::")
+    if kind == "url":
+        path = os.path.join(torch.hub.get_dir(), "checkpoints", os.path.basename(urlparse(location).path))
+    else:
+        path = location
+    parts = [resource]
+    if os.path.exists(path):
+        stat = os.stat(path)
+        parts += [stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()[:16]
+
+
+def inference_settings(model, config=None):
+    """Settings of a DepthModel and its config that change its predictions, for the cache keys (see CachedInference).
+
+    Args:
+        model (zoedepth.models.depth_model.DepthModel): the model, or the BucketedDepthModel wrapping it
+        config (dict, optional): config the model was built from. Defaults to None.
+    """
+    settings = dict(buckets=getattr(model, "buckets", None))
+    model = getattr(model, "model", model)
+    settings.update(precision=getattr(model, "precision", None), weights_dtype=getattr(model, "weights_dtype", None))
+    if config is not None:
+        settings.update({k: config.get(k) for k in ("midas_model_type", "img_size", "force_keep_ar", "head_resolution")})
+    return settings
+
+
+class DepthCache:
+    def __init__(self, max_bytes=256 * 2**20, cache_dir=None):
+        """Two-tier LRU cache of depth maps.
+
+        The memory tier holds depth maps as given (float32) up to a total of max_bytes and evicts the least recently used entries.
+        The optional disk tier stores every entry as a compressed float16 .npz under cache_dir and survives restarts.
+        Entries found on disk are promoted back to the memory tier.
+
+        Args:
+            max_bytes (int, optional): Byte budget of the memory tier. Defaults to 256MB.
+            cache_dir (str, optional): Directory of the disk tier. Defaults to None (memory only).
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.counters = dict(memory_hits=0, disk_hits=0, misses=0, evictions=0, disk_writes=0)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+    def get(self, key):
+        """Returns the cached (read-only) depth map for key or None"""
+        with self._lock:
+            depth = self._entries.get(key)
+            if depth is not None:
+                self._entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return depth
+
+        if self.cache_dir is not None and os.path.exists(self._path(key)):
+            try:
+                with np.load(self._path(key)) as f:
+                    depth = f['depth'].astype(np.float32)
+            except (OSError, ValueError, KeyError):
+                # partially written or corrupt file, treat as a miss
+                depth = None
+            if depth is not None:
+                self._put_memory(key, depth)
+                with self._lock:
+                    self.counters['disk_hits'] += 1
+                return depth
+
+        with self._lock:
+            self.counters['misses'] += 1
+        return None
+
+    def put(self, key, depth):
+        # a copy: depth maps of batched inference are views of the whole batch, which would stay alive uncounted by max_bytes
+        depth = np.array(depth, dtype=np.float32)
+        self._put_memory(key, depth)
+        if self.cache_dir is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temp file and rename so that readers never see partial files
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, depth=depth.astype(np.float16))
+            os.replace(tmp, path)
+            with self._lock:
+                self.counters['disk_writes'] += 1
+        return depth
+
+    def _put_memory(self, key, depth):
+        depth.setflags(write=False)
+        if depth.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key).nbytes
+            self._entries[key] = depth
+            self._nbytes += depth.nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                self.counters['evictions'] += 1
+
+    def get_or_compute(self, key, compute_fn):
+        depth = self.get(key)
+        if depth is None:
+            depth = self.put(key, compute_fn())
+        return depth
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries), memory_bytes=self._nbytes, max_bytes=self.max_bytes)
+
+
+class CachedInference(object):
+    def __init__(self, model, cache, model_id="", checkpoint="", settings=None):
+        """Wraps anything with an infer_pil method (a DepthModel or an InferenceBatcher) so that infer_pil results are served from a DepthCache.
+
+        Every key covers the image, the infer_pil arguments, the default inference kwargs of the wrapped batcher or executor, the model,
+        the checkpoint and settings.
+
+        Args:
+            model: object with an infer_pil(pil_img, **kwargs) method returning a numpy depth map
+            cache (DepthCache): cache to use
+            model_id (str, optional): model identifier that is part of every key. Defaults to "".
+            checkpoint (str, optional): pretrained resource of the weights, identified by checkpoint_fingerprint. Defaults to "".
+            settings (dict, optional): anything else that changes the predictions, e.g. inference_settings(model, config). Defaults to None.
+        """
+        self.model = model
+        self.cache = cache
+        self.model_id = model_id
+        self.checkpoint_hash = checkpoint_fingerprint(checkpoint)
+        self.settings = dict(settings or {}, defaults=getattr(model, "infer_kwargs", {}))
+
+    def key(self, pil_img, pad_input: bool=True, with_flip_aug: bool=True, image_bytes=None, **kwargs):
+        """Cache key of the infer_pil call with the same arguments"""
+        if image_bytes is None:
+            image_bytes = pil_img.tobytes() + f"{pil_img.mode}{pil_img.size}".encode()
+        return make_key(image_bytes, pad_input=pad_input, with_flip_aug=with_flip_aug, model=self.model_id,
+                        checkpoint=self.checkpoint_hash, settings=self.settings, **kwargs)
+
+    def infer_pil(self, pil_img, pad_input: bool=True, with_flip_aug: bool=True, output_type: str="numpy", image_bytes=None, key=None, **kwargs):
+        """Same as DepthModel.infer_pil. If the encoded bytes of the image are passed as image_bytes they are hashed instead of the decoded pixels.
+        A key already computed with self.key for the same arguments can be passed as key, the image is then not hashed again."""
+        if key is None:
+            key = self.key(pil_img, pad_input=pad_input, with_flip_aug=with_flip_aug, image_bytes=image_bytes, **kwargs)
+        depth = self.cache.get_or_compute(key, lambda: self.model.infer_pil(
+            pil_img, pad_input=pad_input, with_flip_aug=with_flip_aug, **kwargs))
+
+        if output_type == "numpy":
+            return depth
+        elif output_type == "pil":
+            # uint16 is required for depth pil image
+            return Image.fromarray((depth*256).astype(np.uint16))
+        elif output_type == "tensor":
+            return torch.from_numpy(depth.copy())
+        else:
+            raise ValueError(f"output_type {output_type} not supported. Supported values are 'numpy', 'pil' and 'tensor'")
+
+    def lookup(self, key):
+        """Cached depth map of a previous infer_pil call by its key, or None if it is not (or no longer) cached"""
+        # keys can come from urls, never let them escape the cache directory
+        if not KEY_RE.fullmatch(key):
+            return None
+        return self.cache.get(key)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,156 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Binary depth response formats.
+
+A depth payload is a fixed size little-endian header followed by the depth values in row major order, optionally zlib compressed:
+
+    offset  size  field
+    0       4     magic b"ZDEP"
+    4       1     format version (1)
+    5       1     dtype code (1: float16, 2: uint16)
+    6       1     compression (0: none, 1: zlib)
+    7       1     reserved
+    8       4     height (uint32)
+    12      4     width (uint32)
+    16      4     scale (float32), depth = value * scale
+    20      8     units, ascii, NUL padded (e.g. b"m", b"ft")
+
+Only the values after the header are compressed, so clients can read the shape and units before inflating.
+"""
+
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b"ZDEP"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBxIIf8s")
+
+DTYPE_CODES = {"float16": 1, "uint16": 2}
+DTYPES = {v: k for k, v in DTYPE_CODES.items()}
+
+# format name -> (mimetype, dtype, compressed)
+FORMATS = {
+    "f16": ("application/x-zoedepth-f16", "float16", False),
+    "u16": ("application/x-zoedepth-u16", "uint16", False),
+    "f16z": ("application/x-zoedepth-f16+zlib", "float16", True),
+    "u16z": ("application/x-zoedepth-u16+zlib", "uint16", True),
+}
+MIMETYPES = {mimetype: name for name, (mimetype, _, _) in FORMATS.items()}
+
+# uint16 depth uses the same 1/256 fixed point convention as save_raw_16bit
+UINT16_SCALE = 1. / 256
+
+
+def encode_depth(depth, dtype="float16", compress=False, units="m", scale=None, compress_level=6):
+    """Encodes a depth map (H, W) into the binary depth format
+
+    Args:
+        depth (numpy.ndarray): Depth map. Singular dimensions are squeezed
+        dtype (str, optional): "float16" or "uint16". Defaults to "float16".
+        compress (bool, optional): zlib compress the values. Defaults to False.
+        units (str, optional): Units of depth, at most 8 ascii characters. Defaults to "m".
+        scale (float, optional): Quantization step for uint16, values are round(depth / scale) clipped to [0, 65535]. Defaults to 1/256.
+            Always 1 for float16.
+        compress_level (int, optional): zlib compression level. Defaults to 6.
+
+    Returns:
+        bytes: header + payload
+    """
+    depth = np.asarray(depth, dtype=np.float32).squeeze()
+    if depth.ndim != 2:
+        raise ValueError(f"Expected a (H, W) depth map, got shape {depth.shape}")
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"dtype {dtype} not supported. Supported values are {list(DTYPE_CODES)}")
+
+    if dtype == "float16":
+        scale = 1.
+        values = depth.astype("<f2")
+    else:
+        scale = UINT16_SCALE if scale is None else scale
+        values = np.clip(np.rint(depth / scale), 0, 65535).astype("<u2")
+
+    payload = values.tobytes()
+    if compress:
+        payload = zlib.compress(payload, compress_level)
+
+    h, w = depth.shape
+    header = HEADER.pack(MAGIC, VERSION, DTYPE_CODES[dtype], int(compress), h, w, scale, units.encode("ascii"))
+    return header + payload
+
+
+def decode_depth(buf):
+    """Decodes the binary depth format
+
+    Returns:
+        tuple[numpy.ndarray, dict]: float32 depth map (H, W) and the header fields (dtype, compressed, height, width, scale, units)
+    """
+    magic, version, dtype_code, compressed, h, w, scale, units = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError("Not a depth payload")
+    if version != VERSION:
+        raise ValueError(f"Unsupported depth format version {version}")
+
+    payload = memoryview(buf)[HEADER.size:]
+    if compressed:
+        payload = zlib.decompress(payload)
+    dtype = DTYPES[dtype_code]
+    values = np.frombuffer(payload, dtype="<f2" if dtype == "float16" else "<u2").reshape(h, w)
+    depth = values.astype(np.float32)
+    if scale != 1:
+        depth *= scale
+    meta = dict(dtype=dtype, compressed=bool(compressed), height=h, width=w, scale=scale, units=units.rstrip(b"\0").decode("ascii"))
+    return depth, meta
+
+
+def encode(depth, fmt, units="m"):
+    """Encodes depth in the named format (one of FORMATS)
+
+    Returns:
+        tuple[bytes, str]: body and its mimetype
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Format {fmt} not supported. Supported values are {list(FORMATS)}")
+    mimetype, dtype, compress = FORMATS[fmt]
+    return encode_depth(depth, dtype=dtype, compress=compress, units=units), mimetype
+
+
+def negotiate(accept_mimetypes, fmt=None, default="image/png"):
+    """Picks the response format of a request
+
+    Args:
+        accept_mimetypes (werkzeug.datastructures.MIMEAccept): Accept header of the request (request.accept_mimetypes)
+        fmt (str, optional): Explicit format name, e.g. from a ?format= query parameter. Takes precedence over the Accept header.
+        default (str, optional): Mimetype to use when the client accepts anything. Defaults to "image/png".
+
+    Returns:
+        str: a FORMATS name, or the mimetype of a non binary response ("image/png", "application/json") that the caller renders itself
+    """
+    if fmt is not None:
+        if fmt not in FORMATS:
+            raise ValueError(f"Format {fmt} not supported. Supported values are {list(FORMATS)}")
+        return fmt
+    offered = [default] + [m for m in MIMETYPES if m != default]
+    best = accept_mimetypes.best_match(offered, default=default)
+    return MIMETYPES.get(best, best)
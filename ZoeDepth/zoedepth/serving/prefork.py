@@ -0,0 +1,167 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Pre-forking launcher for the serving apps.
+
+The app module (and with it the model) is imported once in the parent. Parameters and buffers are moved to shared memory, the garbage
+collector is frozen and N workers are forked that accept connections on one shared listening socket. All workers then reference the same
+physical weight pages, so a worker costs its activations and python heap, not another copy of the weights.
+
+See serve.py for the command line launcher.
+"""
+
+import gc
+import logging
+import os
+import signal
+import socket
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def memory_usage(pid="self"):
+    """Memory of a process from /proc/<pid>/smaps_rollup in bytes.
+
+    Returns:
+        dict: rss, pss (shared pages divided among the processes that map them) and uss (pages private to this process). {} if unavailable.
+    """
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    except OSError:
+        return {}
+    return dict(rss=fields.get("Rss", 0), pss=fields.get("Pss", 0),
+                uss=fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0))
+
+
+def prepare_for_fork(models, share_memory=True):
+    """Makes the state of the parent process cheap to inherit.
+
+    Args:
+        models (list[torch.nn.Module]): models whose parameters and buffers are moved to shared memory. Shared pages are never copied on
+            write, so they stay shared even if a worker writes to them. Models loaded from an mmap:: checkpoint with meta_init are already
+            backed by the page cache and can skip this (share_memory=False).
+        share_memory (bool, optional): Defaults to True.
+    """
+    if share_memory:
+        for model in models:
+            model.share_memory()
+    # Objects that survive gc.freeze are moved to a permanent generation that the collector never traverses, so collections in the
+    # workers don't write to (and thereby copy) the pages of everything inherited from the parent
+    gc.collect()
+    gc.freeze()
+
+
+class PreforkServer:
+    def __init__(self, app, host="0.0.0.0", port=5000, workers=2, threads_per_worker=None, report_interval=60):
+        """Forks workers that serve a WSGI app from one shared listening socket.
+
+        Args:
+            app: WSGI application, e.g. a Flask app
+            host (str, optional): Defaults to "0.0.0.0".
+            port (int, optional): Defaults to 5000.
+            workers (int, optional): Number of worker processes. Defaults to 2.
+            threads_per_worker (int, optional): torch intra-op threads per worker. Defaults to cpu count // workers.
+            report_interval (float, optional): Seconds between per-worker memory reports in the log, 0 disables them. Defaults to 60.
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.report_interval = report_interval
+        self.pids = {}
+        self._stopping = False
+
+    def serve_forever(self):
+        self.socket = socket.create_server((self.host, self.port), backlog=128)
+        self.socket.set_inheritable(True)
+        logger.info(f"Listening on {self.host}:{self.port} with {self.workers} workers, {self.threads_per_worker} threads each")
+
+        for i in range(self.workers):
+            self._spawn(i)
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        last_report = time.monotonic()
+        while not self._stopping:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid and pid in self.pids and not self._stopping:
+                i = self.pids.pop(pid)
+                logger.warning(f"Worker {i} (pid {pid}) exited with status {status}, restarting")
+                self._spawn(i)
+            if self.report_interval and time.monotonic() - last_report > self.report_interval:
+                self.log_memory()
+                last_report = time.monotonic()
+            time.sleep(0.5)
+
+    def _spawn(self, i):
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = i
+            return
+        # worker
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            torch.set_num_threads(self.threads_per_worker)
+            from werkzeug.serving import make_server
+            server = make_server(self.host, self.port, self.app, threaded=True, fd=self.socket.fileno())
+            server.serve_forever()
+        finally:
+            os._exit(1)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+    def memory_report(self):
+        """Memory of the parent and every worker, see memory_usage"""
+        report = {"parent": dict(pid=os.getpid(), **memory_usage())}
+        for pid, i in sorted(self.pids.items(), key=lambda item: item[1]):
+            report[f"worker{i}"] = dict(pid=pid, **memory_usage(pid))
+        return report
+
+    def log_memory(self):
+        for name, m in self.memory_report().items():
+            if "uss" in m:
+                logger.info(f"{name} (pid {m['pid']}): uss {m['uss'] / 2**20:.0f}MB pss {m['pss'] / 2**20:.0f}MB rss {m['rss'] / 2**20:.0f}MB")
+
@@ -0,0 +1,132 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Fast depth map rendering through a precomputed colormap lookup table."""
+
+import io
+
+import matplotlib
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+class DepthRenderer(object):
+    def __init__(self, cmap='gray', lut_size=256, label="Depth value", bar_width=20, bar_height=1024, n_ticks=6, compress_level=1,
+                 max_side=1024):
+        """Renders depth maps to RGB images with a colorbar, without building a matplotlib figure per call.
+
+        The colormap lookup table, the colorbar strip and the rotated label are built once here. Rendering a depth map then only
+        downscales it to at most max_side, normalizes it, indexes the lookup table, composites the strip and tick labels next to it and encodes the result.
+
+        Args:
+            cmap (str, optional): matplotlib colormap to use. Defaults to 'gray'.
+            lut_size (int, optional): Number of lookup table entries, e.g 256 or 4096. Defaults to 256.
+            label (str, optional): Colorbar label. Defaults to "Depth value".
+            bar_width (int, optional): Width of the colorbar strip in pixels. Defaults to 20.
+            bar_height (int, optional): Height of the pre-rendered colorbar strip. It is resampled to the image height. Defaults to 1024.
+            n_ticks (int, optional): Number of colorbar tick labels. Defaults to 6.
+            compress_level (int, optional): zlib compression level of the PNG output. Defaults to 1.
+            max_side (int, optional): Longest side of the rendered depth map, larger maps are downscaled (area averaged) before they are
+                colorized and encoded. None renders at full resolution. Defaults to 1024.
+        """
+        self.lut_size = lut_size
+        cmapper = matplotlib.colormaps[cmap].resampled(lut_size)
+        self.lut = cmapper(np.arange(lut_size), bytes=True)[:, :3]  # lut_size x 3, uint8
+        self.n_ticks = n_ticks
+        self.compress_level = compress_level
+        self.max_side = max_side
+
+        # colorbar strip, highest value at the top
+        idx = np.linspace(lut_size - 1, 0, bar_height).round().astype(np.intp)
+        self.bar = np.repeat(self.lut[idx][:, None, :], bar_width, axis=1)
+
+        self.font = ImageFont.load_default()
+        self.margin = 10
+        self.tick_width = 6 + self._text_size("-000.00")[0]
+        label_w, label_h = self._text_size(label)
+        label_img = Image.new("L", (label_w + 2, label_h + 2), 255)
+        ImageDraw.Draw(label_img).text((1, 1), label, fill=0, font=self.font)
+        self.label = np.asarray(label_img.rotate(90, expand=True))  # vertical, reads bottom to top
+
+    def _text_size(self, text):
+        left, top, right, bottom = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox((0, 0), text, font=self.font)
+        return right - left, bottom - top
+
+    def downscale(self, depth):
+        """Area averages depth (H, W) down to at most max_side pixels on its longest side"""
+        depth = np.asarray(depth, dtype=np.float32).squeeze()
+        h, w = depth.shape
+        if self.max_side is None or max(h, w) <= self.max_side:
+            return depth
+        scale = self.max_side / max(h, w)
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        return np.asarray(Image.fromarray(depth, mode="F").resize(size, Image.BOX))
+
+    def colorize(self, depth, vmin=None, vmax=None):
+        """Maps depth (H, W) to RGB (H, W, 3) uint8 through the lookup table. vmin/vmax default to the depth range, as with matplotlib's imshow."""
+        depth = np.asarray(depth, dtype=np.float32)
+        vmin = float(np.nanmin(depth)) if vmin is None else vmin
+        vmax = float(np.nanmax(depth)) if vmax is None else vmax
+        scale = self.lut_size / (vmax - vmin) if vmax > vmin else 0.
+        idx = np.subtract(depth, vmin)
+        idx *= scale
+        np.clip(idx, 0, self.lut_size - 1, out=idx)
+        return self.lut[np.nan_to_num(idx).astype(np.intp)]
+
+    def render(self, depth, vmin=None, vmax=None):
+        """Renders depth (H, W) and its colorbar side by side
+
+        Returns:
+            PIL.Image.Image: RGB image of height H, or of the downscaled height if H or W is larger than max_side
+        """
+        depth = self.downscale(depth)
+        vmin = float(np.nanmin(depth)) if vmin is None else vmin
+        vmax = float(np.nanmax(depth)) if vmax is None else vmax
+        colored = self.colorize(depth, vmin, vmax)
+        h, w = depth.shape
+
+        bar_w = self.bar.shape[1]
+        label_h, label_w = self.label.shape
+        canvas = np.full((h, w + 2 * self.margin + bar_w + self.tick_width + label_w, 3), 255, dtype=np.uint8)
+        canvas[:, :w] = colored
+        x0 = w + self.margin
+        canvas[:, x0:x0 + bar_w] = self.bar[np.linspace(0, self.bar.shape[0] - 1, h).round().astype(np.intp)]
+        x_label = x0 + bar_w + self.tick_width + self.margin
+        if label_h <= h:
+            y_label = (h - label_h) // 2
+            canvas[y_label:y_label + label_h, x_label:x_label + label_w] = self.label[..., None]
+
+        img = Image.fromarray(canvas)
+        draw = ImageDraw.Draw(img)
+        text_h = self._text_size("0")[1]
+        for value, y in zip(np.linspace(vmax, vmin, self.n_ticks), np.linspace(0, h - 1, self.n_ticks)):
+            y = int(round(y))
+            draw.line([(x0 + bar_w, y), (x0 + bar_w + 3, y)], fill=(0, 0, 0))
+            ty = min(max(y - text_h // 2, 0), h - text_h - 1)
+            draw.text((x0 + bar_w + 5, ty), f"{value:.2f}", fill=(0, 0, 0), font=self.font)
+        return img
+
+    def render_png(self, depth, vmin=None, vmax=None):
+        """Same as render, encoded as PNG bytes"""
+        buf = io.BytesIO()
+        self.render(depth, vmin=vmin, vmax=vmax).save(buf, format="PNG", compress_level=self.compress_level)
+        return buf.getvalue()
@@ -0,0 +1,230 @@
+# MIT License
+
+# Copyright (c) 2022 Intelligent Systems Lab Org
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Runs inference on several CPU model replicas, each pinned to its own cores."""
+
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+
+import torch
+
+from zoedepth.serving.batching import Histogram
+from zoedepth.serving.prefork import prepare_for_fork
+
+
+def split_cores(replicas, threads_per_replica=None, cores=None):
+    """Splits the cores this process may run on into disjoint sets, one per replica.
+
+    Args:
+        replicas (int): number of replicas
+        threads_per_replica (int, optional): cores per replica. Defaults to all available cores divided evenly.
+        cores (list[int], optional): cores to split. Defaults to the affinity of this process.
+
+    Returns:
+        list[list[int]]
+    """
+    cores = sorted(os.sched_getaffinity(0) if cores is None else cores)
+    threads_per_replica = threads_per_replica or max(1, len(cores) // replicas)
+    if replicas * threads_per_replica > len(cores):
+        raise ValueError(f"{replicas} replicas x {threads_per_replica} threads need more than the {len(cores)} available cores")
+    return [cores[i * threads_per_replica:(i + 1) * threads_per_replica] for i in range(replicas)]
+
+
+def _replica_main(model, cores, requests, results):
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    parent = os.getppid()
+    while True:
+        try:
+            item = requests.get(timeout=1)
+        except queue.Empty:
+            # a prefork worker is killed without closing its executor, don't outlive it
+            if os.getppid() != parent:
+                return
+            continue
+        if item is None:
+            return
+        request_id, pil_img, kwargs = item
+        try:
+            depth = model.infer_pil(pil_img, output_type="numpy", **kwargs)
+            results.put((request_id, depth, None))
+        except Exception as e:
+            results.put((request_id, None, RuntimeError(f"{type(e).__name__}: {e}")))
+
+
+class _Replica:
+    def __init__(self, index, cores):
+        self.index = index
+        self.cores = cores
+        self.in_flight = 0
+        self.completed = 0
+        self.alive = True
+        self.latency_ms = Histogram([10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000])
+
+
+class ReplicaExecutor:
+    def __init__(self, model, replicas=2, threads_per_replica=None, policy="least_load", share_memory=True, **infer_kwargs):
+        """Runs DepthModel.infer_pil on `replicas` forked copies of model, each pinned to a disjoint set of cores.
+
+        Small inputs don't keep many intra-op threads busy, so on CPU several replicas with a few threads each have a higher throughput
+        than one model using every core. Replicas are processes since torch.set_num_threads is per process. They are forked from this
+        process, so the weights are shared with it rather than copied. Exposes the same submit/infer_pil/stats interface as
+        InferenceBatcher. Use sweep_replicas.py to find the split of cores for a host.
+
+        Args:
+            model (zoedepth.models.depth_model.DepthModel): CPU model used for inference
+            replicas (int, optional): Number of replicas. Defaults to 2.
+            threads_per_replica (int, optional): Cores (and torch threads) per replica. Defaults to the available cores divided evenly.
+            policy (str, optional): How requests are assigned to replicas, "least_load" (fewest requests in flight) or "round_robin".
+                Defaults to "least_load".
+            share_memory (bool, optional): Move the weights to shared memory before forking, see prefork.prepare_for_fork. Defaults to True.
+            **infer_kwargs: Default kwargs passed to model.infer_pil, e.g. pad_input, with_flip_aug. Can be overridden per request.
+        """
+        if policy not in ("least_load", "round_robin"):
+            raise ValueError(f"policy {policy} not supported. Supported values are 'least_load' and 'round_robin'")
+        if any(p.device.type != "cpu" for p in model.parameters()):
+            # CUDA can't be used in processes forked after it was initialized
+            raise ValueError("Replicas run on CPU, move the model to the CPU or use InferenceBatcher on GPU")
+        self.model = model
+        self.policy = policy
+        self.infer_kwargs = infer_kwargs
+        self.cores = split_cores(replicas, threads_per_replica)
+        prepare_for_fork([model], share_memory=share_memory)
+        self._spawning = False
+        self._start()
+        # A forked child (e.g. a prefork serving worker) inherits neither the collector thread nor the replicas' queues, it starts its
+        # own replicas on the same cores. So only one child should serve, and the parent closes its own replicas before forking it (see
+        # serve.py). The replicas themselves are forked while _spawning is set and skip this.
+        restart = weakref.WeakMethod(self._restart_after_fork)
+        os.register_at_fork(after_in_child=lambda: restart() is not None and restart()())
+
+    def _restart_after_fork(self):
+        if not self._spawning:
+            self._start()
+
+    def _start(self):
+        self.replicas = [_Replica(i, cores) for i, cores in enumerate(self.cores)]
+        ctx = mp.get_context("fork")
+        self._results = ctx.Queue()
+        self._requests = [ctx.Queue() for _ in self.replicas]
+        self._processes = [ctx.Process(target=_replica_main, args=(self.model, r.cores, q, self._results), daemon=True,
+                                       name=f"zoedepth-replica-{r.index}")
+                           for r, q in zip(self.replicas, self._requests)]
+        self._spawning = True
+        try:
+            for p in self._processes:
+                p.start()
+        finally:
+            self._spawning = False
+
+        self._lock = threading.Lock()
+        self._pending = {}  # request id -> (future, replica, start time)
+        self._ids = itertools.count()
+        self._round_robin = itertools.cycle(self.replicas)
+        self._closed = False
+        self._thread = threading.Thread(target=self._collect, name="zoedepth-replica-results", daemon=True)
+        self._thread.start()
+
+    def _pick(self):
+        alive = [r for r in self.replicas if r.alive]
+        if not alive:
+            raise RuntimeError("All inference replicas exited")
+        if self.policy == "round_robin":
+            return next(r for r in self._round_robin if r.alive)
+        return min(alive, key=lambda r: r.in_flight)
+
+    def submit(self, pil_img, **kwargs) -> Future:
+        """Queue a PIL image for inference.
+
+        Args:
+            pil_img (PIL.Image.Image): input RGB image
+            **kwargs: kwargs passed to model.infer_pil for this request
+
+        Returns:
+            concurrent.futures.Future: resolves to the depth map as a numpy array of shape (H, W)
+        """
+        future = Future()
+        with self._lock:
+            replica = self._pick()
+            replica.in_flight += 1
+            request_id = next(self._ids)
+            self._pending[request_id] = (future, replica, time.perf_counter())
+        self._requests[replica.index].put((request_id, pil_img, {**self.infer_kwargs, **kwargs}))
+        return future
+
+    def infer_pil(self, pil_img, **kwargs):
+        """Blocking equivalent of DepthModel.infer_pil(pil_img, output_type="numpy") that runs on one of the replicas"""
+        return self.submit(pil_img, **kwargs).result()
+
+    def stats(self):
+        with self._lock:
+            return dict(policy=self.policy, replicas=[dict(cores=r.cores, alive=r.alive, in_flight=r.in_flight, completed=r.completed,
+                                                           latency_ms=r.latency_ms.to_dict()) for r in self.replicas])
+
+    def close(self):
+        self._closed = True
+        for q in self._requests:
+            q.put(None)
+        for p in self._processes:
+            p.join()
+        self._thread.join()
+
+    def _collect(self):
+        while not self._closed or self._pending:
+            self._fail_dead_replicas()
+            try:
+                request_id, depth, error = self._results.get(timeout=1)
+            except queue.Empty:
+                if self._closed and not any(p.is_alive() for p in self._processes):
+                    return
+                continue
+            with self._lock:
+                if request_id not in self._pending:
+                    continue
+                future, replica, start = self._pending.pop(request_id)
+                replica.in_flight -= 1
+                replica.completed += 1
+            replica.latency_ms.add((time.perf_counter() - start) * 1000)
+            if error is None:
+                future.set_result(depth)
+            else:
+                future.set_exception(error)
+
+    def _fail_dead_replicas(self):
+        dead = {r.index for r, p in zip(self.replicas, self._processes) if r.alive and not p.is_alive() and p.exitcode != 0}
+        if not dead:
+            return
+        with self._lock:
+            for i in dead:
+                self.replicas[i].alive = False
+            lost = [(i, f) for i, (f, r, _) in self._pending.items() if r.index in dead]
+            for i, _ in lost:
+                _, replica, _ = self._pending.pop(i)
+                replica.in_flight -= 1
+        for _, future in lost:
+            future.set_exception(RuntimeError("Inference replica exited"))
@@ -1,17 +1,24 @@
 import os
+import sys
 import numpy as np
 from PIL import Image
 import torch
-from flask import Flask, request, jsonify, render_template, send_file
+from flask import Flask, Response, request, jsonify, render_template, send_file
 from flask_cors import CORS
 import io
 import base64
 import logging
-import matplotlib
-import matplotlib.pyplot as plt
 
-# Use the 'Agg' backend for headless rendering (no GUI)
-matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ZoeDepth"))
+from zoedepth.models.builder import build_model
+from zoedepth.utils.config import get_config
+from zoedepth.models.bucketing import BucketedDepthModel, parse_buckets
+from zoedepth.serving.batching import InferenceBatcher
+from zoedepth.serving.replicas import ReplicaExecutor
+from zoedepth.serving.cache import DepthCache, CachedInference, inference_settings
+from zoedepth.serving.render import DepthRenderer
+from zoedepth.serving import formats
+from zoedepth.serving.prefork import memory_usage
 
 # Set up Flask app
 app = Flask(__name__)
@@ -20,21 +27,104 @@ CORS(app)
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 
-# Load the ZoeDepth model
-zoe = torch.hub.load("isl-org/ZoeDepth", "ZoeD_N", pretrained=True)
+# Load the ZoeD_N model from the local ZoeDepth package, the MiDaS backbone is built from vendored code so no torch.hub repo download is needed
+overwrite = {"pretrained_resource": os.environ["ZOE_PRETRAINED_RESOURCE"]} if "ZOE_PRETRAINED_RESOURCE" in os.environ else {}
+# ZOE_WEIGHTS_DTYPE=bfloat16 (or float16) keeps the layer weights in half precision, see DepthModel.set_weights_dtype
+if os.environ.get("ZOE_WEIGHTS_DTYPE"):
+    overwrite["weights_dtype"] = os.environ["ZOE_WEIGHTS_DTYPE"]
+conf = get_config("zoedepth", "infer", **overwrite)
+zoe = build_model(conf)
 
 # Set the model to evaluation mode explicitly
 zoe.eval()
 
+# ZOE_PRECISION=bf16 runs inference under bfloat16 autocast, fp16-weights halves the weight memory (see DepthModel.set_precision)
+zoe.set_precision(os.environ.get("ZOE_PRECISION", "fp32"))
+
+# With ZOE_BUCKETS ("default" or e.g. "384x512,672x512"), inputs are padded to one of a few network resolutions and the model is compiled
+# once per resolution at startup, ZOE_COMPILE_CACHE keeps the compiled graphs across restarts (see zoedepth.models.bucketing)
+if os.environ.get("ZOE_BUCKETS"):
+    zoe = BucketedDepthModel(zoe, buckets=parse_buckets(os.environ["ZOE_BUCKETS"]), cache_dir=os.environ.get("ZOE_COMPILE_CACHE"))
+    zoe.warmup(batch_sizes=[int(b) for b in os.environ.get("ZOE_WARMUP_BATCH_SIZES", "2").split(",")])
+
+# Concurrent requests are batched together before going through the model, or with ZOE_REPLICAS set, spread over that many CPU
+# replicas of the model pinned to their own cores (see sweep_replicas.py)
+if int(os.environ.get("ZOE_REPLICAS", 0)):
+    batcher = ReplicaExecutor(zoe, replicas=int(os.environ["ZOE_REPLICAS"]),
+                              threads_per_replica=int(os.environ.get("ZOE_THREADS_PER_REPLICA", 0)) or None,
+                              policy=os.environ.get("ZOE_REPLICA_POLICY", "least_load"))
+else:
+    batcher = InferenceBatcher(zoe, max_batch_size=int(os.environ.get("ZOE_MAX_BATCH_SIZE", 4)),
+                               max_wait_ms=float(os.environ.get("ZOE_MAX_WAIT_MS", 10)))
+
+# ZOE_RESIZE_FIRST=1 resizes uploads to the network resolution before the padding and flip augmentations instead of augmenting the full
+# resolution image (see DepthModel.infer_with_tta)
+infer_kwargs = dict(resize_first=True) if os.environ.get("ZOE_RESIZE_FIRST") == "1" else {}
+# The depth map is only rendered and downloaded, never indexed by image pixel, so with ZOE_OUTPUT_MAX_SIDE (e.g. 1024, or "network" for
+# the resolution the model predicts at) it is returned smaller than the upload instead of being upsampled to full resolution
+if os.environ.get("ZOE_OUTPUT_MAX_SIDE") == "network":
+    infer_kwargs["output_size"] = "network"
+elif os.environ.get("ZOE_OUTPUT_MAX_SIDE"):
+    infer_kwargs["max_side"] = int(os.environ["ZOE_OUTPUT_MAX_SIDE"])
+
+# Repeated uploads of the same image are served from the cache
+cache = DepthCache(max_bytes=int(os.environ.get("ZOE_CACHE_MB", 256)) * 2**20, cache_dir=os.environ.get("ZOE_CACHE_DIR"))
+depth_model = CachedInference(batcher, cache, model_id=f"{conf.model}_{conf.version_name}", checkpoint=conf.pretrained_resource,
+                              settings=inference_settings(zoe, conf))
+
+# Colormap lookup table and colorbar are built once, not per request
+renderer = DepthRenderer(cmap='gray', label='Depth value (feet)')
+
+FEET_PER_METER = 3.28084
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 
+@app.route('/stats')
+def stats():
+    return jsonify(batcher=batcher.stats(), cache=cache.stats(), worker=dict(pid=os.getpid(), **memory_usage()))
+
+
+def depth_response(depth_np_feet, fmt, key):
+    # Every response carries the cache key so that the other representations can be fetched from /depth/<key>
+    headers = {'X-Depth-Key': key, 'Link': f'</depth/{key}.png>; rel="alternate"; type="image/png"'}
+    if fmt in formats.FORMATS:
+        body, mimetype = formats.encode(depth_np_feet, fmt, units="ft")
+        return Response(body, mimetype=mimetype, headers=headers)
+
+    # Render the depth map with its colorbar straight to PNG
+    buf = io.BytesIO(renderer.render_png(depth_np_feet))
+    response = send_file(buf, mimetype='image/png', as_attachment=True, download_name='depth_map.png')
+    response.headers.update(headers)
+    return response
+
+
+@app.route('/depth/<key>.png')
+@app.route('/depth/<key>')
+def depth(key):
+    # Depth maps of earlier uploads, as long as they are still cached
+    depth_np = depth_model.lookup(key)
+    if depth_np is None:
+        return jsonify({'error': 'Unknown or expired depth key, upload the image again'}), 404
+    try:
+        fmt = 'image/png' if request.path.endswith('.png') else formats.negotiate(request.accept_mimetypes, request.args.get('format'), default=formats.FORMATS['f16'][0])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return depth_response(depth_np * FEET_PER_METER, fmt, key)
+
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     logging.debug("Upload endpoint called")
 
+    try:
+        # image/png (rendered depth map) unless the client asks for one of the binary depth formats
+        fmt = formats.negotiate(request.accept_mimetypes, request.args.get('format'), default='image/png')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     try:
         # Read raw image data from the request
         image_data = request.data
@@ -46,27 +136,17 @@ def upload_file():
 
     try:
         # Perform depth estimation
-        predicted_depth = zoe.infer_pil(image, pad_input=False)  # Better 'metric' accuracy
+        key = depth_model.key(image, image_bytes=image_data, pad_input=False, **infer_kwargs)
+        predicted_depth = depth_model.infer_pil(image, key=key, pad_input=False, **infer_kwargs)  # Better 'metric' accuracy
         logging.debug(f"Depth estimation completed: {predicted_depth}")
 
         # Convert the depth map to a numpy array
         depth_np = np.array(predicted_depth)
 
         # Convert from meters to feet
-        depth_np_feet = depth_np * 3.28084
-
-        # Plot and save the depth map with Matplotlib
-        fig, ax = plt.subplots()
-        cax = ax.imshow(depth_np_feet, cmap='gray')
-        fig.colorbar(cax, ax=ax, label='Depth value (feet)')
-
-        # Save the plot to a BytesIO object
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        plt.close(fig)  # Close the figure to free up memory
+        depth_np_feet = depth_np * FEET_PER_METER
 
-        return send_file(buf, mimetype='image/png', as_attachment=True, download_name='depth_map.png')
+        return depth_response(depth_np_feet, fmt, key)
 
     except Exception as e:
         logging.error(f"Error processing image: {e}")